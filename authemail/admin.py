@@ -1,13 +1,208 @@
-from django.contrib import admin
+from ipware import get_client_ip
+
+from django.conf import settings
+from django.contrib import admin, messages
 from django.contrib.auth import get_user_model
 from django.contrib.auth.admin import UserAdmin
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connections
+from django.forms.models import BaseInlineFormSet
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.urls import path, reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
+from rest_framework.authtoken.models import Token
+
+from authemail import jobs
+from authemail.export import CONTENT_TYPES, export_users
 from authemail.forms import EmailUserCreationForm, EmailUserChangeForm
+from authemail.models import AuditEvent, DailyStats
 from authemail.models import SignupCode, PasswordResetCode, EmailChangeCode
+from authemail.models import send_mass_multi_format_email
+
+# Most codes shown in each inline on the user change page
+CODE_INLINE_LIMIT = 10
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Avoids COUNT(*) over large tables.  An unfiltered changelist uses the
+    planner's row estimate on PostgreSQL and MySQL, and otherwise counting
+    stops at count_limit rows.  As such counts aren't exact, pages past
+    them are still served, and a full page links to the next one.
+    """
+    count_limit = 10000
+    count_is_exact = True
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = self.estimate(queryset)
+            if estimate is not None and estimate > self.count_limit:
+                self.count_is_exact = False
+                return estimate
+        count = queryset.values('pk')[:self.count_limit].count()
+        self.count_is_exact = count < self.count_limit
+        return count
+
+    def validate_number(self, number):
+        try:
+            return super(EstimatedCountPaginator, self).validate_number(number)
+        except EmptyPage:
+            if self.count_is_exact:
+                raise
+            number = int(float(number))
+            if number < 1:
+                raise
+            return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if self.count_is_exact:
+            return super(EstimatedCountPaginator, self).page(number)
+        bottom = (number - 1) * self.per_page
+        page = self._get_page(
+            self.object_list[bottom:bottom + self.per_page], number, self)
+        if len(page) == self.per_page:
+            # There may be more rows than were counted
+            self.num_pages = max(self.num_pages, number + 1)
+        return page
+
+    def estimate(self, queryset):
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+        if connection.vendor == 'postgresql':
+            sql = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+        elif connection.vendor == 'mysql':
+            sql = ('SELECT table_rows FROM information_schema.tables '
+                   'WHERE table_schema = DATABASE() AND table_name = %s')
+        else:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [table])
+            row = cursor.fetchone()
+        return int(row[0]) if row and row[0] is not None else None
+
+
+class BoundedCodeInlineFormSet(BaseInlineFormSet):
+    """
+    Loads only the newest CODE_INLINE_LIMIT codes of the user, in one query.
+    """
+    def get_queryset(self):
+        if not hasattr(self, '_bounded_queryset'):
+            self._bounded_queryset = list(
+                super(BoundedCodeInlineFormSet, self).get_queryset()
+                [:CODE_INLINE_LIMIT])
+        return self._bounded_queryset
+
+
+class BulkActionMixin(object):
+    """
+    Runs bulk actions as set-based queries.  Selections larger than
+    AUTH_EMAIL_ADMIN_BACKGROUND_THRESHOLD are handed to a background job,
+    whose progress can be followed at the URL given in the message.
+    """
+    def run_bulk_action(self, request, queryset, func, description):
+        threshold = getattr(settings, 'AUTH_EMAIL_ADMIN_BACKGROUND_THRESHOLD',
+                            500)
+        if queryset.values('pk')[:threshold + 1].count() <= threshold:
+            count = func(queryset)
+            self.message_user(request, _('%(action)s: %(count)d affected.') %
+                              {'action': description, 'count': count})
+            return
+
+        job_id = jobs.start_job(str(description), func, queryset)
+        opts = self.model._meta
+        url = reverse('admin:%s_%s_job' % (opts.app_label, opts.model_name),
+                      args=[job_id])
+        self.message_user(request, format_html(
+            _('{} is running in the background. <a href="{}">Progress</a>'),
+            description, url))
+        if not jobs.cache_is_shared():
+            self.message_user(request, _(
+                'The default cache is local to this process, so other '
+                'workers can\'t report the progress of the job.  Use a '
+                'shared cache.'), messages.WARNING)
+
+    def job_view(self, request, job_id):
+        if not self.has_change_permission(request):
+            raise Http404
+        job = jobs.get_job(job_id)
+        if job is None:
+            raise Http404
+        return JsonResponse(job)
+
+    def get_urls(self):
+        opts = self.model._meta
+        urls = [
+            path('jobs/<str:job_id>/', self.admin_site.admin_view(self.job_view),
+                 name='%s_%s_job' % (opts.app_label, opts.model_name)),
+        ]
+        return urls + super(BulkActionMixin, self).get_urls()
+
+
+def bulk_action(func, description):
+    """
+    Makes an admin action running func, which takes a queryset and returns
+    the number of objects affected, through BulkActionMixin.
+    """
+    def action(modeladmin, request, queryset):
+        modeladmin.run_bulk_action(request, queryset, func, description)
+    action.__name__ = func.__name__
+    action.short_description = description
+    return action
+
+
+def mark_verified(users):
+    SignupCode.objects.filter(user__in=users.values('pk')).delete()
+    return users.filter(is_verified=False).update(is_verified=True)
+
+
+def resend_verification(users, ipaddr='0.0.0.0'):
+    users = list(users.filter(is_verified=False))
+    signup_codes = SignupCode.objects.issue_codes(users, ipaddr=ipaddr)
+    send_mass_multi_format_email(
+        [c.build_email('signup_email') for c in signup_codes], 'signup_email')
+    return len(signup_codes)
+
+
+def revoke_tokens(users):
+    return Token.objects.filter(user__in=users.values('pk')).delete()[0]
+
+
+def purge_user_codes(users):
+    user_ids = users.values('pk')
+    return sum(model.objects.filter(user__in=user_ids).delete()[0]
+               for model in (SignupCode, PasswordResetCode, EmailChangeCode))
+
+
+def purge_codes(codes):
+    return codes.delete()[0]
+
 
+def purge_expired_codes(codes):
+    return codes.filter(pk__in=codes.model.objects.expired().values(
+        'pk')).delete()[0]
 
-class SignupCodeAdmin(admin.ModelAdmin):
+
+class BaseCodeAdmin(BulkActionMixin, admin.ModelAdmin):
+    actions = [bulk_action(purge_codes, _('Purge selected codes'))]
+    list_select_related = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class BaseCodeInline(admin.TabularInline):
+    formset = BoundedCodeInlineFormSet
+    ordering = ('-created_at',)
+    show_change_link = True
+    classes = ('collapse',)
+
+
+class SignupCodeAdmin(BaseCodeAdmin):
     list_display = ('code', 'user', 'ipaddr', 'created_at')
     ordering = ('-created_at',)
     readonly_fields = ('user', 'code', 'ipaddr')
@@ -16,7 +211,7 @@ class SignupCodeAdmin(admin.ModelAdmin):
         return False
 
 
-class SignupCodeInline(admin.TabularInline):
+class SignupCodeInline(BaseCodeInline):
     model = SignupCode
     fieldsets = (
         (None, {
@@ -29,7 +224,9 @@ class SignupCodeInline(admin.TabularInline):
         return False
 
 
-class PasswordResetCodeAdmin(admin.ModelAdmin):
+class PasswordResetCodeAdmin(BaseCodeAdmin):
+    actions = BaseCodeAdmin.actions + [
+        bulk_action(purge_expired_codes, _('Purge expired codes'))]
     list_display = ('code', 'user', 'created_at')
     ordering = ('-created_at',)
     readonly_fields = ('user', 'code')
@@ -38,7 +235,7 @@ class PasswordResetCodeAdmin(admin.ModelAdmin):
         return False
 
 
-class PasswordResetCodeInline(admin.TabularInline):
+class PasswordResetCodeInline(BaseCodeInline):
     model = PasswordResetCode
     fieldsets = (
         (None, {
@@ -51,7 +248,9 @@ class PasswordResetCodeInline(admin.TabularInline):
         return False
 
 
-class EmailChangeCodeAdmin(admin.ModelAdmin):
+class EmailChangeCodeAdmin(BaseCodeAdmin):
+    actions = BaseCodeAdmin.actions + [
+        bulk_action(purge_expired_codes, _('Purge expired codes'))]
     list_display = ('code', 'user', 'email', 'created_at')
     ordering = ('-created_at',)
     readonly_fields = ('user', 'code', 'email')
@@ -60,7 +259,7 @@ class EmailChangeCodeAdmin(admin.ModelAdmin):
         return False
 
 
-class EmailChangeCodeInline(admin.TabularInline):
+class EmailChangeCodeInline(BaseCodeInline):
     model = EmailChangeCode
     fieldsets = (
         (None, {
@@ -73,7 +272,52 @@ class EmailChangeCodeInline(admin.TabularInline):
         return False
 
 
-class EmailUserAdmin(UserAdmin):
+class AuditEventAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'event', 'email', 'user', 'ipaddr')
+    list_filter = ('event',)
+    # Joined, since the user may have been deleted
+    list_select_related = ('user',)
+    ordering = ('-created_at',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class DailyStatsAdmin(admin.ModelAdmin):
+    """
+    Shows the daily counters, with their totals over the days listed.
+    """
+    list_display = ('date', 'signups', 'signups_verified', 'password_resets',
+                    'password_resets_verified', 'email_changes',
+                    'email_changes_verified', 'codes_expired', 'users_reaped')
+    date_hierarchy = 'date'
+    ordering = ('-date',)
+
+    def changelist_view(self, request, extra_context=None):
+        response = super(DailyStatsAdmin, self).changelist_view(
+            request, extra_context)
+        context = getattr(response, 'context_data', None)
+        if context and 'cl' in context:
+            context['summary'] = DailyStats.objects.summary(
+                days=context['cl'].queryset)
+        return response
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class EmailUserAdmin(BulkActionMixin, UserAdmin):
     fieldsets = (
         (None, {'fields': ('email', 'password')}),
         (_('Personal Info'), {'fields': ('first_name', 'last_name')}),
@@ -92,11 +336,57 @@ class EmailUserAdmin(UserAdmin):
     inlines = [SignupCodeInline, EmailChangeCodeInline, PasswordResetCodeInline]
     list_display = ('email', 'is_verified', 'first_name', 'last_name',
                     'is_staff')
-    search_fields = ('first_name', 'last_name', 'email')
+    search_fields = ('email',)
     ordering = ('email',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = [
+        'resend_verification',
+        'export_users_csv',
+        'export_users_ndjson',
+        bulk_action(mark_verified, _('Mark selected users verified')),
+        bulk_action(revoke_tokens, _('Revoke auth tokens of selected users')),
+        bulk_action(purge_user_codes, _('Purge codes of selected users')),
+    ]
+
+    def resend_verification(self, request, queryset):
+        ipaddr = get_client_ip(request)[0] or '0.0.0.0'
+        self.run_bulk_action(
+            request, queryset,
+            lambda users: resend_verification(users, ipaddr),
+            self.resend_verification.short_description)
+    resend_verification.short_description = _(
+        'Resend verification email to selected users')
+
+    def export_users(self, queryset, format):
+        response = StreamingHttpResponse(export_users(queryset, format),
+                                         content_type=CONTENT_TYPES[format])
+        response['Content-Disposition'] = \
+            'attachment; filename="users.%s"' % format
+        return response
+
+    def export_users_csv(self, request, queryset):
+        return self.export_users(queryset, 'csv')
+    export_users_csv.short_description = _('Export selected users as CSV')
+
+    def export_users_ndjson(self, request, queryset):
+        return self.export_users(queryset, 'ndjson')
+    export_users_ndjson.short_description = _(
+        'Export selected users as NDJSON')
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Search by email prefix, which can use the index on email.
+        """
+        search_term = search_term.strip()
+        if search_term:
+            queryset = queryset.filter(email__startswith=search_term)
+        return queryset, False
 
 
 admin.site.register(get_user_model(), EmailUserAdmin)
 admin.site.register(SignupCode, SignupCodeAdmin)
 admin.site.register(PasswordResetCode, PasswordResetCodeAdmin)
 admin.site.register(EmailChangeCode, EmailChangeCodeAdmin)
+admin.site.register(AuditEvent, AuditEventAdmin)
+admin.site.register(DailyStats, DailyStatsAdmin)
@@ -0,0 +1,59 @@
+"""
+Audit log of the authemail views.
+
+With AUTH_EMAIL_AUDIT_LOG set, the views record an AuditEvent for each
+login, failed login, signup, verification, password reset, password change
+and email change.  Events are buffered in process memory and inserted with
+bulk_create once AUTH_EMAIL_AUDIT_BATCH_SIZE are waiting, at most
+AUTH_EMAIL_AUDIT_MAX_DELAY seconds after an event, and when the worker
+exits, so recording one doesn't add a query to the request.
+"""
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from ipware import get_client_ip
+
+from authemail.buffers import FlushBuffer
+from authemail.models import AuditEvent
+
+
+def flush_events(items):
+    AuditEvent.objects.bulk_create([AuditEvent(**item) for item in items],
+                                   batch_size=1000)
+
+
+_events = None
+
+
+def get_event_buffer():
+    global _events
+    if _events is None:
+        _events = FlushBuffer(
+            flush_events,
+            getattr(settings, 'AUTH_EMAIL_AUDIT_BATCH_SIZE', 100),
+            getattr(settings, 'AUTH_EMAIL_AUDIT_MAX_DELAY', 5))
+    return _events
+
+
+@receiver(setting_changed)
+def _reset_event_buffer(setting, **kwargs):
+    global _events
+    if setting.startswith('AUTH_EMAIL_AUDIT_') and _events is not None:
+        _events.flush()
+        _events = None
+
+
+def record(request, event, user=None, user_id=None, email=''):
+    """
+    Buffers an event of user (or the user with pk user_id).  Does nothing
+    unless AUTH_EMAIL_AUDIT_LOG is set.
+    """
+    if not getattr(settings, 'AUTH_EMAIL_AUDIT_LOG', False):
+        return
+    if user is not None:
+        user_id = user.pk
+        email = email or user.email
+    get_event_buffer().add({
+        'user_id': user_id, 'email': email, 'event': event,
+        'ipaddr': get_client_ip(request)[0], 'created_at': timezone.now()})
@@ -0,0 +1,90 @@
+"""
+Token authentication that loads only the user columns a view needs.
+
+DRF's TokenAuthentication loads the whole token and user rows on every
+authenticated request.  NarrowTokenAuthentication loads the token's key
+and user, and of the user only:
+
+- is_active, is_staff and is_superuser, for the authentication and
+  permission checks,
+- the fields named in the view's user_fields attribute, or else the fields
+  of the view's serializer_class, if it's a ModelSerializer of the user
+  model.
+
+Views with neither get the whole row, as before.  Fields that weren't
+loaded are still loaded on first access, one query each.
+"""
+from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldDoesNotExist
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions, serializers
+from rest_framework.authentication import TokenAuthentication
+
+BASE_USER_FIELDS = ('is_active', 'is_staff', 'is_superuser')
+
+
+def get_serializer_user_fields(serializer_class):
+    """
+    Returns the names of the user model fields serializer_class reads, or
+    None if it isn't a ModelSerializer of the user model with a list of
+    model fields.
+    """
+    user_model = get_user_model()
+    meta = getattr(serializer_class, 'Meta', None)
+    if (meta is None or
+            not issubclass(serializer_class, serializers.ModelSerializer) or
+            not issubclass(user_model, getattr(meta, 'model', ())) or
+            not isinstance(getattr(meta, 'fields', None), (list, tuple))):
+        return None
+
+    names = []
+    for name in meta.fields:
+        try:
+            field = user_model._meta.get_field(name)
+        except FieldDoesNotExist:
+            if name != 'pk':
+                return None
+            continue
+        if not field.concrete or field.many_to_many:
+            return None
+        names.append(field.name)
+    return names
+
+
+class NarrowTokenAuthentication(TokenAuthentication):
+    user_fields = None
+
+    def get_user_fields(self, request):
+        """
+        Returns the user fields to load for the request's view, or None to
+        load them all.
+        """
+        view = (getattr(request, 'parser_context', None) or {}).get('view')
+        fields = getattr(view, 'user_fields', None)
+        if fields is None:
+            fields = get_serializer_user_fields(
+                getattr(view, 'serializer_class', None))
+        if fields is None:
+            return None
+        return list(BASE_USER_FIELDS) + [
+            field for field in fields if field not in BASE_USER_FIELDS]
+
+    def authenticate(self, request):
+        self.user_fields = self.get_user_fields(request)
+        return super(NarrowTokenAuthentication, self).authenticate(request)
+
+    def authenticate_credentials(self, key):
+        model = self.get_model()
+        queryset = model.objects.select_related('user')
+        if self.user_fields is not None:
+            queryset = queryset.only(
+                'key', 'user', *['user__' + field for field in self.user_fields])
+        try:
+            token = queryset.get(key=key)
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return (token.user, token)
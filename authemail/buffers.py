@@ -0,0 +1,208 @@
+"""
+Write buffers that batch rows bound for the database.
+
+A FlushBuffer collects items in process memory and hands them to its flush
+function in one batch once max_size items are waiting, once the oldest has
+waited max_delay seconds, and when the process exits.  Items not yet
+flushed are lost if the process is killed, so buffers only hold data that
+may go missing, like daily counts.
+
+A CacheBuffer keeps its items in the default cache instead, where any
+worker's flush picks up the items of a worker that was killed, as long as
+the cache is shared by the workers and doesn't evict them first.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from django.utils import timezone
+
+logger = logging.getLogger('authemail.buffers')
+
+
+class FlushBuffer(object):
+    def __init__(self, flush_func, max_size=500, max_delay=60.0):
+        self.flush_func = flush_func
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.items = []
+        self.timer = None
+        self.registered = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        with self.lock:
+            self.items.append(item)
+            full = len(self.items) >= self.max_size
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self._flush_later)
+                self.timer.daemon = True
+                self.timer.start()
+            if not self.registered:
+                atexit.register(self.flush)
+                self.registered = True
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Flushes the waiting items now.  Returns how many there were.
+        """
+        with self.lock:
+            items, self.items = self.items, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if items:
+            try:
+                self.flush_func(items)
+            except Exception:
+                logger.exception('Unable to flush %d items', len(items))
+        return len(items)
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        finally:
+            connections.close_all()
+
+
+class CacheBuffer(FlushBuffer):
+    """
+    FlushBuffer keeping its items in the default cache under key_prefix.
+    Items are numbered by a counter in the cache; a flush claims a lock,
+    hands the items numbered since the last flush to flush_func in batches
+    of max_size, and deletes them.  Every max_size-th item triggers a flush.
+    """
+    lock_timeout = 60    # seconds
+
+    def __init__(self, key_prefix, flush_func, max_size=500, max_delay=60.0,
+                 timeout=60 * 60 * 24):
+        super(CacheBuffer, self).__init__(flush_func, max_size, max_delay)
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+
+    def __len__(self):
+        count, flushed = self._range()
+        return count - flushed
+
+    def _range(self):
+        values = cache.get_many([self.key_prefix + 'count',
+                                 self.key_prefix + 'flushed'])
+        count = values.get(self.key_prefix + 'count', 0)
+        flushed = values.get(self.key_prefix + 'flushed', 0)
+        # The counter was evicted and started over
+        if flushed > count:
+            flushed = 0
+        return count, flushed
+
+    def add(self, item):
+        key = self.key_prefix + 'count'
+        try:
+            number = cache.incr(key)
+        except ValueError:
+            cache.add(key, 0, None)
+            number = cache.incr(key)
+        cache.set(self.key_prefix + str(number), item, self.timeout)
+
+        with self.lock:
+            full = number % self.max_size == 0
+            if not full and self.timer is None:
+                self.timer = threading.Timer(self.max_delay, self._flush_later)
+                self.timer.daemon = True
+                self.timer.start()
+            if not self.registered:
+                atexit.register(self.flush)
+                self.registered = True
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Flushes the items waiting in the cache, unless another flush is
+        running.  Returns how many there were.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        lock_key = self.key_prefix + 'lock'
+        if not cache.add(lock_key, 1, self.lock_timeout):
+            return 0
+        try:
+            count, flushed = self._range()
+            numbers = range(flushed + 1, count + 1)
+            total = 0
+            for start in range(0, len(numbers), self.max_size):
+                keys = [self.key_prefix + str(number)
+                        for number in numbers[start:start + self.max_size]]
+                values = cache.get_many(keys)
+                items = [values[key] for key in keys if key in values]
+                if items:
+                    try:
+                        self.flush_func(items)
+                    except Exception:
+                        logger.exception('Unable to flush %d items',
+                                         len(items))
+                cache.delete_many(keys)
+                total += len(items)
+            cache.set(self.key_prefix + 'flushed', count, None)
+            return total
+        finally:
+            cache.delete(lock_key)
+
+
+def flush_last_logins(items):
+    """
+    Writes the latest of the (user pk, time) items of each user as its
+    last_login, in one UPDATE per batch.
+    """
+    latest = {}
+    for pk, last_login in items:
+        if pk not in latest or last_login > latest[pk]:
+            latest[pk] = last_login
+    user_model = get_user_model()
+    user_model._default_manager.bulk_update(
+        [user_model(pk=pk, last_login=last_login)
+         for pk, last_login in sorted(latest.items())],
+        ['last_login'], batch_size=1000)
+
+
+_last_logins = None
+
+
+def get_last_login_buffer():
+    global _last_logins
+    if _last_logins is None:
+        _last_logins = CacheBuffer(
+            'authemail:last_login:', flush_last_logins,
+            getattr(settings, 'AUTH_EMAIL_LAST_LOGIN_BATCH_SIZE', 500),
+            getattr(settings, 'AUTH_EMAIL_LAST_LOGIN_MAX_DELAY', 60))
+    return _last_logins
+
+
+@receiver(setting_changed)
+def _reset_last_login_buffer(setting, **kwargs):
+    global _last_logins
+    if (setting.startswith('AUTH_EMAIL_LAST_LOGIN_') and
+            _last_logins is not None):
+        _last_logins.flush()
+        _last_logins = None
+
+
+def record_last_login(user):
+    """
+    Sets user.last_login to now, and buffers the write to the database in
+    the cache.
+    """
+    user.last_login = timezone.now()
+    get_last_login_buffer().add((user.pk, user.last_login))
@@ -0,0 +1,62 @@
+"""
+System checks.
+
+The code column's type depends on AUTH_EMAIL_CODE_STORAGE when the tables
+are migrated, which migrations don't record, so check_code_storage
+compares the setting with the columns in the database.  Like other
+database checks, it runs with migrate and with check --database.
+"""
+from django.conf import settings
+from django.core import checks
+from django.db import connections
+
+
+def _code_column_is_binary(connection, model):
+    """
+    Returns whether the code column of model's table is binary, or None if
+    the table doesn't exist yet.
+    """
+    table = model._meta.db_table
+    column = model._meta.get_field('code').column
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            # Introspection doesn't tell varbinary from varchar
+            cursor.execute(
+                'SELECT data_type FROM information_schema.columns '
+                'WHERE table_schema = DATABASE() AND table_name = %s '
+                'AND column_name = %s', [table, column])
+            row = cursor.fetchone()
+            return None if row is None else 'binary' in row[0].lower()
+        if table not in connection.introspection.table_names(cursor):
+            return None
+        for info in connection.introspection.get_table_description(cursor,
+                                                                   table):
+            if info.name == column:
+                return connection.introspection.get_field_type(
+                    info.type_code, info) == 'BinaryField'
+    return None
+
+
+@checks.register(checks.Tags.database)
+def check_code_storage(app_configs=None, databases=None, **kwargs):
+    from authemail.models import EmailChangeCode, PasswordResetCode
+    from authemail.models import SignupCode
+
+    storage = getattr(settings, 'AUTH_EMAIL_CODE_STORAGE', 'hex')
+    errors = []
+    for alias in databases or []:
+        connection = connections[alias]
+        for model in (SignupCode, PasswordResetCode, EmailChangeCode):
+            binary = _code_column_is_binary(connection, model)
+            if binary is None or binary == (storage == 'binary'):
+                continue
+            errors.append(checks.Error(
+                "AUTH_EMAIL_CODE_STORAGE is %r, but the code column of %s "
+                "in database %r is %s." % (
+                    storage, model._meta.db_table, alias,
+                    'binary' if binary else 'not binary'),
+                hint="Set AUTH_EMAIL_CODE_STORAGE to the storage the code "
+                     "tables were migrated with.",
+                obj=model,
+                id='authemail.E001'))
+    return errors
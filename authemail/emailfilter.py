@@ -0,0 +1,220 @@
+"""
+Bloom filter of the email addresses of users.
+
+With AUTH_EMAIL_EMAIL_FILTER set, the Signup, PasswordReset and EmailChange
+views ask the filter before looking an email address up in the user table,
+and skip the lookup for addresses the filter has never seen.
+
+The filter is built from the user table by the authemail_rebuild_email_filter
+management command and published in the cache named by
+AUTH_EMAIL_EMAIL_FILTER_CACHE (default 'default'), which must be shared by
+all workers.  Each worker keeps a copy in process memory.  Emails of users
+saved after the build are appended to a log in the same cache, which the
+workers replay into their copies, so checking an email costs one cache
+round trip rather than a query.
+
+A Bloom filter can't forget an email, so deleted users and old addresses
+stay in the filter, and only cost a lookup, until the next rebuild.  While
+the filter is missing, e.g. before the first build, every email is looked
+up.
+"""
+import hashlib
+import math
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+GENERATION_KEY = 'authemail:emailfilter:generation'
+
+
+class BloomFilter(object):
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray(bits or (num_bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate=0.01):
+        """
+        Returns an empty filter sized for capacity emails at error_rate
+        false positives.
+        """
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                 math.log(2) ** 2))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, email):
+        digest = hashlib.sha256(email.lower().encode('utf-8')).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, email):
+        for position in self._positions(email):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, email):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(email))
+
+
+def is_enabled():
+    return getattr(settings, 'AUTH_EMAIL_EMAIL_FILTER', False)
+
+
+def get_cache():
+    return caches[getattr(settings, 'AUTH_EMAIL_EMAIL_FILTER_CACHE',
+                          'default')]
+
+
+def _key(generation, name):
+    return 'authemail:emailfilter:%s:%s' % (generation, name)
+
+
+class _LocalFilter(object):
+    """
+    This worker's copy of the filter of one generation, and how much of
+    that generation's log it has replayed.
+    """
+    def __init__(self, generation, bloom):
+        self.generation = generation
+        self.bloom = bloom
+        self.replayed = 0
+
+
+_lock = threading.Lock()
+_local = None
+
+
+@receiver(setting_changed)
+def _reset_local(setting, **kwargs):
+    global _local
+    if setting.startswith('AUTH_EMAIL_EMAIL_FILTER'):
+        _local = None
+
+
+def _load(cache):
+    """
+    Brings this worker's copy up to date.  Returns it, or None when the
+    filter can't be trusted.
+    """
+    global _local
+    local = _local
+    if local is None:
+        generation = cache.get(GENERATION_KEY)
+        if generation is None:
+            return None
+        length = None
+    else:
+        generation = local.generation
+        values = cache.get_many([GENERATION_KEY, _key(generation, 'length')])
+        if values.get(GENERATION_KEY) != generation:
+            # Rebuilt by another worker
+            local = _local = None
+            return _load(cache)
+        length = values.get(_key(generation, 'length'), 0)
+
+    with _lock:
+        if local is None:
+            data = cache.get(_key(generation, 'filter'))
+            if data is None:
+                return None
+            local = _local = _LocalFilter(generation, BloomFilter(**data))
+            length = cache.get(_key(generation, 'length'), 0)
+
+        if length > local.replayed:
+            keys = [_key(generation, 'log:%d' % n)
+                    for n in range(local.replayed + 1, length + 1)]
+            emails = cache.get_many(keys)
+            for key in keys:
+                if key not in emails:
+                    # Not written yet, or evicted
+                    return None
+                local.bloom.add(emails[key])
+                local.replayed += 1
+    return local
+
+
+def may_exist(email):
+    """
+    Returns False if no user has ever had the email address, as far as the
+    filter knows, or True if one might.  Always True while the filter is
+    disabled or missing.
+    """
+    if not is_enabled():
+        return True
+    local = _load(get_cache())
+    return local is None or email in local.bloom
+
+
+def add_emails(emails):
+    """
+    Adds the emails to the filter, by appending those it doesn't know yet
+    to the log.
+    """
+    if not is_enabled():
+        return
+    cache = get_cache()
+    local = _load(cache)
+    generation = local.generation if local else cache.get(GENERATION_KEY)
+    if generation is None:
+        return
+
+    emails = [email for email in emails
+              if local is None or email not in local.bloom]
+    if not emails:
+        return
+    length_key = _key(generation, 'length')
+    cache.add(length_key, 0, None)
+    length = cache.incr(length_key, len(emails))
+    cache.set_many(dict(
+        (_key(generation, 'log:%d' % n), email)
+        for n, email in enumerate(emails, length - len(emails) + 1)), None)
+
+
+def rebuild(using=None, error_rate=None):
+    """
+    Builds the filter from the user table and publishes it.  Returns it.
+    """
+    from django.contrib.auth import get_user_model
+
+    if error_rate is None:
+        error_rate = getattr(settings, 'AUTH_EMAIL_EMAIL_FILTER_ERROR_RATE',
+                             0.01)
+    cache = get_cache()
+    old_generation = cache.get(GENERATION_KEY, 0)
+    generation = old_generation + 1
+    # Users saved from here on go to the log of the new generation
+    cache.set(_key(generation, 'length'), 0, None)
+    cache.set(GENERATION_KEY, generation, None)
+
+    queryset = get_user_model()._default_manager.using(using)
+    # Room to grow until the next rebuild
+    bloom = BloomFilter.for_capacity(max(2 * queryset.count(), 10000),
+                                     error_rate)
+    for email in queryset.values_list('email', flat=True).iterator(
+            chunk_size=2000):
+        bloom.add(email)
+
+    cache.set(_key(generation, 'filter'), {
+        'num_bits': bloom.num_bits, 'num_hashes': bloom.num_hashes,
+        'bits': bytes(bloom.bits)}, None)
+
+    old_length = cache.get(_key(old_generation, 'length'), 0)
+    cache.delete_many([_key(old_generation, 'filter'),
+                       _key(old_generation, 'length')] +
+                      [_key(old_generation, 'log:%d' % n)
+                       for n in range(1, old_length + 1)])
+    return bloom
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def _add_saved_email(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'email' in update_fields:
+        add_emails([instance.email])
@@ -0,0 +1,15 @@
+"""
+Password hashing for worker processes.
+
+Workers of a process pool may be started with the spawn method, without
+Django's settings, so they are given the hasher to use rather than look it
+up.  This module doesn't import the models, so workers can unpickle
+hash_password without setting up Django.
+"""
+
+
+def hash_password(hasher, password):
+    """
+    Hashes password like make_password() does with hasher.
+    """
+    return hasher.encode(password, hasher.salt())
@@ -0,0 +1,146 @@
+"""
+Background jobs for bulk operations on large querysets.
+
+A job walks the primary keys of a queryset in batches, in order, and calls
+a function with a queryset of each batch.  Its progress is kept in the
+default cache under the job id so any worker can report it, which needs a
+cache shared by the workers, such as Memcached or Redis.
+
+Jobs run in a thread of the worker that started them, and are lost if it
+exits.  While a job runs, the thread refreshes a heartbeat in the cache; a
+pending or running job whose heartbeat is older than
+AUTH_EMAIL_JOB_STALE_AFTER seconds is reported as stale.
+"""
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections
+from django.utils import timezone
+
+CACHE_PREFIX = 'authemail:job:'
+CACHE_TIMEOUT = 60 * 60 * 24    # seconds
+
+
+def get_stale_after():
+    return getattr(settings, 'AUTH_EMAIL_JOB_STALE_AFTER', 60)
+
+
+def cache_is_shared():
+    """
+    Returns False if the default cache is local to the process, so workers
+    can't see each other's jobs.
+    """
+    return not isinstance(caches['default'], (LocMemCache, DummyCache))
+
+
+def get_job(job_id):
+    keys = [CACHE_PREFIX + job_id, CACHE_PREFIX + job_id + ':heartbeat']
+    values = cache.get_many(keys)
+    job = values.get(keys[0])
+    if job is not None and job.get('state') in ('pending', 'running'):
+        heartbeat = values.get(keys[1])
+        if heartbeat is None or time.time() - heartbeat > get_stale_after():
+            job.update(state='stale',
+                       error='The worker running the job has stopped.')
+    return job
+
+
+def _save_job(job_id, **state):
+    job = cache.get(CACHE_PREFIX + job_id) or {}
+    job.update(state, updated_at=timezone.now().isoformat())
+    cache.set(CACHE_PREFIX + job_id, job, CACHE_TIMEOUT)
+    return job
+
+
+def iter_pk_batches(queryset, batch_size):
+    """
+    Yields lists of primary keys using keyset pagination, so every batch
+    costs the same however far into the queryset it is.
+    """
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        batch_queryset = queryset
+        if last_pk is not None:
+            batch_queryset = queryset.filter(pk__gt=last_pk)
+        batch = list(batch_queryset[:batch_size])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1]
+
+
+def _beat(job_id):
+    cache.set(CACHE_PREFIX + job_id + ':heartbeat', time.time(),
+              CACHE_TIMEOUT)
+
+
+@contextmanager
+def heartbeat(job_id):
+    """
+    Refreshes the job's heartbeat from another thread until exited.
+    """
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(get_stale_after() / 3.0):
+            _beat(job_id)
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_job(job_id, func, queryset, batch_size):
+    model = queryset.model
+    with heartbeat(job_id):
+        _run_job(job_id, func, model, queryset, batch_size)
+
+
+def _run_job(job_id, func, model, queryset, batch_size):
+    try:
+        _save_job(job_id, state='running', total=queryset.count())
+        processed = affected = 0
+        for batch in iter_pk_batches(queryset, batch_size):
+            affected += func(model._default_manager.filter(pk__in=batch))
+            processed += len(batch)
+            _save_job(job_id, processed=processed, affected=affected)
+        _save_job(job_id, state='done')
+    except Exception as e:
+        _save_job(job_id, state='failed', error=str(e))
+        raise
+
+
+def _thread_main(*args):
+    try:
+        run_job(*args)
+    finally:
+        connections.close_all()
+
+
+def _start_thread(*args):
+    thread = threading.Thread(target=_thread_main, args=args, daemon=True)
+    thread.start()
+
+
+def start_job(name, func, queryset, batch_size=1000):
+    """
+    Runs func over queryset in the background.  func takes a queryset and
+    returns the number of objects it affected.  Returns the job id.
+    """
+    job_id = uuid.uuid4().hex
+    _save_job(job_id, name=name, state='pending', total=None, processed=0,
+              affected=0, created_at=timezone.now().isoformat())
+    _beat(job_id)
+    _start_thread(job_id, func, queryset, batch_size)
+    return job_id
@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from authemail.export import EXPORT_FIELDS, FORMATS, export_users
+
+
+class Command(BaseCommand):
+    help = 'Stream all users to a CSV or NDJSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', default='-',
+                            help="File to write, or '-' for stdout.")
+        parser.add_argument('--fields', default=','.join(EXPORT_FIELDS),
+                            help='Comma-separated user fields to export.')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        user_model = get_user_model()
+        fields = tuple(f.strip() for f in options['fields'].split(','))
+        concrete = set(f.name for f in user_model._meta.concrete_fields)
+        unknown = [f for f in fields if f != 'pk' and f not in concrete]
+        if unknown:
+            raise CommandError('Unknown user fields: %s' % ', '.join(unknown))
+
+        queryset = user_model._default_manager.using(options['database'])
+        lines = export_users(queryset, options['format'], fields,
+                             options['chunk_size'])
+
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+        else:
+            with open(options['output'], 'w', newline='') as f:
+                f.writelines(lines)
@@ -0,0 +1,50 @@
+import csv
+import sys
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Create users from a CSV file with an email column and optional '
+            'password, first_name and last_name columns.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help="CSV file, or '-' for stdin.")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--hash-workers', type=int, default=None,
+                            help='Hash passwords in this many processes.')
+        parser.add_argument('--no-emails', action='store_false',
+                            dest='send_emails',
+                            help="Don't send signup, password reset or "
+                                 "welcome emails.")
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if options['csv_file'] == '-':
+            self.import_users(sys.stdin, options)
+        else:
+            with open(options['csv_file'], newline='') as f:
+                self.import_users(f, options)
+
+    def import_users(self, f, options):
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or 'email' not in reader.fieldnames:
+            raise CommandError('The CSV file must have an email column.')
+
+        start = time.perf_counter()
+        manager = get_user_model()._default_manager.db_manager(
+            options['database'])
+        created, skipped = manager.bulk_create_users(
+            reader, batch_size=options['batch_size'],
+            hash_workers=options['hash_workers'],
+            send_emails=options['send_emails'])
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write('Created %d users in %.1fs, skipped %d existing or '
+                          'duplicate emails' % (created, elapsed,
+                                                len(skipped)))
+        if options['verbosity'] > 1:
+            for email in skipped:
+                self.stdout.write('Skipped %s' % email)
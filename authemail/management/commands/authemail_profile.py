@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from authemail.jobs import cache_is_shared
+from authemail.profiling import disable_profiling, enable_profiling
+from authemail.profiling import get_profile_dir, profiled_endpoints
+
+
+class Command(BaseCommand):
+    help = ('Switch sampled profiling of authemail endpoints on or off at '
+            'runtime, or list the endpoints being profiled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('enable', 'disable', 'list'))
+        parser.add_argument('url_names', nargs='*',
+                            help="URL names, e.g. 'authemail-login'.")
+        parser.add_argument('--rate', type=float, default=None,
+                            help='Fraction of requests to profile.')
+
+    def handle(self, *args, **options):
+        action, url_names = options['action'], options['url_names']
+
+        if action == 'enable':
+            if not url_names:
+                raise CommandError('Name at least one URL to profile.')
+            for url_name in url_names:
+                enable_profiling(url_name, options['rate'])
+        elif action == 'disable':
+            for url_name in url_names or [None]:
+                disable_profiling(url_name)
+
+        endpoints = profiled_endpoints(refresh=True)
+        for url_name, rate in sorted(endpoints.items()):
+            self.stdout.write('%s %g' % (url_name, rate))
+        if not endpoints:
+            self.stdout.write('No endpoints are being profiled.')
+        self.stdout.write('Reports are written to %s' % get_profile_dir())
+        if not cache_is_shared():
+            self.stderr.write('The default cache is local to each process, '
+                              'so the switches don\'t reach the workers.  '
+                              'Use a shared cache.')
@@ -0,0 +1,28 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ('Delete unverified users who signed up more than a number of '
+            'days ago, together with their codes and tokens.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='Age in days after which unverified users '
+                                 'are deleted (default '
+                                 'AUTH_EMAIL_UNVERIFIED_MAX_AGE, or 30).')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count the users that would be '
+                                 'deleted.')
+
+    def handle(self, *args, **options):
+        manager = get_user_model()._default_manager
+        if options['dry_run']:
+            count = manager.stale_unverified(options['days']).count()
+            self.stdout.write('%d unverified users would be deleted' % count)
+            return
+
+        count = manager.reap_unverified(options['days'],
+                                        options['batch_size'])
+        self.stdout.write('Deleted %d unverified users' % count)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from authemail import emailfilter
+
+
+class Command(BaseCommand):
+    help = ('Build the filter of user email addresses from the user table '
+            'and publish it to the workers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--error-rate', type=float, default=None,
+                            help='False positive rate (default '
+                                 'AUTH_EMAIL_EMAIL_FILTER_ERROR_RATE, or '
+                                 '0.01).')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        bloom = emailfilter.rebuild(options['database'],
+                                    options['error_rate'])
+        self.stdout.write('Built the email filter: %d bits, %d hashes' % (
+            bloom.num_bits, bloom.num_hashes))
@@ -0,0 +1,114 @@
+import random
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from authemail.emailfilter import add_emails
+from authemail.models import SignupCode, PasswordResetCode, EmailChangeCode
+from authemail.models import _set_bulk_created_pks
+
+
+class Command(BaseCommand):
+    help = ('Bulk-insert synthetic users and their signup, password reset '
+            'and email change codes for load testing.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('count', type=int,
+                            help='Number of users to create.')
+        parser.add_argument('--unverified', type=float, default=0.2,
+                            help='Fraction of users not yet verified, each '
+                                 'with a signup code (default 0.2).')
+        parser.add_argument('--inactive', type=float, default=0.05,
+                            help='Fraction of users verified but inactive '
+                                 '(default 0.05).')
+        parser.add_argument('--password-reset-codes', type=float,
+                            default=0.1,
+                            help='Fraction of verified users with a password '
+                                 'reset code (default 0.1).')
+        parser.add_argument('--email-change-codes', type=float, default=0.05,
+                            help='Fraction of verified users with an email '
+                                 'change code (default 0.05).')
+        parser.add_argument('--password', default='seed',
+                            help='Password for every user, hashed once.')
+        parser.add_argument('--domain', default='seed.example.com')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=None,
+                            help='Random seed for a reproducible mix.')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if options['unverified'] + options['inactive'] > 1:
+            raise CommandError('--unverified and --inactive add up to more '
+                               'than 1.')
+
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.password = make_password(options['password'])
+        self.prefix = uuid.uuid4().hex[:8]
+        totals = dict.fromkeys(('users', 'signup', 'reset', 'change'), 0)
+
+        start = time.perf_counter()
+        batch_size = options['batch_size']
+        for offset in range(0, options['count'], batch_size):
+            size = min(batch_size, options['count'] - offset)
+            for key, value in self.seed_batch(offset, size).items():
+                totals[key] += value
+            if options['verbosity'] > 1:
+                self.stdout.write('%d/%d users' %
+                                  (offset + size, options['count']))
+        elapsed = time.perf_counter() - start
+
+        rows = sum(totals.values())
+        self.stdout.write(
+            'Created %(users)d users, %(signup)d signup codes, %(reset)d '
+            'password reset codes and %(change)d email change codes' % totals)
+        self.stdout.write('%d rows in %.1fs (%d rows/minute)' % (
+            rows, elapsed, rows / elapsed * 60 if elapsed else rows))
+
+    def seed_batch(self, offset, size):
+        options = self.options
+        using = options['database']
+        now = timezone.now()
+        user_model = get_user_model()
+
+        users = []
+        for i in range(offset, offset + size):
+            r = self.rng.random()
+            is_verified = r >= options['unverified']
+            is_active = not (is_verified and
+                             r < options['unverified'] + options['inactive'])
+            users.append(user_model(
+                email='%s-%d@%s' % (self.prefix, i, options['domain']),
+                password=self.password, is_verified=is_verified,
+                is_active=is_active, last_login=now, date_joined=now))
+
+        with transaction.atomic(using=using):
+            user_model.objects.using(using).bulk_create(users)
+            _set_bulk_created_pks(user_model, users, using)
+
+            signup_codes, reset_codes, change_codes = [], [], []
+            for user in users:
+                if not user.is_verified:
+                    signup_codes.append(SignupCode.objects.new_code(
+                        user, ipaddr='127.0.0.1'))
+                    continue
+                if self.rng.random() < options['password_reset_codes']:
+                    reset_codes.append(
+                        PasswordResetCode.objects.new_code(user))
+                if self.rng.random() < options['email_change_codes']:
+                    change_codes.append(EmailChangeCode.objects.new_code(
+                        user, email='new-' + user.email))
+
+            SignupCode.objects.using(using).bulk_create(signup_codes)
+            PasswordResetCode.objects.using(using).bulk_create(reset_codes)
+            EmailChangeCode.objects.using(using).bulk_create(change_codes)
+        # bulk_create() sends no post_save signals
+        add_emails([user.email for user in users])
+
+        return {'users': len(users), 'signup': len(signup_codes),
+                'reset': len(reset_codes), 'change': len(change_codes)}
@@ -0,0 +1,220 @@
+"""
+Instrumentation for the authemail views and email delivery.
+
+Metrics are sent to the sink named by the AUTH_EMAIL_METRICS_SINK setting,
+e.g. 'authemail.metrics.InMemorySink' or 'authemail.metrics.LoggingSink'.
+When the setting is not defined, recording a metric is a no-op.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+VIEW_SECONDS = 'authemail_view_seconds'
+STAGE_SECONDS = 'authemail_stage_seconds'
+CODES = 'authemail_codes_total'
+EMAIL_SEND_FAILURES = 'authemail_email_send_failures_total'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class BaseSink(object):
+    def incr(self, name, value, labels):
+        raise NotImplementedError
+
+    def observe(self, name, value, labels):
+        raise NotImplementedError
+
+
+class InMemorySink(BaseSink):
+    """
+    Keeps counters and histograms in process memory and renders them in the
+    Prometheus text exposition format.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def incr(self, name, value, labels):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0.0,
+                    'count': 0}
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def get_counter(self, name, **labels):
+        return self.counters.get((name, _labels(labels)), 0)
+
+    def get_histogram(self, name, **labels):
+        return self.histograms.get((name, _labels(labels)))
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, dict(value, buckets=list(
+                value['buckets']))) for key, value in self.histograms.items())
+
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _format_labels(labels), value))
+
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for le, count in zip(self.buckets, histogram['buckets']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, _format_labels(labels + (('le', repr(le)),)),
+                    cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, _format_labels(labels + (('le', '+Inf'),)),
+                histogram['count']))
+            lines.append('%s_sum%s %r' % (name, _format_labels(labels),
+                                          histogram['sum']))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels),
+                                            histogram['count']))
+
+        return '\n'.join(lines) + '\n'
+
+
+class LoggingSink(BaseSink):
+    """
+    Writes every metric to the 'authemail.metrics' logger at DEBUG level.
+    """
+    logger = logging.getLogger('authemail.metrics')
+
+    def incr(self, name, value, labels):
+        self.logger.debug('%s%s +%s', name, _format_labels(labels), value)
+
+    def observe(self, name, value, labels):
+        self.logger.debug('%s%s %.6f', name, _format_labels(labels), value)
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, v.replace('\\', r'\\').replace('"', r'\"')
+                     .replace('\n', r'\n'))
+        for k, v in labels)
+
+
+_sink = None
+_sink_loaded = False
+
+
+def get_sink():
+    global _sink, _sink_loaded
+    if not _sink_loaded:
+        path = getattr(settings, 'AUTH_EMAIL_METRICS_SINK', None)
+        _sink = import_string(path)() if path else None
+        _sink_loaded = True
+    return _sink
+
+
+@receiver(setting_changed)
+def _reset_sink(setting, **kwargs):
+    global _sink, _sink_loaded
+    if setting == 'AUTH_EMAIL_METRICS_SINK':
+        _sink, _sink_loaded = None, False
+
+
+def incr(name, value=1, **labels):
+    sink = get_sink()
+    if sink is not None:
+        sink.incr(name, value, _labels(labels))
+
+
+def observe(name, value, **labels):
+    sink = get_sink()
+    if sink is not None:
+        sink.observe(name, value, _labels(labels))
+
+
+@contextmanager
+def _timer(sink, name, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        sink.observe(name, time.perf_counter() - start, _labels(labels))
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_timer = _NullTimer()
+
+
+def timer(name, **labels):
+    """
+    Context manager observing the time spent in its block.
+    """
+    sink = get_sink()
+    if sink is None:
+        return _null_timer
+    return _timer(sink, name, labels)
+
+
+def stage(name):
+    return timer(STAGE_SECONDS, stage=name)
+
+
+class ViewMetricsMixin(object):
+    """
+    Records the latency of every request handled by an APIView, labelled by
+    view, method, and response status code.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        sink = get_sink()
+        if sink is None:
+            return super(ViewMetricsMixin, self).dispatch(
+                request, *args, **kwargs)
+
+        start = time.perf_counter()
+        response = super(ViewMetricsMixin, self).dispatch(
+            request, *args, **kwargs)
+        sink.observe(VIEW_SECONDS, time.perf_counter() - start, _labels({
+            'view': self.__class__.__name__, 'method': request.method,
+            'status': response.status_code}))
+        return response
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+def delete_duplicate_codes(apps, schema_editor):
+    """
+    Keeps only the newest code of each user, so the unique constraints
+    can be added.
+    """
+    db_alias = schema_editor.connection.alias
+    for model_name in ('SignupCode', 'PasswordResetCode', 'EmailChangeCode'):
+        model = apps.get_model('authemail', model_name)
+        codes = model.objects.using(db_alias)
+        duplicated = (codes.values('user')
+                      .annotate(count=models.Count('pk'))
+                      .filter(count__gt=1)
+                      .values_list('user', flat=True))
+        for user_id in duplicated.iterator():
+            stale = (codes.filter(user_id=user_id)
+                     .order_by('-created_at', '-pk')
+                     .values_list('pk', flat=True)[1:])
+            codes.filter(pk__in=list(stale)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('authemail', '0002_emailchangecode'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_codes,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='signupcode',
+            constraint=models.UniqueConstraint(fields=('user',), name='authemail_signupcode_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='passwordresetcode',
+            constraint=models.UniqueConstraint(fields=('user',), name='authemail_passwordresetcode_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='emailchangecode',
+            constraint=models.UniqueConstraint(fields=('user',), name='authemail_emailchangecode_user'),
+        ),
+    ]
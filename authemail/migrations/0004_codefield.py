@@ -0,0 +1,44 @@
+from django.conf import settings
+from django.db import migrations
+
+import authemail.models
+
+
+def delete_codes_for_binary_storage(apps, schema_editor):
+    """
+    Hex codes can't be cast to binary columns in place, so outstanding codes
+    are deleted when AUTH_EMAIL_CODE_STORAGE is 'binary'.
+    """
+    if getattr(settings, 'AUTH_EMAIL_CODE_STORAGE', 'hex') != 'binary':
+        return
+    db_alias = schema_editor.connection.alias
+    for model_name in ('SignupCode', 'PasswordResetCode', 'EmailChangeCode'):
+        model = apps.get_model('authemail', model_name)
+        model.objects.using(db_alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authemail', '0003_one_code_per_user'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_codes_for_binary_storage,
+                             migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='signupcode',
+            name='code',
+            field=authemail.models.CodeField(max_length=40, primary_key=True, serialize=False, verbose_name='code'),
+        ),
+        migrations.AlterField(
+            model_name='passwordresetcode',
+            name='code',
+            field=authemail.models.CodeField(max_length=40, primary_key=True, serialize=False, verbose_name='code'),
+        ),
+        migrations.AlterField(
+            model_name='emailchangecode',
+            name='code',
+            field=authemail.models.CodeField(max_length=40, primary_key=True, serialize=False, verbose_name='code'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+import hashlib
+
+from django.db import migrations
+from django.db.models import Case, Value, When
+
+import authemail.models
+
+BATCH_SIZE = 1000
+
+
+def hash_codes(apps, schema_editor):
+    """
+    Replaces each plaintext code with its SHA-256 digest, in one UPDATE per
+    batch of at most BATCH_SIZE codes.  Digests are 64 hex characters long,
+    codes 40, so codes already hashed are skipped.
+    """
+    connection = schema_editor.connection
+    # Each code takes three query parameters, as in bulk_update()
+    batch_size = min(BATCH_SIZE, connection.ops.bulk_batch_size(
+        ['pk', 'pk', 'code'], range(BATCH_SIZE)))
+    for model_name in ('SignupCode', 'PasswordResetCode', 'EmailChangeCode'):
+        model = apps.get_model('authemail', model_name)
+        field = model._meta.get_field('code')
+        codes = model.objects.using(connection.alias).order_by('pk')
+        last_pk = None
+        while True:
+            batch_queryset = codes
+            if last_pk is not None:
+                batch_queryset = codes.filter(pk__gt=last_pk)
+            batch = list(batch_queryset.values_list('pk', flat=True)
+                         [:batch_size])
+            if not batch:
+                break
+            plain = [code for code in batch if len(code) == 40]
+            if plain:
+                codes.filter(pk__in=plain).update(code=Case(*[
+                    When(pk=code, then=Value(
+                        hashlib.sha256(code.encode('utf-8')).hexdigest(),
+                        output_field=field))
+                    for code in plain], output_field=field))
+            last_pk = batch[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authemail', '0004_codefield'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='signupcode',
+            name='code',
+            field=authemail.models.CodeField(max_length=64, primary_key=True, serialize=False, verbose_name='code'),
+        ),
+        migrations.AlterField(
+            model_name='passwordresetcode',
+            name='code',
+            field=authemail.models.CodeField(max_length=64, primary_key=True, serialize=False, verbose_name='code'),
+        ),
+        migrations.AlterField(
+            model_name='emailchangecode',
+            name='code',
+            field=authemail.models.CodeField(max_length=64, primary_key=True, serialize=False, verbose_name='code'),
+        ),
+        # Digests can't be turned back into codes, so they're kept
+        migrations.RunPython(hash_codes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('authemail', '0005_hash_codes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('email', models.EmailField(blank=True, max_length=255, verbose_name='email address')),
+                ('event', models.CharField(choices=[('login', 'Login'), ('login_failed', 'Failed login'), ('signup', 'Signup'), ('signup_verified', 'Signup verified'), ('password_reset', 'Password reset requested'), ('password_reset_verified', 'Password reset'), ('password_change', 'Password changed'), ('email_change', 'Email change requested'), ('email_change_verified', 'Email changed')], max_length=32, verbose_name='event')),
+                ('ipaddr', models.GenericIPAddressField(blank=True, null=True, verbose_name='ip address')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(blank=True, db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'created_at'], name='authemail_audit_user_created'), models.Index(fields=['created_at'], name='authemail_audit_created')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-19 07:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authemail', '0006_auditevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('date', models.DateField(primary_key=True, serialize=False, verbose_name='date')),
+                ('signups', models.PositiveIntegerField(default=0, verbose_name='signups')),
+                ('signups_verified', models.PositiveIntegerField(default=0, verbose_name='signups verified')),
+                ('verify_seconds', models.BigIntegerField(default=0, help_text='Total over the signups verified.', verbose_name='seconds to verify')),
+                ('verified_within_10m', models.PositiveIntegerField(default=0)),
+                ('verified_within_1h', models.PositiveIntegerField(default=0)),
+                ('verified_within_1d', models.PositiveIntegerField(default=0)),
+                ('verified_later', models.PositiveIntegerField(default=0)),
+                ('password_resets', models.PositiveIntegerField(default=0, verbose_name='password resets')),
+                ('password_resets_verified', models.PositiveIntegerField(default=0, verbose_name='password resets verified')),
+                ('email_changes', models.PositiveIntegerField(default=0, verbose_name='email changes')),
+                ('email_changes_verified', models.PositiveIntegerField(default=0, verbose_name='email changes verified')),
+                ('codes_expired', models.PositiveIntegerField(default=0, verbose_name='codes expired')),
+                ('users_reaped', models.PositiveIntegerField(default=0, verbose_name='unverified users reaped')),
+            ],
+            options={
+                'verbose_name': 'daily stats',
+                'verbose_name_plural': 'daily stats',
+            },
+        ),
+    ]
@@ -1,23 +1,63 @@
 import binascii
+import hashlib
+import itertools
 import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from functools import partial
 from django.conf import settings
+from django.contrib.auth.hashers import get_hasher, make_password
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser
 from django.contrib.auth.models import PermissionsMixin
 from django.core.mail.message import EmailMultiAlternatives
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.core.mail import send_mail
+from django.core.mail import get_connection, send_mail
+
+from authemail import checks  # noqa: F401 registers the system checks
+from authemail import metrics
+from authemail.emailfilter import add_emails
+from authemail.hashing import hash_password
+from authemail.stores import get_code_store
 
 # Make part of the model eventually, so it can be edited
 EXPIRY_PERIOD = 3    # days
 
+# Age after which unverified users are reaped, unless set in settings
+UNVERIFIED_MAX_AGE = 30    # days
+
 
 def _generate_code():
     return binascii.hexlify(os.urandom(20)).decode('utf-8')
 
 
+def _hash_code(code):
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+def _set_bulk_created_pks(model, objs, using, key='email'):
+    """
+    Fills in the primary keys of objs after bulk_create() on databases that
+    can't return them, looking them up by the unique field key.
+    """
+    if not objs:
+        return
+    features = connections[using].features
+    # Django 2.2 names the feature can_return_ids_from_bulk_insert
+    if getattr(features, 'can_return_rows_from_bulk_insert',
+               getattr(features, 'can_return_ids_from_bulk_insert', False)):
+        return
+    pks = dict(model._default_manager.using(using).filter(**{
+        key + '__in': [getattr(obj, key) for obj in objs]}).values_list(
+            key, 'pk'))
+    for obj in objs:
+        obj.pk = pks[getattr(obj, key)]
+
+
 class EmailUserManager(BaseUserManager):
     def _create_user(self, email, password, is_staff, is_superuser,
                      is_verified, **extra_fields):
@@ -44,6 +84,158 @@ class EmailUserManager(BaseUserManager):
         return self._create_user(email, password, True, True, True,
                                  **extra_fields)
 
+    def stale_unverified(self, days=None):
+        """
+        Unverified, non-staff users who joined more than days ago
+        (AUTH_EMAIL_UNVERIFIED_MAX_AGE by default).
+        """
+        if days is None:
+            days = getattr(settings, 'AUTH_EMAIL_UNVERIFIED_MAX_AGE',
+                           UNVERIFIED_MAX_AGE)
+        cutoff = timezone.now() - timedelta(days=days)
+        return self.filter(is_verified=False, date_joined__lt=cutoff,
+                           is_staff=False)
+
+    def reap_unverified(self, days=None, batch_size=1000):
+        """
+        Deletes the stale unverified users, together with their codes and
+        tokens, batch_size users at a time.  Call it periodically, e.g. from
+        cron or a task scheduler.
+
+        Returns the number of users deleted.
+        """
+        # Read the batches from the primary, which they're deleted from
+        using = self._db or router.db_for_write(self.model)
+        stale = self.stale_unverified(days).using(using)
+        deleted = 0
+        while True:
+            batch = list(stale.order_by('date_joined').values_list(
+                'pk', flat=True)[:batch_size])
+            if not batch:
+                if deleted:
+                    from authemail import stats
+                    stats.record(users_reaped=deleted)
+                return deleted
+            with transaction.atomic(using=using):
+                # Users verified since the batch was read are kept
+                counts = stale.filter(pk__in=batch).delete()[1]
+            deleted += counts.get(self.model._meta.label, 0)
+
+    def bulk_create_users(self, rows, batch_size=1000, hash_workers=None,
+                          send_emails=True, ipaddr='0.0.0.0'):
+        """
+        Creates users from an iterable of dicts with an 'email' and optional
+        'password', 'first_name' and 'last_name', batch_size at a time.
+
+        Emails already taken are skipped.  Users with a password are sent a
+        signup email to verify their address, or a welcome email when
+        AUTH_EMAIL_VERIFICATION is False.  Users without one get an unusable
+        password, are verified, and are sent a password reset email to choose
+        their password.  Passwords are hashed in a pool of hash_workers
+        processes, if given, with the default hasher.  Emails taken by
+        another process while a chunk is created are skipped too.
+
+        Returns the number of users created and the list of emails skipped.
+        """
+        rows = iter(rows)
+        executor = ProcessPoolExecutor(hash_workers) if hash_workers else None
+        created, skipped = 0, []
+        try:
+            while True:
+                chunk = list(itertools.islice(rows, batch_size))
+                if not chunk:
+                    break
+                chunk_created, chunk_skipped = self._bulk_create_chunk(
+                    chunk, executor, send_emails, ipaddr)
+                created += chunk_created
+                skipped.extend(chunk_skipped)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return created, skipped
+
+    def _bulk_create_chunk(self, chunk, executor, send_emails, ipaddr):
+        using = self._db or router.db_for_write(self.model)
+        must_validate_email = getattr(settings, 'AUTH_EMAIL_VERIFICATION', True)
+
+        rows, skipped = {}, []
+        for row in chunk:
+            if not row.get('email'):
+                raise ValueError('Users must have an email address')
+            email = self.normalize_email(row['email'])
+            if email in rows:
+                skipped.append(email)
+            else:
+                rows[email] = row
+
+        # One lookup for the whole chunk
+        taken = set(self.using(using).filter(email__in=list(rows)).values_list(
+            'email', flat=True))
+        skipped.extend(email for email in rows if email in taken)
+        rows = [(email, row) for email, row in rows.items()
+                if email not in taken]
+
+        passwords = [row['password'] for email, row in rows
+                     if row.get('password')]
+        if executor is not None:
+            hashes = executor.map(partial(hash_password, get_hasher()),
+                                  passwords,
+                                  chunksize=max(1, len(passwords) // 16))
+        else:
+            hashes = map(make_password, passwords)
+        hashes = iter(list(hashes))
+
+        now = timezone.now()
+        users = []
+        for email, row in rows:
+            has_password = bool(row.get('password'))
+            users.append(self.model(
+                email=email, first_name=row.get('first_name') or '',
+                last_name=row.get('last_name') or '',
+                password=next(hashes) if has_password else make_password(None),
+                is_staff=False, is_active=True, is_superuser=False,
+                is_verified=not (has_password and must_validate_email),
+                last_login=now, date_joined=now))
+
+        with transaction.atomic(using=using):
+            # Emails taken since the lookup are skipped rather than failing
+            # the chunk.  Passwords are salted, so they tell which rows were
+            # inserted by this call, and ignore_conflicts sets no pks.
+            self.using(using).bulk_create(users, ignore_conflicts=True)
+            inserted = dict(self.using(using).filter(
+                email__in=[user.email for user in users]).values_list(
+                    'password', 'pk'))
+            for user in users:
+                user.pk = inserted.get(user.password)
+            skipped.extend(user.email for user in users if user.pk is None)
+            users = [user for user in users if user.pk is not None]
+            signup_codes = SignupCode.objects.db_manager(using).issue_codes(
+                [user for user in users if not user.is_verified],
+                ipaddr=ipaddr)
+            password_reset_codes = \
+                PasswordResetCode.objects.db_manager(using).issue_codes(
+                    [user for user in users if not user.has_usable_password()])
+        # bulk_create() sends no post_save signals
+        add_emails([user.email for user in users])
+
+        if send_emails:
+            welcome_emails = [
+                build_multi_format_email('welcome_email',
+                                         {'email': user.email}, user.email)
+                for user in users
+                if user.is_verified and user.has_usable_password()]
+            for prefix, messages in (
+                    ('signup_email', [c.build_email('signup_email')
+                                      for c in signup_codes]),
+                    ('password_reset_email',
+                     [c.build_email('password_reset_email')
+                      for c in password_reset_codes]),
+                    ('welcome_email', welcome_emails)):
+                if messages:
+                    send_mass_multi_format_email(messages, prefix)
+
+        return len(users), skipped
+
 
 class EmailAbstractUser(AbstractBaseUser, PermissionsMixin):
     """
@@ -99,80 +291,279 @@ class EmailAbstractUser(AbstractBaseUser, PermissionsMixin):
         return self.email
 
 
-class SignupCodeManager(models.Manager):
+class BaseCodeManager(models.Manager):
+    """
+    Issues, looks up and uses codes, which are kept in the code store named
+    by AUTH_EMAIL_CODE_STORE (the code tables by default).
+    """
+    @property
+    def store(self):
+        return get_code_store()
+
+    def new_code(self, user, **fields):
+        """
+        Returns an unsaved code for user.  Only the SHA-256 digest of the code
+        is stored; the code itself is kept in raw_code for the emails.
+        """
+        raw_code = _generate_code()
+        obj = self.model(user=user, code=_hash_code(raw_code), **fields)
+        obj.raw_code = raw_code
+        return obj
+
+    def issue_code(self, user, **fields):
+        """
+        Creates a new code for user, replacing the user's live code, if any.
+        """
+        return self.store.issue(self, self.new_code(user, **fields))
+
+    def issue_codes(self, users, **fields):
+        return self.store.issue_many(
+            self, [self.new_code(user, **fields) for user in users])
+
+    def _with_user(self, obj):
+        # Codes kept outside the code tables may outlive their user.  Only
+        # used codes are checked, since their user is loaded anyway;
+        # deleting a user deletes its codes from the stores.
+        user_model = self.model._meta.get_field('user').related_model
+        try:
+            obj.user
+        except user_model.DoesNotExist:
+            raise self.model.DoesNotExist()
+        return obj
+
+    def get_by_code(self, code):
+        return self.store.get(self, _hash_code(code))
+
+    def use_code(self, code):
+        """
+        Returns the code and deletes it, so it can be used only once.
+        """
+        return self._with_user(self.store.pop(self, _hash_code(code)))
+
+    def delete_user_codes(self, user):
+        self.store.delete_for_user(self, user)
+
+
+class SignupCodeManager(BaseCodeManager):
     def create_signup_code(self, user, ipaddr):
-        code = _generate_code()
-        signup_code = self.create(user=user, code=code, ipaddr=ipaddr)
+        with metrics.stage('code_create'):
+            signup_code = self.issue_code(user, ipaddr=ipaddr)
+        metrics.incr(metrics.CODES, kind='signup', event='issued')
 
         return signup_code
 
-    def set_user_is_verified(self, code):
+    def verify_code(self, code):
+        """
+        Uses code and marks its user verified.  Returns the used code, or
+        None if there is no such code.
+        """
         try:
-            signup_code = SignupCode.objects.get(code=code)
-            signup_code.user.is_verified = True
-            signup_code.user.save()
-            return True
-        except SignupCode.DoesNotExist:
-            pass
+            signup_code = self.use_code(code)
+        except self.model.DoesNotExist:
+            return None
+        signup_code.user.is_verified = True
+        signup_code.user.save(update_fields=['is_verified'])
+        return signup_code
+
+    def set_user_is_verified(self, code):
+        return self.verify_code(code) is not None
+
+
+class ExpiringCodeManager(BaseCodeManager):
+    def get_expiry_period(self):
+        return EXPIRY_PERIOD
 
-        return False
+    def expired(self):
+        """
+        Codes older than the expiry period, as the verify views judge them.
+        """
+        today = timezone.now().replace(hour=0, minute=0, second=0,
+                                       microsecond=0)
+        cutoff = today - timedelta(days=self.get_expiry_period())
+        return self.filter(created_at__lt=cutoff)
 
 
-class PasswordResetCodeManager(models.Manager):
+class PasswordResetCodeManager(ExpiringCodeManager):
     def create_password_reset_code(self, user):
-        code = _generate_code()
-        password_reset_code = self.create(user=user, code=code)
+        with metrics.stage('code_create'):
+            password_reset_code = self.issue_code(user)
+        metrics.incr(metrics.CODES, kind='password_reset', event='issued')
 
         return password_reset_code
 
-    def get_expiry_period(self):
-        return EXPIRY_PERIOD
 
-
-class EmailChangeCodeManager(models.Manager):
+class EmailChangeCodeManager(ExpiringCodeManager):
     def create_email_change_code(self, user, email):
-        code = _generate_code()
-        email_change_code = self.create(user=user, code=code, email=email)
+        with metrics.stage('code_create'):
+            email_change_code = self.issue_code(user, email=email)
+        metrics.incr(metrics.CODES, kind='email_change', event='issued')
 
         return email_change_code
 
-    def get_expiry_period(self):
-        return EXPIRY_PERIOD
 
+class AuditEventManager(models.Manager):
+    def between(self, since=None, until=None):
+        """
+        Events from since up to, but not including, until, newest first.
+        """
+        events = self.all()
+        if since is not None:
+            events = events.filter(created_at__gte=since)
+        if until is not None:
+            events = events.filter(created_at__lt=until)
+        return events.order_by('-created_at', '-pk')
 
-def send_multi_format_email(template_prefix, template_ctxt, target_email):
+    def for_user(self, user, since=None, until=None):
+        return self.between(since, until).filter(user_id=getattr(user, 'pk', user))
+
+
+class DailyStatsManager(models.Manager):
+    def between(self, since=None, until=None):
+        """
+        Days from since up to, but not including, until, newest first.
+        """
+        days = self.all()
+        if since is not None:
+            days = days.filter(date__gte=since)
+        if until is not None:
+            days = days.filter(date__lt=until)
+        return days.order_by('-date')
+
+    def summary(self, since=None, until=None, days=None):
+        """
+        Returns the totals of the counters over the days (by default those
+        between since and until), with the mean time to verify a signup in
+        seconds, and the name of the bucket of VERIFY_BUCKETS the median
+        time falls in.  Both are None without verified signups.
+        """
+        if days is None:
+            days = self.between(since, until)
+        counters = [f.name for f in self.model._meta.concrete_fields
+                    if f.name != 'date']
+        totals = days.order_by().aggregate(
+            **dict((name, models.Sum(name)) for name in counters))
+        totals = dict((name, value or 0) for name, value in totals.items())
+
+        verified = totals['signups_verified']
+        totals['mean_verify_seconds'] = (
+            totals['verify_seconds'] / verified if verified else None)
+        totals['median_verify_bucket'] = None
+        within = 0
+        for name, seconds in self.model.VERIFY_BUCKETS:
+            within += totals[name]
+            if verified and within * 2 >= verified:
+                totals['median_verify_bucket'] = name
+                break
+        return totals
+
+
+def build_multi_format_email(template_prefix, template_ctxt, target_email):
     subject_file = 'authemail/%s_subject.txt' % template_prefix
     txt_file = 'authemail/%s.txt' % template_prefix
     html_file = 'authemail/%s.html' % template_prefix
 
-    subject = render_to_string(subject_file).strip()
+    with metrics.stage('render'):
+        subject = render_to_string(subject_file).strip()
+        text_content = render_to_string(txt_file, template_ctxt)
+        html_content = render_to_string(html_file, template_ctxt)
     from_email = settings.EMAIL_FROM
     to = target_email
     bcc_email = settings.EMAIL_BCC
-    text_content = render_to_string(txt_file, template_ctxt)
-    html_content = render_to_string(html_file, template_ctxt)
     msg = EmailMultiAlternatives(subject, text_content, from_email, [to],
                                  bcc=[bcc_email])
     msg.attach_alternative(html_content, 'text/html')
-    msg.send()
+    return msg
+
+
+def send_multi_format_email(template_prefix, template_ctxt, target_email):
+    msg = build_multi_format_email(template_prefix, template_ctxt,
+                                   target_email)
+    try:
+        with metrics.stage('send'):
+            msg.send()
+    except Exception:
+        metrics.incr(metrics.EMAIL_SEND_FAILURES, template=template_prefix)
+        raise
+
+
+def send_mass_multi_format_email(messages, template_prefix):
+    """
+    Sends messages built by build_multi_format_email over one connection.
+    """
+    try:
+        with metrics.stage('send'):
+            return get_connection().send_messages(messages)
+    except Exception:
+        metrics.incr(metrics.EMAIL_SEND_FAILURES, value=len(messages),
+                     template=template_prefix)
+        raise
+
+
+class CodeField(models.CharField):
+    """
+    A code, always a hex string in Python.  With AUTH_EMAIL_CODE_STORAGE set
+    to 'binary', the column holds the raw bytes instead, half the size.
+    """
+    @property
+    def binary(self):
+        return getattr(settings, 'AUTH_EMAIL_CODE_STORAGE', 'hex') == 'binary'
+
+    def db_type(self, connection):
+        if not self.binary:
+            return super(CodeField, self).db_type(connection)
+        size = self.max_length // 2
+        if connection.vendor == 'mysql':
+            return 'varbinary(%d)' % size
+        if connection.vendor == 'oracle':
+            return 'RAW(%d)' % size
+        return connection.data_types['BinaryField']
+
+    def from_db_value(self, value, expression, connection):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value).hex()
+        return value
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        value = super(CodeField, self).get_db_prep_value(value, connection,
+                                                         prepared)
+        if value is None or not self.binary:
+            return value
+        try:
+            value = bytes.fromhex(value)
+        except ValueError:
+            value = b''    # Not a code, so matches no row
+        return connection.Database.Binary(value)
 
 
 class AbstractBaseCode(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
-    code = models.CharField(_('code'), max_length=40, primary_key=True)
+    code = CodeField(_('code'), max_length=64, primary_key=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # The code sent to the user, known only when the code was just created
+    raw_code = None
+
     class Meta:
         abstract = True
 
-    def send_email(self, prefix):
-        ctxt = {
+    def get_email_context(self):
+        return {
             'email': self.user.email,
             'first_name': self.user.first_name,
             'last_name': self.user.last_name,
-            'code': self.code
+            'code': self.raw_code
         }
-        send_multi_format_email(prefix, ctxt, target_email=self.user.email)
+
+    def build_email(self, prefix):
+        return build_multi_format_email(prefix, self.get_email_context(),
+                                        target_email=self.user.email)
+
+    def send_email(self, prefix):
+        send_multi_format_email(prefix, self.get_email_context(),
+                                target_email=self.user.email)
+
+    def delete(self, *args, **kwargs):
+        return type(self).objects.store.delete(self, *args, **kwargs)
 
     def __str__(self):
         return self.code
@@ -183,6 +574,13 @@ class SignupCode(AbstractBaseCode):
 
     objects = SignupCodeManager()
 
+    class Meta(AbstractBaseCode.Meta):
+        constraints = [
+            # One live code per user
+            models.UniqueConstraint(fields=['user'],
+                                    name='authemail_signupcode_user'),
+        ]
+
     def send_signup_email(self):
         prefix = 'signup_email'
         self.send_email(prefix)
@@ -191,6 +589,13 @@ class SignupCode(AbstractBaseCode):
 class PasswordResetCode(AbstractBaseCode):
     objects = PasswordResetCodeManager()
 
+    class Meta(AbstractBaseCode.Meta):
+        constraints = [
+            # One live code per user
+            models.UniqueConstraint(fields=['user'],
+                                    name='authemail_passwordresetcode_user'),
+        ]
+
     def send_password_reset_email(self):
         prefix = 'password_reset_email'
         self.send_email(prefix)
@@ -201,6 +606,13 @@ class EmailChangeCode(AbstractBaseCode):
 
     objects = EmailChangeCodeManager()
 
+    class Meta(AbstractBaseCode.Meta):
+        constraints = [
+            # One live code per user
+            models.UniqueConstraint(fields=['user'],
+                                    name='authemail_emailchangecode_user'),
+        ]
+
     def send_email_change_emails(self):
         prefix = 'email_change_notify_previous_email'
         self.send_email(prefix)
@@ -208,7 +620,110 @@ class EmailChangeCode(AbstractBaseCode):
         prefix = 'email_change_confirm_new_email'
         ctxt = {
             'email': self.email,
-            'code': self.code
+            'code': self.raw_code
         }
 
         send_multi_format_email(prefix, ctxt, target_email=self.email)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def delete_codes_of_deleted_user(sender, instance, **kwargs):
+    """
+    Deletes the codes of a deleted user from code stores the user's
+    deletion doesn't cascade to.
+    """
+    for model in (SignupCode, PasswordResetCode, EmailChangeCode):
+        model.objects.store.user_deleted(model.objects, instance)
+
+
+class AuditEvent(models.Model):
+    LOGIN = 'login'
+    LOGIN_FAILED = 'login_failed'
+    SIGNUP = 'signup'
+    SIGNUP_VERIFIED = 'signup_verified'
+    PASSWORD_RESET = 'password_reset'
+    PASSWORD_RESET_VERIFIED = 'password_reset_verified'
+    PASSWORD_CHANGE = 'password_change'
+    EMAIL_CHANGE = 'email_change'
+    EMAIL_CHANGE_VERIFIED = 'email_change_verified'
+    EVENTS = (
+        (LOGIN, _('Login')),
+        (LOGIN_FAILED, _('Failed login')),
+        (SIGNUP, _('Signup')),
+        (SIGNUP_VERIFIED, _('Signup verified')),
+        (PASSWORD_RESET, _('Password reset requested')),
+        (PASSWORD_RESET_VERIFIED, _('Password reset')),
+        (PASSWORD_CHANGE, _('Password changed')),
+        (EMAIL_CHANGE, _('Email change requested')),
+        (EMAIL_CHANGE_VERIFIED, _('Email changed')),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    # No database constraint, so events outlive their users and a buffered
+    # event of a deleted user can still be inserted.  Indexed with
+    # created_at below.
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+                             on_delete=models.DO_NOTHING, db_constraint=False,
+                             db_index=False, related_name='+')
+    email = models.EmailField(_('email address'), max_length=255, blank=True)
+    event = models.CharField(_('event'), max_length=32, choices=EVENTS)
+    ipaddr = models.GenericIPAddressField(_('ip address'), null=True,
+                                          blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = AuditEventManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at'],
+                         name='authemail_audit_user_created'),
+            models.Index(fields=['created_at'],
+                         name='authemail_audit_created'),
+        ]
+
+    def __str__(self):
+        return '%s %s' % (self.event, self.email)
+
+
+class DailyStats(models.Model):
+    """
+    Counters of one day, kept up to date by authemail.stats.
+    """
+    # (counter, most seconds from signup to verification it counts)
+    VERIFY_BUCKETS = (
+        ('verified_within_10m', 600),
+        ('verified_within_1h', 3600),
+        ('verified_within_1d', 86400),
+        ('verified_later', None),
+    )
+
+    date = models.DateField(_('date'), primary_key=True)
+    signups = models.PositiveIntegerField(_('signups'), default=0)
+    signups_verified = models.PositiveIntegerField(_('signups verified'),
+                                                   default=0)
+    verify_seconds = models.BigIntegerField(
+        _('seconds to verify'), default=0,
+        help_text=_('Total over the signups verified.'))
+    verified_within_10m = models.PositiveIntegerField(default=0)
+    verified_within_1h = models.PositiveIntegerField(default=0)
+    verified_within_1d = models.PositiveIntegerField(default=0)
+    verified_later = models.PositiveIntegerField(default=0)
+    password_resets = models.PositiveIntegerField(_('password resets'),
+                                                  default=0)
+    password_resets_verified = models.PositiveIntegerField(
+        _('password resets verified'), default=0)
+    email_changes = models.PositiveIntegerField(_('email changes'), default=0)
+    email_changes_verified = models.PositiveIntegerField(
+        _('email changes verified'), default=0)
+    codes_expired = models.PositiveIntegerField(_('codes expired'), default=0)
+    users_reaped = models.PositiveIntegerField(_('unverified users reaped'),
+                                               default=0)
+
+    objects = DailyStatsManager()
+
+    class Meta:
+        verbose_name = _('daily stats')
+        verbose_name_plural = _('daily stats')
+
+    def __str__(self):
+        return str(self.date)
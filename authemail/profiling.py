@@ -0,0 +1,199 @@
+"""
+Sampled profiling of the authemail views.
+
+Profiling is switched on per URL name (e.g. 'authemail-login') at runtime
+with enable_profiling()/disable_profiling() or the authemail_profile
+management command.  The switches live in the default cache, so every
+worker picks them up without a restart when the cache is shared by the
+workers, such as Memcached or Redis; with a cache local to each process,
+such as the default LocMemCache, they only reach the process that set them.
+A sampled request is run under cProfile while its SQL queries are recorded,
+and a report is written to AUTH_EMAIL_PROFILE_DIR, keeping at most
+AUTH_EMAIL_PROFILE_MAX_FILES.
+"""
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import timezone
+
+CACHE_KEY = 'authemail:profile:endpoints'
+REPORT_SUFFIX = '.prof.txt'
+
+_endpoints = None
+_endpoints_expire = 0
+
+
+def _setting(name, default):
+    return getattr(settings, 'AUTH_EMAIL_PROFILE_' + name, default)
+
+
+def get_profile_dir():
+    return _setting('DIR', None) or os.path.join(tempfile.gettempdir(),
+                                                 'authemail-profiles')
+
+
+def profiled_endpoints(refresh=False):
+    """
+    Returns a dict of the profiled URL names and their sample rates.  The
+    cached switches are re-read at most every AUTH_EMAIL_PROFILE_REFRESH
+    seconds.
+    """
+    global _endpoints, _endpoints_expire
+    now = time.monotonic()
+    if refresh or _endpoints is None or now >= _endpoints_expire:
+        _endpoints = cache.get(CACHE_KEY) or {}
+        _endpoints_expire = now + _setting('REFRESH', 5)
+    return _endpoints
+
+
+def enable_profiling(url_name, rate=None):
+    if rate is None:
+        rate = _setting('SAMPLE_RATE', 0.01)
+    endpoints = dict(cache.get(CACHE_KEY) or {})
+    endpoints[url_name] = rate
+    cache.set(CACHE_KEY, endpoints, None)
+    profiled_endpoints(refresh=True)
+
+
+def disable_profiling(url_name=None):
+    """
+    Stop profiling url_name, or all endpoints if url_name is None.
+    """
+    endpoints = dict(cache.get(CACHE_KEY) or {})
+    if url_name is None:
+        endpoints = {}
+    else:
+        endpoints.pop(url_name, None)
+    cache.set(CACHE_KEY, endpoints, None)
+    profiled_endpoints(refresh=True)
+
+
+def should_profile(url_name):
+    rate = profiled_endpoints().get(url_name)
+    return rate is not None and random.random() < rate
+
+
+class _QueryRecorder(object):
+    """
+    Execute wrapper recording the SQL, parameters and duration of the
+    queries of the default connection.
+    """
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql, 'params': params,
+                'time': '%.3f' % (time.perf_counter() - start)})
+
+
+def _write_report(url_name, request, response, profiler, queries, seconds):
+    profile_dir = get_profile_dir()
+    os.makedirs(profile_dir, exist_ok=True)
+
+    out = io.StringIO()
+    out.write('endpoint: %s\n' % url_name)
+    out.write('request: %s %s\n' % (request.method, request.path))
+    out.write('status: %s\n' % getattr(response, 'status_code', '-'))
+    out.write('time: %.2f ms\n' % (seconds * 1000))
+    out.write('\nqueries: %d\n' % len(queries))
+    for query in queries:
+        out.write('%8s s  %s  %r\n' % (query['time'], query['sql'],
+                                        query['params']))
+    out.write('\n')
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(_setting('TOP', 30))
+
+    filename = '%s-%s-%d%s' % (
+        url_name, timezone.now().strftime('%Y%m%dT%H%M%S%f'), os.getpid(),
+        REPORT_SUFFIX)
+    path = os.path.join(profile_dir, filename)
+    with open(path, 'w') as f:
+        f.write(out.getvalue())
+
+    _rotate(profile_dir)
+    return path
+
+
+def _rotate(profile_dir):
+    reports = [os.path.join(profile_dir, f) for f in os.listdir(profile_dir)
+               if f.endswith(REPORT_SUFFIX)]
+    reports.sort(key=lambda path: (os.path.getmtime(path), path))
+    for path in reports[:-_setting('MAX_FILES', 100)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def profile_call(url_name, request, func, *args, **kwargs):
+    """
+    Calls func under the profiler and writes a report for the request.
+    """
+    profiler = cProfile.Profile()
+    recorder = _QueryRecorder()
+    with connection.execute_wrapper(recorder):
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            response = func(*args, **kwargs)
+            if hasattr(response, 'render') and not response.is_rendered:
+                response.render()
+        finally:
+            profiler.disable()
+        seconds = time.perf_counter() - start
+    _write_report(url_name, request, response, profiler,
+                  recorder.queries, seconds)
+    return response
+
+
+def profile_view(url_name=None):
+    """
+    Decorator profiling a sample of the requests to a view.  The URL name
+    defaults to the one the request was resolved to.
+    """
+    def decorator(view_func):
+        @functools.wraps(view_func)
+        def wrapped(request, *args, **kwargs):
+            name = url_name
+            if name is None and request.resolver_match:
+                name = request.resolver_match.url_name
+            if name and should_profile(name):
+                return profile_call(name, request, view_func, request,
+                                    *args, **kwargs)
+            return view_func(request, *args, **kwargs)
+        return wrapped
+    return decorator
+
+
+class ProfilingMiddleware(object):
+    """
+    Profiles a sample of the requests to every URL name switched on with
+    enable_profiling().  Place it last in MIDDLEWARE, since it calls the
+    view itself.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        url_name = request.resolver_match.url_name
+        if url_name and should_profile(url_name):
+            return profile_call(url_name, request, view_func, request,
+                                *view_args, **view_kwargs)
+        return None
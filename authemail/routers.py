@@ -0,0 +1,153 @@
+"""
+Read-replica routing for authemail.
+
+ReplicaRouter sends reads of the authemail models, the user model and
+tokens to one of the databases named in AUTH_EMAIL_REPLICAS, and all
+writes to the default database.  Reads go to the primary instead:
+
+- inside primary() blocks and views marked with PrimaryDatabaseMixin, such
+  as the verify views,
+- when ReplicaPinningMiddleware is installed, for the rest of a request
+  once it has written, and for AUTH_EMAIL_REPLICA_PIN_SECONDS after a
+  client's last request that wrote.
+
+Writes outside a request, e.g. in management commands, don't pin anything;
+wrap reads that must see them in primary().
+"""
+import hashlib
+import random
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from ipware import get_client_ip
+
+CACHE_PREFIX = 'authemail:pin:'
+
+# use_primary: inside primary() blocks
+# pin: the RequestPin of the request_scope() block
+_local = threading.local()
+
+
+class RequestPin(object):
+    """
+    Whether a request's reads go to the primary, and whether it wrote.
+    """
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+def get_replicas():
+    return list(getattr(settings, 'AUTH_EMAIL_REPLICAS', []))
+
+
+def use_primary():
+    """
+    Sends the rest of the current request's reads to the primary.  Does
+    nothing outside request_scope().
+    """
+    pin = getattr(_local, 'pin', None)
+    if pin is not None:
+        pin.pinned = pin.wrote = True
+
+
+@contextmanager
+def request_scope(pinned=False):
+    """
+    Scopes use_primary() to the block, e.g. a request.  Yields the block's
+    RequestPin.
+    """
+    previous = getattr(_local, 'pin', None)
+    _local.pin = RequestPin(pinned)
+    try:
+        yield _local.pin
+    finally:
+        _local.pin = previous
+
+
+@contextmanager
+def primary():
+    previous = getattr(_local, 'use_primary', False)
+    _local.use_primary = True
+    try:
+        yield
+    finally:
+        _local.use_primary = previous
+
+
+def _is_routed(model):
+    opts = model._meta
+    return (opts.app_label == 'authemail' or
+            opts.label in (settings.AUTH_USER_MODEL, 'authtoken.Token'))
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if not _is_routed(model):
+            return None
+        replicas = get_replicas()
+        pin = getattr(_local, 'pin', None)
+        if (not replicas or getattr(_local, 'use_primary', False) or
+                (pin is not None and pin.pinned)):
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not _is_routed(model):
+            return None
+        # Read your own writes for the rest of the request
+        use_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = set([DEFAULT_DB_ALIAS] + get_replicas())
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class PrimaryDatabaseMixin(object):
+    """
+    Reads from the primary for the whole request.
+    """
+    def dispatch(self, request, *args, **kwargs):
+        with primary():
+            return super(PrimaryDatabaseMixin, self).dispatch(
+                request, *args, **kwargs)
+
+
+def _client_keys(request):
+    keys = []
+    client_ip = get_client_ip(request)[0]
+    if client_ip:
+        keys.append(client_ip)
+    authorization = request.META.get('HTTP_AUTHORIZATION')
+    if authorization:
+        keys.append(authorization)
+    return [CACHE_PREFIX + hashlib.sha256(key.encode('utf-8')).hexdigest()
+            for key in keys]
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Pins a client, known by its IP address and by its Authorization header,
+    to the primary for AUTH_EMAIL_REPLICA_PIN_SECONDS after a request of it
+    writes, whatever its method, so it reads its own writes despite
+    replication lag.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        keys = _client_keys(request)
+        pinned = bool(keys) and bool(cache.get_many(keys))
+        with request_scope(pinned) as pin:
+            response = self.get_response(request)
+
+        if keys and pin.wrote:
+            timeout = getattr(settings, 'AUTH_EMAIL_REPLICA_PIN_SECONDS', 10)
+            cache.set_many(dict.fromkeys(keys, True), timeout)
+        return response
@@ -1,8 +1,108 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
+from rest_framework.fields import empty
+from rest_framework.utils import html
 
+from authemail.models import DailyStats
 
-class SignupSerializer(serializers.Serializer):
+
+class _FieldSpec(object):
+    """
+    What validating one character field of a flat payload takes, read off
+    the field once.
+    """
+    def __init__(self, field):
+        self.name = field.field_name
+        self.required = field.required
+        self.default = field.default
+        self.allow_blank = field.allow_blank
+        self.trim_whitespace = field.trim_whitespace
+        self.validators = tuple(field.validators)
+
+
+def _compile_specs(serializer_class):
+    """
+    Returns the field specs of serializer_class, or None if it has anything
+    but plain character fields and no custom validation.
+    """
+    if serializer_class.validate is not serializers.Serializer.validate:
+        return None
+    specs = []
+    for field in serializer_class().fields.values():
+        if (type(field) not in (serializers.CharField, serializers.EmailField)
+                or hasattr(serializer_class, 'validate_' + field.field_name)
+                or field.read_only or field.allow_null or
+                field.source != field.field_name or
+                (field.default is not empty and callable(field.default)) or
+                any(getattr(v, 'requires_context', False)
+                    for v in field.validators)):
+            return None
+        specs.append(_FieldSpec(field))
+    return specs
+
+
+_specs = {}
+
+
+class FastValidationMixin(object):
+    """
+    Validates flat payloads of character fields against specs compiled once
+    per serializer class, without building the serializer's fields.  Any
+    payload the specs don't accept goes through the full DRF validation, so
+    errors are always DRF's own.  Set AUTH_EMAIL_FAST_VALIDATION to False to
+    always use the full validation.
+    """
+    def is_valid(self, *args, **kwargs):
+        if (not hasattr(self, '_validated_data') and
+                getattr(settings, 'AUTH_EMAIL_FAST_VALIDATION', True)):
+            cls = type(self)
+            if cls not in _specs:
+                _specs[cls] = _compile_specs(cls)
+            if _specs[cls] is not None:
+                validated_data = self._fast_validate(_specs[cls])
+                if validated_data is not None:
+                    self._validated_data = validated_data
+                    self._errors = {}
+        return super(FastValidationMixin, self).is_valid(*args, **kwargs)
+
+    def _fast_validate(self, specs):
+        """
+        Returns the validated data, or None to leave the payload to DRF.
+        """
+        data = self.initial_data
+        if not hasattr(data, 'get') or getattr(self, 'partial', False):
+            return None
+        is_html = html.is_html_input(data)
+
+        validated_data = {}
+        for spec in specs:
+            value = data.get(spec.name, empty)
+            # HTML forms send optional fields left blank as ''
+            if value is empty or (is_html and value == '' and
+                                  not spec.required and not spec.allow_blank):
+                if spec.required:
+                    return None
+                if spec.default is not empty:
+                    validated_data[spec.name] = spec.default
+                continue
+            if not isinstance(value, str):
+                return None
+            if spec.trim_whitespace:
+                value = value.strip()
+            if not value and not spec.allow_blank:
+                return None
+            try:
+                for validator in spec.validators:
+                    validator(value)
+            except (DjangoValidationError, serializers.ValidationError):
+                return None
+            validated_data[spec.name] = value
+        return validated_data
+
+
+class SignupSerializer(FastValidationMixin, serializers.Serializer):
     """
     Don't require email to be unique so visitor can signup multiple times,
     if misplace verification email.  Handle in view.
@@ -15,32 +115,54 @@ class SignupSerializer(serializers.Serializer):
                                       required=False)
 
 
-class LoginSerializer(serializers.Serializer):
+class LoginSerializer(FastValidationMixin, serializers.Serializer):
     email = serializers.EmailField(max_length=255)
     password = serializers.CharField(max_length=128)
 
 
-class PasswordResetSerializer(serializers.Serializer):
+class PasswordResetSerializer(FastValidationMixin, serializers.Serializer):
     email = serializers.EmailField(max_length=255)
 
 
-class PasswordResetVerifiedSerializer(serializers.Serializer):
+class PasswordResetVerifiedSerializer(FastValidationMixin, serializers.Serializer):
     code = serializers.CharField(max_length=40)
     password = serializers.CharField(max_length=128)
 
 
-class PasswordChangeSerializer(serializers.Serializer):
+class PasswordChangeSerializer(FastValidationMixin, serializers.Serializer):
     password = serializers.CharField(max_length=128)
 
 
-class EmailChangeSerializer(serializers.Serializer):
+class EmailChangeSerializer(FastValidationMixin, serializers.Serializer):
     email = serializers.EmailField(max_length=255)
 
 
-class EmailChangeVerifySerializer(serializers.Serializer):
+class EmailChangeVerifySerializer(FastValidationMixin, serializers.Serializer):
     email = serializers.EmailField(max_length=255)
 
 
+class UserListFilterSerializer(serializers.Serializer):
+    """
+    Query parameters of the staff user list.  Validate a plain dict, since
+    BooleanField reads fields missing from a QueryDict as False.
+    """
+    is_verified = serializers.BooleanField(required=False)
+    is_active = serializers.BooleanField(required=False)
+    joined_after = serializers.DateTimeField(required=False)
+    joined_before = serializers.DateTimeField(required=False)
+    email = serializers.CharField(max_length=255, required=False)
+
+
+class DailyStatsQuerySerializer(serializers.Serializer):
+    days = serializers.IntegerField(min_value=1, max_value=3660, default=30)
+
+
+class DailyStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DailyStats
+        fields = '__all__'
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = get_user_model()
@@ -0,0 +1,98 @@
+"""
+Daily signup funnel statistics.
+
+With AUTH_EMAIL_DAILY_STATS set, the views count signups, verifications,
+password resets, email changes and expired codes, and reap_unverified
+counts the users it deletes, in the DailyStats row of the day.  Counts are
+buffered in process memory like audit events, and added to the rows in one
+UPDATE per day once AUTH_EMAIL_DAILY_STATS_BATCH_SIZE are waiting, at most
+AUTH_EMAIL_DAILY_STATS_MAX_DELAY seconds after a count, and when the worker
+exits, so reports read a row per day instead of scanning the user and code
+tables.
+"""
+from datetime import date
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+
+from authemail.buffers import FlushBuffer
+from authemail.models import DailyStats
+
+
+def _add_counts(day, counts):
+    updates = dict((name, F(name) + n) for name, n in counts.items())
+    if DailyStats.objects.filter(date=day).update(**updates):
+        return
+    try:
+        with transaction.atomic():
+            DailyStats.objects.create(date=day, **counts)
+    except IntegrityError:
+        # Created by another worker meanwhile
+        DailyStats.objects.filter(date=day).update(**updates)
+
+
+def flush_counts(items):
+    """
+    Adds up the (date, counts) items of each day, and adds them to its row.
+    """
+    days = {}
+    for day, counts in items:
+        totals = days.setdefault(day, {})
+        for name, n in counts.items():
+            totals[name] = totals.get(name, 0) + n
+    for day, counts in sorted(days.items()):
+        _add_counts(day, counts)
+
+
+_counts = None
+
+
+def get_count_buffer():
+    global _counts
+    if _counts is None:
+        _counts = FlushBuffer(
+            flush_counts,
+            getattr(settings, 'AUTH_EMAIL_DAILY_STATS_BATCH_SIZE', 100),
+            getattr(settings, 'AUTH_EMAIL_DAILY_STATS_MAX_DELAY', 5))
+    return _counts
+
+
+@receiver(setting_changed)
+def _reset_count_buffer(setting, **kwargs):
+    global _counts
+    if setting.startswith('AUTH_EMAIL_DAILY_STATS') and _counts is not None:
+        _counts.flush()
+        _counts = None
+
+
+def today():
+    """
+    The current date, in the current time zone when USE_TZ is set.
+    """
+    return timezone.localdate() if settings.USE_TZ else date.today()
+
+
+def record(**counts):
+    """
+    Buffers counts for today's row, e.g. record(signups=1).  Does nothing
+    unless AUTH_EMAIL_DAILY_STATS is set.
+    """
+    if not getattr(settings, 'AUTH_EMAIL_DAILY_STATS', False):
+        return
+    get_count_buffer().add((today(), counts))
+
+
+def record_verified(signup_code):
+    """
+    Counts a verified signup, and the time since its code was issued.
+    """
+    seconds = max(0, int((timezone.now() -
+                          signup_code.created_at).total_seconds()))
+    for bucket, most in DailyStats.VERIFY_BUCKETS:
+        if most is None or seconds <= most:
+            break
+    record(signups_verified=1, verify_seconds=seconds, **{bucket: 1})
@@ -0,0 +1,350 @@
+"""
+Storage backends for the signup, password reset and email change codes.
+
+The code managers keep their codes in the store named by the
+AUTH_EMAIL_CODE_STORE setting:
+
+- 'authemail.stores.ModelCodeStore' (the default) keeps them in the code
+  tables.
+- 'authemail.stores.CacheCodeStore' keeps them only in the cache named by
+  AUTH_EMAIL_CODE_CACHE (default 'default'), where they expire on their
+  own.  Codes kept in the cache don't appear in the admin.
+
+With AUTH_EMAIL_CODE_LOOKUP_CACHE naming a cache, the store is wrapped in
+a ReadThroughCodeStore, which answers repeated lookups from that cache.
+
+Stores are handed SHA-256 digests, never the codes themselves.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connections, models, router, transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+
+class BaseCodeStore(object):
+    def issue(self, manager, obj):
+        """
+        Saves the new code obj, replacing the live code of its user.
+        """
+        raise NotImplementedError
+
+    def issue_many(self, manager, objs):
+        raise NotImplementedError
+
+    def get(self, manager, digest):
+        """
+        Returns the code, or raises DoesNotExist.
+        """
+        raise NotImplementedError
+
+    def pop(self, manager, digest):
+        """
+        Returns the code and deletes it, or raises DoesNotExist.  Of
+        concurrent calls for one code, only one returns it.
+        """
+        raise NotImplementedError
+
+    def delete(self, obj, *args, **kwargs):
+        raise NotImplementedError
+
+    def delete_for_user(self, manager, user):
+        raise NotImplementedError
+
+    def user_deleted(self, manager, user):
+        """
+        Called when user has been deleted, to delete its codes.
+        """
+        self.delete_for_user(manager, user)
+
+
+class ModelCodeStore(BaseCodeStore):
+    def issue(self, manager, obj):
+        """
+        On PostgreSQL and SQLite this is a single upsert on the unique user
+        column, so concurrent requests can't leave two codes behind.
+        Elsewhere the user's row is locked while the code is replaced.
+        """
+        using = manager._db or router.db_for_write(manager.model)
+        connection = connections[using]
+
+        if not self._can_upsert(connection):
+            with transaction.atomic(using=using):
+                # Concurrent requests for the user wait here
+                self._lock_users(manager, using, [obj.user_id])
+                manager.using(using).filter(user=obj.user).delete()
+                obj.save(force_insert=True, using=using)
+            return obj
+
+        opts = manager.model._meta
+        qn = connection.ops.quote_name
+        fields = opts.concrete_fields
+        columns = [qn(f.column) for f in fields]
+        params = [f.get_db_prep_save(f.pre_save(obj, True), connection)
+                  for f in fields]
+        user_column = qn(opts.get_field('user').column)
+        updates = [c for c in columns if c != user_column]
+
+        sql = 'INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) ' \
+              'DO UPDATE SET %s' % (
+                  qn(opts.db_table), ', '.join(columns),
+                  ', '.join(['%s'] * len(columns)), user_column,
+                  ', '.join('%s = EXCLUDED.%s' % (c, c) for c in updates))
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        obj._state.adding = False
+        obj._state.db = using
+        return obj
+
+    def _can_upsert(self, connection):
+        if connection.vendor == 'postgresql':
+            return True
+        if connection.vendor == 'sqlite':
+            return connection.Database.sqlite_version_info >= (3, 24)
+        return False
+
+    def _lock_users(self, manager, using, user_pks):
+        user_model = manager.model._meta.get_field('user').remote_field.model
+        list(user_model._default_manager.using(using).select_for_update()
+             .filter(pk__in=user_pks).order_by('pk').values_list('pk'))
+
+    def issue_many(self, manager, objs):
+        """
+        Replaces the codes of the users of objs while their rows are locked,
+        so concurrent requests can't leave two codes behind.
+        """
+        using = manager._db or router.db_for_write(manager.model)
+        # Nothing is caught inside, so joining a caller's transaction
+        # doesn't need a savepoint
+        with transaction.atomic(using=using, savepoint=False):
+            self._lock_users(manager, using, [obj.user_id for obj in objs])
+            manager.using(using).filter(
+                user__in=[obj.user_id for obj in objs]).delete()
+            return manager.using(using).bulk_create(objs)
+
+    def get(self, manager, digest):
+        return manager.get(code=digest)
+
+    def pop(self, manager, digest):
+        obj = manager.select_related('user').get(code=digest)
+        # Only the request whose DELETE removed the row may use the code
+        if not manager.filter(code=digest).delete()[0]:
+            raise manager.model.DoesNotExist()
+        return obj
+
+    def delete(self, obj, *args, **kwargs):
+        return models.Model.delete(obj, *args, **kwargs)
+
+    def delete_for_user(self, manager, user):
+        manager.filter(user=user).delete()
+
+    def user_deleted(self, manager, user):
+        pass    # Deleted with the user by the foreign key's CASCADE
+
+
+class CacheCodeStore(BaseCodeStore):
+    """
+    Keeps each code's fields under a key made from its digest, and the
+    digest of each user's live code under a key made from the user's pk.
+    """
+    @property
+    def cache(self):
+        return caches[getattr(settings, 'AUTH_EMAIL_CODE_CACHE', 'default')]
+
+    def code_key(self, model, digest):
+        return 'authemail:code:%s:%s' % (model._meta.model_name, digest)
+
+    def user_key(self, model, user_pk):
+        return 'authemail:code:%s:user:%s' % (model._meta.model_name, user_pk)
+
+    def get_timeout(self, manager):
+        """
+        Expiring codes outlive their expiry period by a day, since the views
+        judge expiry by date.  Signup codes live as long as unverified users.
+        """
+        if hasattr(manager, 'get_expiry_period'):
+            days = manager.get_expiry_period() + 1
+        else:
+            from authemail.models import UNVERIFIED_MAX_AGE
+            days = getattr(settings, 'AUTH_EMAIL_UNVERIFIED_MAX_AGE',
+                           UNVERIFIED_MAX_AGE)
+        return int(timedelta(days=days).total_seconds())
+
+    def _values(self, obj):
+        obj.created_at = timezone.now()
+        return dict((f.attname, getattr(obj, f.attname))
+                    for f in obj._meta.concrete_fields if f.attname != 'code')
+
+    def issue(self, manager, obj):
+        return self.issue_many(manager, [obj])[0]
+
+    def issue_many(self, manager, objs):
+        model = manager.model
+        user_keys = [self.user_key(model, obj.user_id) for obj in objs]
+        old_digests = self.cache.get_many(user_keys).values()
+        self.cache.delete_many([self.code_key(model, digest)
+                                for digest in old_digests])
+
+        values = {}
+        for obj in objs:
+            values[self.code_key(model, obj.code)] = self._values(obj)
+            values[self.user_key(model, obj.user_id)] = obj.code
+        self.cache.set_many(values, self.get_timeout(manager))
+        for obj in objs:
+            obj._state.adding = False
+        return objs
+
+    def get(self, manager, digest):
+        values = self.cache.get(self.code_key(manager.model, digest))
+        if values is None:
+            raise manager.model.DoesNotExist()
+        return _build_code(manager, digest, values)
+
+    def pop(self, manager, digest):
+        key = self.code_key(manager.model, digest)
+        values = self.cache.get(key)
+        # Only the request that adds the used marker may use the code
+        if values is None or not self.cache.add(key + ':used', True,
+                                                self.get_timeout(manager)):
+            raise manager.model.DoesNotExist()
+        self.cache.delete(key)
+        return _build_code(manager, digest, values)
+
+    def delete(self, obj, *args, **kwargs):
+        self.cache.delete(self.code_key(type(obj), obj.code))
+
+    def delete_for_user(self, manager, user):
+        model = manager.model
+        user_key = self.user_key(model, user.pk)
+        digest = self.cache.get(user_key)
+        keys = [user_key]
+        if digest is not None:
+            keys.append(self.code_key(model, digest))
+        self.cache.delete_many(keys)
+
+
+class ReadThroughCodeStore(BaseCodeStore):
+    """
+    Answers lookups of codes from the cache named by
+    AUTH_EMAIL_CODE_LOOKUP_CACHE, falling back to the wrapped store.  Codes
+    found are cached for AUTH_EMAIL_CODE_LOOKUP_TIMEOUT seconds, and codes
+    not found for AUTH_EMAIL_CODE_MISS_TIMEOUT seconds.
+
+    Issuing, using and deleting codes through the managers updates the
+    cache.  Codes deleted in bulk, e.g. by an admin action, may still be
+    found by get() until their entry times out, but can't be used, since
+    pop() always asks the wrapped store.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def cache(self):
+        return caches[settings.AUTH_EMAIL_CODE_LOOKUP_CACHE]
+
+    def code_key(self, model, digest):
+        return 'authemail:lookup:%s:%s' % (model._meta.model_name, digest)
+
+    def user_key(self, model, user_pk):
+        return 'authemail:lookup:%s:user:%s' % (model._meta.model_name,
+                                                user_pk)
+
+    def forget_users(self, model, user_pks):
+        """
+        Deletes the cached codes of the users.
+        """
+        user_keys = [self.user_key(model, pk) for pk in user_pks]
+        digests = self.cache.get_many(user_keys).values()
+        self.cache.delete_many(
+            user_keys + [self.code_key(model, digest) for digest in digests])
+
+    def remember_missing(self, model, digest):
+        self.cache.set(self.code_key(model, digest), False,
+                       getattr(settings, 'AUTH_EMAIL_CODE_MISS_TIMEOUT', 30))
+
+    def issue(self, manager, obj):
+        self.forget_users(manager.model, [obj.user_id])
+        return self.store.issue(manager, obj)
+
+    def issue_many(self, manager, objs):
+        self.forget_users(manager.model, [obj.user_id for obj in objs])
+        return self.store.issue_many(manager, objs)
+
+    def get(self, manager, digest):
+        model = manager.model
+        values = self.cache.get(self.code_key(model, digest))
+        if values is False:
+            raise model.DoesNotExist()
+        if values is not None:
+            return _build_code(manager, digest, values)
+
+        try:
+            obj = self.store.get(manager, digest)
+        except model.DoesNotExist:
+            self.remember_missing(model, digest)
+            raise
+        values = dict((f.attname, getattr(obj, f.attname))
+                      for f in model._meta.concrete_fields
+                      if f.attname != 'code')
+        self.cache.set_many({
+            self.code_key(model, digest): values,
+            self.user_key(model, obj.user_id): digest,
+        }, getattr(settings, 'AUTH_EMAIL_CODE_LOOKUP_TIMEOUT', 300))
+        return obj
+
+    def pop(self, manager, digest):
+        model = manager.model
+        if self.cache.get(self.code_key(model, digest)) is False:
+            raise model.DoesNotExist()
+        try:
+            obj = self.store.pop(manager, digest)
+        except model.DoesNotExist:
+            self.remember_missing(model, digest)
+            raise
+        self.remember_missing(model, digest)
+        return obj
+
+    def delete(self, obj, *args, **kwargs):
+        digest = obj.code    # Cleared by Model.delete()
+        result = self.store.delete(obj, *args, **kwargs)
+        self.remember_missing(type(obj), digest)
+        return result
+
+    def delete_for_user(self, manager, user):
+        self.forget_users(manager.model, [user.pk])
+        self.store.delete_for_user(manager, user)
+
+    def user_deleted(self, manager, user):
+        self.forget_users(manager.model, [user.pk])
+        self.store.user_deleted(manager, user)
+
+
+def _build_code(manager, digest, values):
+    obj = manager.model(code=digest, **values)
+    obj._state.adding = False
+    return obj
+
+
+_store = None
+
+
+def get_code_store():
+    global _store
+    if _store is None:
+        _store = import_string(getattr(settings, 'AUTH_EMAIL_CODE_STORE',
+                                       'authemail.stores.ModelCodeStore'))()
+        if getattr(settings, 'AUTH_EMAIL_CODE_LOOKUP_CACHE', None):
+            _store = ReadThroughCodeStore(_store)
+    return _store
+
+
+@receiver(setting_changed)
+def _reset_store(setting, **kwargs):
+    global _store
+    if setting in ('AUTH_EMAIL_CODE_STORE', 'AUTH_EMAIL_CODE_LOOKUP_CACHE'):
+        _store = None
@@ -1,16 +1,46 @@
+import csv
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
 import re
-from datetime import timedelta
-
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.apps import apps as django_apps
+from django.conf import settings
 from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, models
+from django.contrib import admin
 from django.contrib.auth import get_user_model
-from django.test.utils import override_settings
+from django.contrib.auth.hashers import check_password, get_hasher, make_password
+from django.contrib.auth.models import Group
+from django.http import HttpResponse, QueryDict
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.authtoken.models import Token
-from rest_framework.test import APITestCase
+from rest_framework.test import APITestCase, APITransactionTestCase
 
-from authemail.models import SignupCode, PasswordResetCode
-from authemail.models import EmailChangeCode
+from authemail import audit, buffers, checks, emailfilter, jobs, metrics, stats, stores
+from authemail.admin import EstimatedCountPaginator
+from authemail.authentication import get_serializer_user_fields
+from authemail import export, hashing, profiling
+from authemail.models import AuditEvent, DailyStats, SignupCode, PasswordResetCode
+from authemail.models import EmailChangeCode, _set_bulk_created_pks
+from authemail.routers import ReplicaPinningMiddleware, ReplicaRouter, primary
+from authemail.routers import request_scope
+from authemail.serializers import LoginSerializer, SignupSerializer, UserSerializer
 
 
 def _get_code_from_email(mail):
@@ -21,6 +51,19 @@ def _get_code_from_email(mail):
     return None
 
 
+def _updated_columns(queries, model):
+    """
+    Lists the columns set by each UPDATE of the table of model in queries.
+    """
+    prefix = 'UPDATE %s SET ' % connection.ops.quote_name(model._meta.db_table)
+    updates = []
+    for query in queries:
+        if query['sql'].startswith(prefix):
+            set_clause = query['sql'][len(prefix):].split(' WHERE ', 1)[0]
+            updates.append(sorted(re.findall(r'"(\w+)" = ', set_clause)))
+    return updates
+
+
 @override_settings(AUTH_EMAIL_VERIFICATION=True)
 class SignupTests(APITestCase):
     def setUp(self):
@@ -412,13 +455,14 @@ class PasswordResetTests(APITestCase):
         self.assertEqual(response.data['detail'], 'Password reset not allowed.')
 
     def test_password_reset_user_verified_code_created_email_sent(self):
-        # Create two past reset codes that aren't used
+        # Create two past reset codes that aren't used; the second replaces the first
         password_reset_code_old1 = PasswordResetCode.objects.create_password_reset_code(
             self.user_verified)
         password_reset_code_old2 = PasswordResetCode.objects.create_password_reset_code(
             self.user_verified)
         count = PasswordResetCode.objects.filter(user=self.user_verified).count()
-        self.assertEqual(count, 2)
+        self.assertEqual(count, 1)
+        self.assertNotEqual(password_reset_code_old1.code, password_reset_code_old2.code)
 
         # Send Password Reset request
         url = reverse('authemail-password-reset')
@@ -470,7 +514,7 @@ class PasswordResetTests(APITestCase):
         password_reset_code = PasswordResetCode.objects.latest('code')
         password_reset_code.created_at += timedelta(days=-(PasswordResetCode.objects.get_expiry_period()+1))
         password_reset_code.save()
-        code_lapsed = password_reset_code.code
+        code_lapsed = _get_code_from_email(mail)
 
         # Confirm password reset code_lapsed can't be used
         url = reverse('authemail-password-reset-verify')
@@ -489,8 +533,7 @@ class PasswordResetTests(APITestCase):
             'email': self.user_verified_email,
         }
         self.client.post(url, payload)
-        password_reset_code = PasswordResetCode.objects.latest('code')
-        code = password_reset_code.code
+        code = _get_code_from_email(mail)
 
         # Send Password Reset Verify request
         url = reverse('authemail-password-reset-verify')
@@ -527,8 +570,7 @@ class PasswordResetTests(APITestCase):
             'email': self.user_verified_email,
         }
         self.client.post(url, payload)
-        password_reset_code = PasswordResetCode.objects.latest('code')
-        code = password_reset_code.code
+        code = _get_code_from_email(mail)
 
         # Send Password Reset Verify request
         url = reverse('authemail-password-reset-verify')
@@ -555,8 +597,7 @@ class PasswordResetTests(APITestCase):
             'email': self.user_verified_email,
         }
         response = self.client.post(url, payload)
-        password_reset_code = PasswordResetCode.objects.latest('code')
-        code_not_used = password_reset_code.code
+        code_not_used = _get_code_from_email(mail)
 
         # Send Password Reset request for used code
         url = reverse('authemail-password-reset')
@@ -564,8 +605,7 @@ class PasswordResetTests(APITestCase):
             'email': self.user_verified_email,
         }
         self.client.post(url, payload)
-        password_reset_code = PasswordResetCode.objects.latest('code')
-        code_used = password_reset_code.code
+        code_used = _get_code_from_email(mail)
 
         # Send Password Reset Verify request
         url = reverse('authemail-password-reset-verify')
@@ -748,13 +788,14 @@ class EmailChangeTests(APITestCase):
         self.assertEqual(mail.outbox[1].subject, 'Confirm New Email Address')
 
     def test_email_change_no_other_user_code_created_and_emails_sent(self):
-        # Create two past change codes that aren't used
+        # Create two past change codes that aren't used; the second replaces the first
         email_change_code_old1 = EmailChangeCode.objects.create_email_change_code(
             self.user_to_change, self.user_not_verified_email)
         email_change_code_old2 = EmailChangeCode.objects.create_email_change_code(
             self.user_to_change, self.user_not_verified_email)
         count = EmailChangeCode.objects.filter(user=self.user_to_change).count()
-        self.assertEqual(count, 2)
+        self.assertEqual(count, 1)
+        self.assertNotEqual(email_change_code_old1.code, email_change_code_old2.code)
 
         # Send Email Change request
         self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
@@ -809,7 +850,7 @@ class EmailChangeTests(APITestCase):
         email_change_code = EmailChangeCode.objects.latest('code')
         email_change_code.created_at += timedelta(days=-(EmailChangeCode.objects.get_expiry_period()+1))
         email_change_code.save()
-        code_lapsed = email_change_code.code
+        code_lapsed = _get_code_from_email(mail)
 
         # Confirm email change code_lapsed can't be used
         url = reverse('authemail-email-change-verify')
@@ -838,7 +879,7 @@ class EmailChangeTests(APITestCase):
         # Confirm email address taken
         url = reverse('authemail-email-change-verify')
         params = {
-            'code': email_change_code,
+            'code': _get_code_from_email(mail),
         }
         response = self.client.get(url, params)
 
@@ -861,7 +902,7 @@ class EmailChangeTests(APITestCase):
         # Confirm user_not_verified deleted, email changed, email change code deleted
         url = reverse('authemail-email-change-verify')
         params = {
-            'code': email_change_code,
+            'code': _get_code_from_email(mail),
         }
         response = self.client.get(url, params)
 
@@ -893,7 +934,7 @@ class EmailChangeTests(APITestCase):
         # Confirm email changed email change code deleted
         url = reverse('authemail-email-change-verify')
         params = {
-            'code': email_change_code,
+            'code': _get_code_from_email(mail),
         }
         response = self.client.get(url, params)
 
@@ -1033,3 +1074,1864 @@ class UserDetailTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.data['id'], 1)
         self.assertEqual(response.data['email'], self.user_me_email)
+
+
+@override_settings(AUTH_EMAIL_VERIFICATION=True,
+                   PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class QueryBudgetTests(APITestCase):
+    def setUp(self):
+        # benchmarks isn't installed with the package, only in the repository
+        try:
+            from benchmarks.querybudget import FlowRunner, load_budgets
+        except ImportError:
+            self.skipTest('benchmarks is not on the path')
+        self.budgets = load_budgets()
+        self.measurements = FlowRunner().run()
+
+    def test_flows_succeed(self):
+        for m in self.measurements:
+            self.assertEqual(m.status_code, m.expected_status, m.step)
+
+    def test_every_step_has_a_budget(self):
+        steps = set(m.step for m in self.measurements)
+        self.assertEqual(steps - set(self.budgets), set())
+
+    def test_query_counts_match_budget(self):
+        # Fewer queries than budgeted fail too, so budgets get lowered
+        for m in self.measurements:
+            self.assertEqual(
+                m.num_queries, self.budgets[m.step],
+                '%s issued %d queries (budget %d):\n%s' % (
+                    m.step, m.num_queries, self.budgets[m.step],
+                    '\n'.join(m.queries)))
+
+
+class SeedCommandTests(APITestCase):
+    def test_seed_users_and_codes(self):
+        call_command('authemail_seed', 250, batch_size=100, unverified=0.2,
+                     inactive=0.1, password_reset_codes=0.5,
+                     email_change_codes=0.5, seed=1, stdout=StringIO())
+
+        users = get_user_model().objects.all()
+        self.assertEqual(users.count(), 250)
+
+        # Every unverified user, and only those, has a signup code
+        unverified = users.filter(is_verified=False)
+        self.assertTrue(0 < unverified.count() < 250)
+        self.assertEqual(SignupCode.objects.count(), unverified.count())
+        self.assertFalse(SignupCode.objects.filter(user__is_verified=True).exists())
+
+        # Inactive users are verified
+        self.assertTrue(users.filter(is_active=False).exists())
+        self.assertFalse(users.filter(is_active=False, is_verified=False).exists())
+
+        self.assertTrue(PasswordResetCode.objects.exists())
+        self.assertTrue(EmailChangeCode.objects.exists())
+        self.assertFalse(PasswordResetCode.objects.filter(user__is_verified=False).exists())
+
+    def test_seeded_user_can_login(self):
+        call_command('authemail_seed', 5, unverified=0, inactive=0,
+                     password='seeded', stdout=StringIO())
+        user = get_user_model().objects.first()
+
+        url = reverse('authemail-login')
+        response = self.client.post(url, {'email': user.email,
+                                          'password': 'seeded'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('token', response.data)
+
+
+@override_settings(AUTH_EMAIL_METRICS_SINK='authemail.metrics.InMemorySink')
+class MetricsTests(APITestCase):
+    def setUp(self):
+        self.sink = metrics.get_sink()
+        self.sink.reset()
+
+        # A staff user who can read the metrics
+        self.user_staff = get_user_model().objects.create_user('staff@mail.com', 'pw')
+        self.user_staff.is_staff = True
+        self.user_staff.save()
+        self.token = Token.objects.create(user=self.user_staff).key
+
+    def signup(self, email):
+        url = reverse('authemail-signup')
+        return self.client.post(url, {'email': email, 'password': 'pw'})
+
+    def test_signup_and_verify_recorded(self):
+        self.signup('visitor@mail.com')
+        url = reverse('authemail-signup-verify')
+        self.client.get(url, {'code': _get_code_from_email(mail)})
+
+        self.assertEqual(self.sink.get_counter(metrics.CODES, kind='signup', event='issued'), 1)
+        self.assertEqual(self.sink.get_counter(metrics.CODES, kind='signup', event='verified'), 1)
+        for stage in ('code_create', 'render', 'send'):
+            histogram = self.sink.get_histogram(metrics.STAGE_SECONDS, stage=stage)
+            self.assertEqual(histogram['count'], 1)
+        histogram = self.sink.get_histogram(metrics.VIEW_SECONDS, view='Signup',
+                                            method='POST', status=201)
+        self.assertEqual(histogram['count'], 1)
+
+    def test_email_send_failure_recorded(self):
+        with mock.patch('authemail.models.EmailMultiAlternatives.send',
+                        side_effect=ConnectionRefusedError):
+            with self.assertRaises(ConnectionRefusedError):
+                self.signup('visitor@mail.com')
+
+        self.assertEqual(self.sink.get_counter(metrics.EMAIL_SEND_FAILURES,
+                                               template='signup_email'), 1)
+
+    def test_metrics_prometheus_text(self):
+        self.signup('visitor@mail.com')
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        response = self.client.get(reverse('authemail-metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode()
+        self.assertIn('authemail_codes_total{event="issued",kind="signup"} 1', body)
+        self.assertIn('authemail_stage_seconds_bucket{stage="send",le="+Inf"} 1', body)
+        self.assertIn('# TYPE authemail_view_seconds histogram', body)
+
+    def test_metrics_staff_only(self):
+        user = get_user_model().objects.create_user('user@mail.com', 'pw')
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        response = self.client.get(reverse('authemail-metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_metrics_disabled(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        with self.settings(AUTH_EMAIL_METRICS_SINK=None):
+            self.assertIsNone(metrics.get_sink())
+            response = self.client.get(reverse('authemail-metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['authemail.profiling.ProfilingMiddleware'])
+class ProfilingTests(APITestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profile_dir)
+        cache.delete(profiling.CACHE_KEY)
+        self.addCleanup(profiling.disable_profiling)
+
+        self.user_email = 'user@mail.com'
+        user = get_user_model().objects.create_user(self.user_email, 'pw')
+        user.is_verified = True
+        user.save()
+
+    def login(self):
+        url = reverse('authemail-login')
+        return self.client.post(url, {'email': self.user_email, 'password': 'pw'})
+
+    def reports(self):
+        return sorted(os.listdir(self.profile_dir))
+
+    def test_profiled_endpoint_writes_report(self):
+        profiling.enable_profiling('authemail-login', rate=1.0)
+        with self.settings(AUTH_EMAIL_PROFILE_DIR=self.profile_dir):
+            response = self.login()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('token', response.data)
+
+        reports = self.reports()
+        self.assertEqual(len(reports), 1)
+        self.assertTrue(reports[0].startswith('authemail-login-'))
+        with open(os.path.join(self.profile_dir, reports[0])) as f:
+            report = f.read()
+        self.assertIn('endpoint: authemail-login', report)
+        self.assertIn('SELECT', report)
+        self.assertIn('function calls', report)
+
+    def test_endpoint_not_profiled(self):
+        profiling.enable_profiling('authemail-signup', rate=1.0)
+        with self.settings(AUTH_EMAIL_PROFILE_DIR=self.profile_dir):
+            self.login()
+
+        self.assertEqual(self.reports(), [])
+
+    def test_disable_at_runtime(self):
+        call_command('authemail_profile', 'enable', 'authemail-login', rate=1.0,
+                     stdout=StringIO(), stderr=StringIO())
+        call_command('authemail_profile', 'disable', 'authemail-login',
+                     stdout=StringIO(), stderr=StringIO())
+        with self.settings(AUTH_EMAIL_PROFILE_DIR=self.profile_dir):
+            self.login()
+
+        self.assertEqual(self.reports(), [])
+
+    def test_local_cache_warning(self):
+        err = StringIO()
+        call_command('authemail_profile', 'list', stdout=StringIO(), stderr=err)
+        self.assertIn('local to each process', err.getvalue())
+
+        err = StringIO()
+        with mock.patch('authemail.management.commands.authemail_profile.'
+                        'cache_is_shared', return_value=True):
+            call_command('authemail_profile', 'list', stdout=StringIO(),
+                         stderr=err)
+        self.assertEqual(err.getvalue(), '')
+
+    def test_report_lists_queries_with_params(self):
+        profiling.enable_profiling('authemail-login', rate=1.0)
+        with self.settings(AUTH_EMAIL_PROFILE_DIR=self.profile_dir), \
+                self.assertNumQueries(5):
+            self.login()
+
+        with open(os.path.join(self.profile_dir, self.reports()[0])) as f:
+            report = f.read()
+        self.assertIn('queries: 5\n', report)
+        self.assertIn(repr(self.user_email), report)
+
+    def test_reports_rotated(self):
+        profiling.enable_profiling('authemail-login', rate=1.0)
+        with self.settings(AUTH_EMAIL_PROFILE_DIR=self.profile_dir,
+                           AUTH_EMAIL_PROFILE_MAX_FILES=2):
+            for i in range(3):
+                self.login()
+
+        self.assertEqual(len(self.reports()), 2)
+
+
+class AdminTests(APITestCase):
+    def setUp(self):
+        self.superuser = get_user_model().objects.create_superuser('admin@mail.com', 'pw')
+        self.client.force_login(self.superuser)
+
+        opts = get_user_model()._meta
+        self.changelist_url = reverse('admin:%s_%s_changelist' % (opts.app_label, opts.model_name))
+        self.change_url_name = 'admin:%s_%s_change' % (opts.app_label, opts.model_name)
+
+    def test_search_by_email_prefix(self):
+        get_user_model().objects.create_user('alice@mail.com', 'pw')
+        get_user_model().objects.create_user('bob@alice.com', 'pw')
+
+        response = self.client.get(self.changelist_url, {'q': 'alice'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        emails = [u.email for u in response.context['cl'].result_list]
+        self.assertEqual(emails, ['alice@mail.com'])
+
+    def test_count_stops_at_limit(self):
+        for i in range(5):
+            get_user_model().objects.create_user('user%d@mail.com' % i, 'pw')
+
+        paginator = EstimatedCountPaginator(get_user_model().objects.order_by('pk'), 2)
+        paginator.count_limit = 3
+        self.assertEqual(paginator.count, 3)
+
+        paginator = EstimatedCountPaginator(get_user_model().objects.order_by('pk'), 2)
+        self.assertEqual(paginator.count, 6)
+
+    def test_pages_past_count_limit(self):
+        for i in range(5):
+            get_user_model().objects.create_user('user%d@mail.com' % i, 'pw')
+
+        paginator = EstimatedCountPaginator(get_user_model().objects.order_by('pk'), 2)
+        paginator.count_limit = 3
+        self.assertEqual(paginator.num_pages, 2)
+        self.assertEqual(len(paginator.page(3)), 2)
+        self.assertEqual(paginator.num_pages, 4)
+        self.assertEqual(len(paginator.page(4)), 0)
+
+        model_admin = admin.site._registry[get_user_model()]
+        with mock.patch.object(EstimatedCountPaginator, 'count_limit', 2), \
+                mock.patch.object(model_admin, 'list_per_page', 1):
+            response = self.client.get(self.changelist_url, {'p': 4})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+
+    def test_code_changelist_selects_user(self):
+        for i in range(3):
+            user = get_user_model().objects.create_user('user%d@mail.com' % i, 'pw')
+            PasswordResetCode.objects.create_password_reset_code(user)
+
+        url = reverse('admin:authemail_passwordresetcode_changelist')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.context['cl'].result_list), 3)
+        user_queries = [q for q in ctx.captured_queries
+                        if q['sql'].startswith('SELECT') and
+                        get_user_model()._meta.db_table in q['sql'] and
+                        'authemail_passwordresetcode' not in q['sql']]
+        # Only the session user is fetched on its own
+        self.assertEqual(len(user_queries), 1)
+
+    def test_code_inline_shows_live_code(self):
+        user = get_user_model().objects.create_user('user@mail.com', 'pw')
+        for i in range(3):
+            password_reset_code = PasswordResetCode.objects.create_password_reset_code(user)
+
+        response = self.client.get(reverse(self.change_url_name, args=[user.pk]))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        formsets = [f.formset for f in response.context['inline_admin_formsets']
+                    if f.formset.model is PasswordResetCode]
+        self.assertEqual(len(formsets[0].forms), 1)
+        self.assertEqual(formsets[0].forms[0].instance.code, password_reset_code.code)
+
+
+class AdminBulkActionTests(APITestCase):
+    def setUp(self):
+        self.superuser = get_user_model().objects.create_superuser('admin@mail.com', 'pw')
+        self.client.force_login(self.superuser)
+        opts = get_user_model()._meta
+        self.url_prefix = 'admin:%s_%s_' % (opts.app_label, opts.model_name)
+
+        self.users = [get_user_model().objects.create_user('user%d@mail.com' % i, 'pw')
+                      for i in range(5)]
+        for user in self.users:
+            SignupCode.objects.create_signup_code(user, '127.0.0.1')
+            Token.objects.create(user=user)
+
+    def post_action(self, action, users, url=None):
+        url = url or reverse(self.url_prefix + 'changelist')
+        return self.client.post(url, {
+            'action': action,
+            '_selected_action': [u.pk for u in users],
+        }, follow=True)
+
+    def test_mark_verified(self):
+        response = self.post_action('mark_verified', self.users[:3])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_user_model().objects.filter(is_verified=True).count(), 1+3)
+        self.assertEqual(SignupCode.objects.count(), 2)
+
+    def test_revoke_tokens_and_purge_codes(self):
+        PasswordResetCode.objects.create_password_reset_code(self.users[0])
+
+        self.post_action('revoke_tokens', self.users[:2])
+        self.post_action('purge_user_codes', self.users[:2])
+
+        self.assertEqual(Token.objects.count(), 3)
+        self.assertEqual(SignupCode.objects.count(), 3)
+        self.assertEqual(PasswordResetCode.objects.count(), 0)
+
+    def test_resend_verification(self):
+        old_codes = set(SignupCode.objects.values_list('code', flat=True))
+
+        self.post_action('resend_verification', self.users[:2])
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].subject, 'Verify your email address')
+        self.assertEqual(SignupCode.objects.count(), 5)
+        new_codes = set(SignupCode.objects.values_list('code', flat=True)) - old_codes
+        self.assertEqual(len(new_codes), 2)
+        self.assertIn(SignupCode.objects.get_by_code(_get_code_from_email(mail)).code,
+                      new_codes)
+
+    def test_purge_expired_codes(self):
+        for user in self.users[:2]:
+            PasswordResetCode.objects.create_password_reset_code(user)
+        expired = PasswordResetCode.objects.latest('created_at')
+        expired.created_at += timedelta(days=-(PasswordResetCode.objects.get_expiry_period()+1))
+        expired.save()
+
+        url = reverse('admin:authemail_passwordresetcode_changelist')
+        self.client.post(url, {
+            'action': 'purge_expired_codes',
+            '_selected_action': list(PasswordResetCode.objects.values_list('pk', flat=True)),
+        })
+
+        self.assertEqual(PasswordResetCode.objects.count(), 1)
+        self.assertFalse(PasswordResetCode.objects.filter(pk=expired.pk).exists())
+
+    @override_settings(AUTH_EMAIL_ADMIN_BACKGROUND_THRESHOLD=2)
+    def test_large_selection_runs_in_background(self):
+        with mock.patch('authemail.jobs._start_thread', side_effect=jobs.run_job) as start_thread:
+            response = self.post_action('mark_verified', self.users)
+
+        self.assertEqual(start_thread.call_count, 1)
+        self.assertEqual(get_user_model().objects.filter(is_verified=True).count(), 1+5)
+
+        job_id = start_thread.call_args[0][0]
+        job_url = reverse(self.url_prefix + 'job', args=[job_id])
+        self.assertContains(response, job_url)
+
+        response = self.client.get(job_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        job = response.json()
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(job['total'], 5)
+        self.assertEqual(job['processed'], 5)
+        self.assertEqual(job['affected'], 5)
+
+    @override_settings(AUTH_EMAIL_ADMIN_BACKGROUND_THRESHOLD=2)
+    def test_background_job_warns_of_local_cache(self):
+        with mock.patch('authemail.jobs._start_thread'):
+            response = self.post_action('mark_verified', self.users)
+
+        self.assertContains(response, 'local to this process')
+
+    @override_settings(AUTH_EMAIL_JOB_STALE_AFTER=60)
+    def test_job_stale_without_heartbeat(self):
+        with mock.patch('authemail.jobs._start_thread'):
+            job_id = jobs.start_job('Mark verified', len, get_user_model().objects.all())
+
+        self.assertEqual(jobs.get_job(job_id)['state'], 'pending')
+        with mock.patch('authemail.jobs.time.time', return_value=jobs.time.time() + 61):
+            job = jobs.get_job(job_id)
+        self.assertEqual(job['state'], 'stale')
+        self.assertIn('error', job)
+
+
+class ExportTests(APITestCase):
+    def setUp(self):
+        for i in range(5):
+            user = get_user_model().objects.create_user('user%d@mail.com' % i, 'pw',
+                                                        first_name='First%d' % i)
+            user.is_verified = i % 2 == 0
+            user.save()
+
+    def test_export_csv_command(self):
+        out = StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('authemail_export_users', chunk_size=2, stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'email,first_name,last_name,is_verified,is_active,date_joined')
+        self.assertEqual(len(lines), 1+5)
+        self.assertTrue(lines[1].startswith('user0@mail.com,First0,,True,True,'))
+
+        # One query per chunk, plus the empty one that ends the export
+        self.assertEqual(len(ctx.captured_queries), 3+1)
+
+    def test_export_csv_escapes_formulas(self):
+        get_user_model().objects.filter(email='user0@mail.com').update(
+            first_name='=HYPERLINK("http://x")', last_name='-1+2')
+        get_user_model().objects.filter(email='user1@mail.com').update(
+            first_name='@SUM(A1)', last_name='+1')
+        rows = list(csv.reader(export.export_users(fields=(
+            'email', 'first_name', 'last_name'))))
+
+        self.assertEqual(rows[1], ['user0@mail.com', '\'=HYPERLINK("http://x")',
+                                   "'-1+2"])
+        self.assertEqual(rows[2], ['user1@mail.com', "'@SUM(A1)", "'+1"])
+        self.assertEqual(rows[3], ['user2@mail.com', 'First2', ''])
+
+    def test_export_ndjson_command(self):
+        out = StringIO()
+        call_command('authemail_export_users', format='ndjson',
+                     fields='email,is_verified', stdout=out)
+
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(rows[1], {'email': 'user1@mail.com', 'is_verified': False})
+
+    def test_export_admin_action_streams(self):
+        superuser = get_user_model().objects.create_superuser('admin@mail.com', 'pw')
+        self.client.force_login(superuser)
+        opts = get_user_model()._meta
+        url = reverse('admin:%s_%s_changelist' % (opts.app_label, opts.model_name))
+        users = get_user_model().objects.filter(is_verified=False)
+
+        response = self.client.post(url, {
+            'action': 'export_users_csv',
+            '_selected_action': [u.pk for u in users],
+        })
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1+2)
+
+
+@override_settings(AUTH_EMAIL_VERIFICATION=True)
+class BulkImportTests(APITestCase):
+    def setUp(self):
+        self.user_existing = get_user_model().objects.create_user('existing@mail.com', 'pw')
+
+    def test_bulk_create_users(self):
+        rows = [
+            {'email': 'new1@mail.com', 'password': 'pw1', 'first_name': 'New'},
+            {'email': 'new2@mail.com', 'password': 'pw2'},
+            {'email': 'invited@mail.com'},
+            {'email': 'existing@mail.com', 'password': 'pw'},
+            {'email': 'new1@mail.com', 'password': 'again'},
+        ]
+        with CaptureQueriesContext(connection) as ctx:
+            created, skipped = get_user_model().objects.bulk_create_users(rows, batch_size=10)
+
+        self.assertEqual(created, 3)
+        self.assertEqual(sorted(skipped), ['existing@mail.com', 'new1@mail.com'])
+        # Lookups, user locks and bulk inserts of users and codes,
+        # independent of row count
+        self.assertLessEqual(len(ctx.captured_queries), 11)
+
+        user = get_user_model().objects.get(email='new1@mail.com')
+        self.assertTrue(user.check_password('pw1'))
+        self.assertEqual(user.first_name, 'New')
+        self.assertFalse(user.is_verified)
+        self.assertTrue(SignupCode.objects.filter(user=user).exists())
+
+        invited = get_user_model().objects.get(email='invited@mail.com')
+        self.assertFalse(invited.has_usable_password())
+        self.assertTrue(invited.is_verified)
+        self.assertTrue(PasswordResetCode.objects.filter(user=invited).exists())
+
+        subjects = sorted(m.subject for m in mail.outbox)
+        self.assertEqual(subjects, ['Reset Your Password', 'Verify your email address',
+                                    'Verify your email address'])
+
+    def test_set_bulk_created_pks_with_django_22_feature_name(self):
+        users = [get_user_model()(email='existing@mail.com')]
+        features = mock.Mock(spec=['can_return_ids_from_bulk_insert'],
+                             can_return_ids_from_bulk_insert=False)
+        connections = {'default': mock.Mock(features=features)}
+        with mock.patch('authemail.models.connections', connections):
+            _set_bulk_created_pks(get_user_model(), users, 'default')
+            self.assertEqual(users[0].pk, self.user_existing.pk)
+
+            users[0].pk = None
+            features.can_return_ids_from_bulk_insert = True
+            _set_bulk_created_pks(get_user_model(), users, 'default')
+            self.assertIsNone(users[0].pk)
+
+    def test_import_command_with_hash_workers(self):
+        csv_file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        self.addCleanup(os.remove, csv_file.name)
+        with csv_file:
+            csv_file.write('email,password,first_name,last_name\n')
+            for i in range(5):
+                csv_file.write('import%d@mail.com,pw%d,First,Last\n' % (i, i))
+
+        out = StringIO()
+        call_command('authemail_import_users', csv_file.name, batch_size=2,
+                     hash_workers=2, send_emails=False, stdout=out)
+
+        self.assertIn('Created 5 users', out.getvalue())
+        self.assertEqual(len(mail.outbox), 0)
+        user = get_user_model().objects.get(email='import3@mail.com')
+        self.assertTrue(user.check_password('pw3'))
+        self.assertEqual(SignupCode.objects.count(), 5)
+
+    def test_hash_password_in_spawned_worker(self):
+        # Spawned workers have no Django settings
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            encoded = executor.submit(hashing.hash_password, get_hasher(), 'pw').result()
+
+        self.assertTrue(check_password('pw', encoded))
+
+    def test_email_taken_during_import_skipped(self):
+        def make_password_taking_email(password):
+            if not get_user_model().objects.filter(email='import1@mail.com').exists():
+                get_user_model().objects.create_user('import1@mail.com', 'other')
+            return make_password(password)
+
+        rows = [{'email': 'import%d@mail.com' % i, 'password': 'pw'} for i in range(3)]
+        with mock.patch('authemail.models.make_password', side_effect=make_password_taking_email):
+            created, skipped = get_user_model().objects.bulk_create_users(
+                rows, send_emails=False)
+
+        self.assertEqual(created, 2)
+        self.assertEqual(skipped, ['import1@mail.com'])
+        self.assertTrue(get_user_model().objects.get(email='import1@mail.com').check_password('other'))
+        self.assertEqual(SignupCode.objects.count(), 2)
+        self.assertFalse(SignupCode.objects.filter(user__email='import1@mail.com').exists())
+
+
+class ReapUnverifiedTests(APITestCase):
+    def setUp(self):
+        old = timezone.now() - timedelta(days=31)
+
+        self.stale = []
+        for i in range(3):
+            user = get_user_model().objects.create_user('stale%d@mail.com' % i, 'pw')
+            user.date_joined = old
+            user.save()
+            SignupCode.objects.create_signup_code(user, '127.0.0.1')
+            Token.objects.create(user=user)
+            self.stale.append(user)
+
+        # Recent signups, old verified users and old staff are kept
+        self.recent = get_user_model().objects.create_user('recent@mail.com', 'pw')
+        self.verified = get_user_model().objects.create_user('verified@mail.com', 'pw')
+        self.verified.is_verified = True
+        self.verified.date_joined = old
+        self.verified.save()
+        self.staff = get_user_model().objects.create_user('staff@mail.com', 'pw')
+        self.staff.is_staff = True
+        self.staff.date_joined = old
+        self.staff.save()
+
+    def test_reap_unverified(self):
+        deleted = get_user_model().objects.reap_unverified(batch_size=2)
+
+        self.assertEqual(deleted, 3)
+        self.assertEqual(sorted(get_user_model().objects.values_list('email', flat=True)),
+                         ['recent@mail.com', 'staff@mail.com', 'verified@mail.com'])
+        self.assertEqual(SignupCode.objects.count(), 0)
+        self.assertEqual(Token.objects.count(), 0)
+
+    def test_reap_command(self):
+        out = StringIO()
+        call_command('authemail_reap_unverified', dry_run=True, stdout=out)
+        self.assertIn('3 unverified users would be deleted', out.getvalue())
+        self.assertEqual(get_user_model().objects.count(), 6)
+
+        out = StringIO()
+        call_command('authemail_reap_unverified', days=40, stdout=out)
+        self.assertIn('Deleted 0 unverified users', out.getvalue())
+
+        out = StringIO()
+        call_command('authemail_reap_unverified', stdout=out)
+        self.assertIn('Deleted 3 unverified users', out.getvalue())
+
+
+class CodeIssueTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@mail.com', 'pw')
+
+    def test_issue_code_replaces_live_code(self):
+        old = SignupCode.objects.create_signup_code(self.user, '127.0.0.1')
+
+        with CaptureQueriesContext(connection) as ctx:
+            new = SignupCode.objects.create_signup_code(self.user, '10.0.0.1')
+
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertNotEqual(new.code, old.code)
+        signup_code = SignupCode.objects.get(user=self.user)
+        self.assertEqual(signup_code.code, new.code)
+        self.assertEqual(signup_code.ipaddr, '10.0.0.1')
+        self.assertFalse(SignupCode.objects.filter(code=old.code).exists())
+
+    def test_only_digest_stored(self):
+        signup_code = SignupCode.objects.create_signup_code(self.user, '127.0.0.1')
+        signup_code.send_signup_email()
+
+        self.assertEqual(_get_code_from_email(mail), signup_code.raw_code)
+        self.assertEqual(len(signup_code.code), 64)
+        self.assertFalse(SignupCode.objects.filter(code=signup_code.raw_code).exists())
+        self.assertEqual(SignupCode.objects.get_by_code(signup_code.raw_code).pk,
+                         signup_code.code)
+        with self.assertRaises(SignupCode.DoesNotExist):
+            SignupCode.objects.get_by_code(signup_code.code)
+
+    def test_issue_code_per_purpose(self):
+        PasswordResetCode.objects.create_password_reset_code(self.user)
+        email_change_code = EmailChangeCode.objects.create_email_change_code(
+            self.user, 'new@mail.com')
+        email_change_code = EmailChangeCode.objects.create_email_change_code(
+            self.user, 'newer@mail.com')
+
+        self.assertEqual(PasswordResetCode.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(EmailChangeCode.objects.get(user=self.user).email,
+                         'newer@mail.com')
+        self.assertFalse(email_change_code._state.adding)
+
+    def test_issue_code_without_upsert(self):
+        old = PasswordResetCode.objects.create_password_reset_code(self.user)
+
+        with mock.patch.object(stores.ModelCodeStore, '_can_upsert',
+                               return_value=False), \
+                CaptureQueriesContext(connection) as ctx:
+            new = PasswordResetCode.objects.create_password_reset_code(self.user)
+
+        self.assertEqual(PasswordResetCode.objects.get(user=self.user).code, new.code)
+        self.assertNotEqual(new.code, old.code)
+        # The user's row is locked first
+        self.assertIn(get_user_model()._meta.db_table, ctx.captured_queries[1]['sql'])
+
+
+    def test_issue_codes_locks_users(self):
+        other = get_user_model().objects.create_user('other@mail.com', 'pw')
+        old = PasswordResetCode.objects.create_password_reset_code(self.user)
+
+        with CaptureQueriesContext(connection) as ctx:
+            new = PasswordResetCode.objects.issue_codes([self.user, other])
+
+        self.assertEqual(PasswordResetCode.objects.count(), 2)
+        self.assertFalse(PasswordResetCode.objects.filter(code=old.code).exists())
+        self.assertEqual(PasswordResetCode.objects.get(user=self.user).code,
+                         new[0].code)
+        # The users' rows are locked before their codes are replaced
+        self.assertIn(get_user_model()._meta.db_table, ctx.captured_queries[0]['sql'])
+        self.assertEqual(len(ctx.captured_queries), 3)
+
+    def test_hash_codes_migration(self):
+        migration = importlib.import_module('authemail.migrations.0005_hash_codes')
+        plain = ['%040x' % n for n in range(5)]
+        users = [get_user_model().objects.create_user('user%d@mail.com' % n, 'pw')
+                 for n in range(5)]
+        SignupCode.objects.bulk_create([
+            SignupCode(user=user, code=code, ipaddr='127.0.0.1')
+            for user, code in zip(users, plain)])
+        hashed = SignupCode.objects.create_signup_code(self.user, '127.0.0.1')
+
+        with mock.patch.object(migration, 'BATCH_SIZE', 4), \
+                CaptureQueriesContext(connection) as ctx:
+            migration.hash_codes(django_apps, mock.Mock(connection=connection))
+
+        self.assertEqual(
+            sorted(SignupCode.objects.values_list('code', flat=True)),
+            sorted([hashed.code] + [hashlib.sha256(code.encode()).hexdigest()
+                                    for code in plain]))
+        # One UPDATE per batch of 4 codes with plaintext ones
+        updates = [q for q in ctx.captured_queries
+                   if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+
+@override_settings(AUTH_EMAIL_CODE_STORAGE='binary')
+class BinaryCodeStorageTests(APITransactionTestCase):
+    code_models = (SignupCode, PasswordResetCode, EmailChangeCode)
+
+    def alter_code_columns(self, binary):
+        # The test database was migrated with hex storage
+        for model in self.code_models:
+            with self.settings(AUTH_EMAIL_CODE_STORAGE='hex'):
+                hex_field = model._meta.get_field('code')
+                binary_field = models.BinaryField(max_length=32, primary_key=True)
+                binary_field.set_attributes_from_name('code')
+                binary_field.model = model
+                old, new = ((hex_field, binary_field) if binary
+                            else (binary_field, hex_field))
+                with connection.schema_editor() as editor:
+                    editor.alter_field(model, old, new)
+
+    def setUp(self):
+        self.alter_code_columns(binary=True)
+        self.addCleanup(self.alter_code_columns, binary=False)
+        self.user = get_user_model().objects.create_user('user@mail.com', 'pw')
+
+    def test_check_passes(self):
+        self.assertEqual(checks.check_code_storage(databases=['default']), [])
+
+    @override_settings(AUTH_EMAIL_CODE_STORAGE='hex')
+    def test_check_fails_on_mismatch(self):
+        errors = checks.check_code_storage(databases=['default'])
+
+        self.assertEqual([e.id for e in errors], ['authemail.E001'] * 3)
+
+    def test_code_stored_as_bytes(self):
+        signup_code = SignupCode.objects.create_signup_code(self.user, '127.0.0.1')
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT code FROM %s' % SignupCode._meta.db_table)
+            stored = cursor.fetchone()[0]
+        self.assertEqual(bytes(stored), bytes.fromhex(signup_code.code))
+        self.assertEqual(len(stored), 32)
+        self.assertEqual(SignupCode.objects.get(user=self.user).code,
+                         signup_code.code)
+
+    def test_signup_verify_binary_code(self):
+        signup_code = SignupCode.objects.create_signup_code(self.user, '127.0.0.1')
+
+        url = reverse('authemail-signup-verify')
+        response = self.client.get(url, {'code': signup_code.raw_code})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(SignupCode.objects.exists())
+
+    def test_invalid_code_matches_nothing(self):
+        SignupCode.objects.create_signup_code(self.user, '127.0.0.1')
+
+        url = reverse('authemail-password-reset-verify')
+        response = self.client.get(url, {'code': 'not-hex'})
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(PasswordResetCode.objects.filter(code='').exists())
+
+
+@override_settings(AUTH_EMAIL_REPLICAS=['replica'])
+class ReplicaRouterTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.router.db_for_read(SignupCode), 'replica')
+        self.assertEqual(self.router.db_for_read(get_user_model()), 'replica')
+        self.assertEqual(self.router.db_for_read(Token), 'replica')
+        self.assertIsNone(self.router.db_for_read(Group))
+        with request_scope() as pin:
+            self.assertEqual(self.router.db_for_write(SignupCode), 'default')
+            # Then reads its own writes
+            self.assertEqual(self.router.db_for_read(SignupCode), 'default')
+        self.assertTrue(pin.wrote)
+        self.assertEqual(self.router.db_for_read(SignupCode), 'replica')
+
+    def test_write_outside_request_does_not_pin(self):
+        self.assertEqual(self.router.db_for_write(SignupCode), 'default')
+        self.assertEqual(self.router.db_for_read(SignupCode), 'replica')
+
+    def test_primary(self):
+        with primary():
+            self.assertEqual(self.router.db_for_read(SignupCode), 'default')
+        self.assertEqual(self.router.db_for_read(SignupCode), 'replica')
+
+    def test_pins_per_thread(self):
+        databases = []
+
+        def read():
+            databases.append(self.router.db_for_read(SignupCode))
+
+        with primary():
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(databases, ['replica'])
+
+    @override_settings(AUTH_EMAIL_REPLICAS=[])
+    def test_no_replicas(self):
+        self.assertEqual(self.router.db_for_read(SignupCode), 'default')
+
+    def test_signup_and_verify_views_read_primary(self):
+        databases = []
+
+        def read(*args, **kwargs):
+            databases.append(self.router.db_for_read(get_user_model()))
+            raise get_user_model().DoesNotExist
+
+        def verify_code(code):
+            databases.append(self.router.db_for_read(SignupCode))
+            return None
+
+        with mock.patch.object(SignupCode.objects, 'verify_code',
+                               side_effect=verify_code):
+            self.client.get(reverse('authemail-signup-verify'), {'code': 'XXX'})
+        with mock.patch('authemail.views.emailfilter.may_exist', return_value=True), \
+                mock.patch.object(get_user_model().objects, 'get', side_effect=read), \
+                mock.patch.object(get_user_model().objects, 'create_user',
+                                  side_effect=Exception('stop')):
+            with self.assertRaises(Exception):
+                self.client.post(reverse('authemail-signup'), {
+                    'email': 'new@mail.com', 'password': 'pw',
+                    'first_name': '', 'last_name': ''})
+
+        self.assertEqual(databases, ['default', 'default'])
+
+    def test_middleware_pins_client_after_write(self):
+        factory = RequestFactory()
+        databases = []
+
+        def get_response(request):
+            databases.append(self.router.db_for_read(SignupCode))
+            if request.GET.get('write'):
+                self.router.db_for_write(SignupCode)
+            return HttpResponse()
+        middleware = ReplicaPinningMiddleware(get_response)
+
+        middleware(factory.get('/'))
+        middleware(factory.post('/'))
+        middleware(factory.get('/'))
+        # A verify link writes on a GET
+        middleware(factory.get('/?write=1'))
+        middleware(factory.get('/'))
+        middleware(factory.get('/', REMOTE_ADDR='10.0.0.2'))
+        middleware(factory.get('/', REMOTE_ADDR='10.0.0.2',
+                               HTTP_AUTHORIZATION='Token abc'))
+        middleware(factory.post('/?write=1', REMOTE_ADDR='10.0.0.3',
+                                HTTP_AUTHORIZATION='Token abc'))
+        middleware(factory.get('/', REMOTE_ADDR='10.0.0.2',
+                               HTTP_AUTHORIZATION='Token abc'))
+
+        self.assertEqual(databases, ['replica', 'replica', 'replica', 'replica',
+                                     'default', 'replica', 'replica', 'replica',
+                                     'default'])
+
+
+class NarrowWriteTests(APITestCase):
+    def setUp(self):
+        self.user_model = get_user_model()
+        self.user = self.user_model.objects.create_user('user@mail.com', 'pw')
+        self.user.is_verified = True
+        self.user.save()
+        self.token = Token.objects.create(user=self.user)
+
+    def capture(self, method, url, payload, token=None):
+        if token:
+            self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, payload)
+        self.assertLess(response.status_code, 300, response.data)
+        return _updated_columns(ctx.captured_queries, self.user_model)
+
+    def test_signup_new_user_inserts_only(self):
+        updates = self.capture('post', reverse('authemail-signup'), {
+            'email': 'new@mail.com', 'password': 'pw', 'first_name': 'A',
+            'last_name': 'B'})
+
+        self.assertEqual(updates, [])
+        user = self.user_model.objects.get(email='new@mail.com')
+        self.assertTrue(user.check_password('pw'))
+        self.assertEqual(user.first_name, 'A')
+
+    def test_signup_again_and_verify(self):
+        self.user_model.objects.create_user('new@mail.com', 'old')
+        payload = {'email': 'new@mail.com', 'password': 'pw',
+                   'first_name': 'A', 'last_name': 'B'}
+
+        updates = self.capture('post', reverse('authemail-signup'), payload)
+        self.assertEqual(updates, [['first_name', 'last_name', 'password']])
+
+        updates = self.capture('get', reverse('authemail-signup-verify'),
+                               {'code': _get_code_from_email(mail)})
+        self.assertEqual(updates, [['is_verified']])
+
+    @override_settings(AUTH_EMAIL_VERIFICATION=False)
+    def test_signup_without_verification(self):
+        updates = self.capture('post', reverse('authemail-signup'), {
+            'email': 'new@mail.com', 'password': 'pw', 'first_name': '',
+            'last_name': ''})
+
+        self.assertEqual(updates, [['is_verified']])
+        self.assertTrue(self.user_model.objects.get(email='new@mail.com').is_verified)
+
+    def test_password_reset_verified(self):
+        self.client.post(reverse('authemail-password-reset'),
+                         {'email': self.user.email})
+
+        updates = self.capture('post', reverse('authemail-password-reset-verified'),
+                               {'code': _get_code_from_email(mail),
+                                'password': 'new'})
+
+        self.assertEqual(updates, [['password']])
+
+    def test_email_change_verify(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.client.post(reverse('authemail-email-change'), {'email': 'new@mail.com'})
+
+        updates = self.capture('get', reverse('authemail-email-change-verify'),
+                               {'code': _get_code_from_email(mail)})
+
+        self.assertEqual(updates, [['email']])
+
+    def test_password_change(self):
+        updates = self.capture('post', reverse('authemail-password-change'),
+                               {'password': 'new'}, token=self.token)
+
+        self.assertEqual(updates, [['password']])
+
+    def test_example_user_me_change(self):
+        updates = self.capture('post', '/api/accounts/users/me/change/',
+                               {'first_name': 'A'}, token=self.token)
+
+        self.assertEqual(updates, [['first_name']])
+
+
+class FlushBufferTests(APITestCase):
+    def test_flush_by_size(self):
+        batches = []
+        buffer = buffers.FlushBuffer(batches.append, max_size=3, max_delay=60)
+        for i in range(7):
+            buffer.add(i)
+
+        self.assertEqual(batches, [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual(len(buffer), 1)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(batches[-1], [6])
+        self.assertEqual(buffer.flush(), 0)
+        self.assertIsNone(buffer.timer)
+
+    def test_flush_by_delay(self):
+        flushed = threading.Event()
+        batches = []
+
+        def flush(items):
+            batches.append(items)
+            flushed.set()
+        buffer = buffers.FlushBuffer(flush, max_size=100, max_delay=0.01)
+        buffer.add('a')
+        buffer.add('b')
+
+        self.assertTrue(flushed.wait(5))
+        self.assertEqual(batches, [['a', 'b']])
+
+    def test_flush_error_is_logged(self):
+        def flush(items):
+            raise ValueError('down')
+        buffer = buffers.FlushBuffer(flush)
+        buffer.add('a')
+
+        with self.assertLogs('authemail.buffers', 'ERROR'):
+            self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(len(buffer), 0)
+
+
+@override_settings(AUTH_EMAIL_DEFER_LAST_LOGIN=True,
+                   AUTH_EMAIL_LAST_LOGIN_MAX_DELAY=60)
+class DeferredLastLoginTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = []
+        for i in range(3):
+            user = get_user_model().objects.create_user('user%d@mail.com' % i, 'pw')
+            user.is_verified = True
+            user.last_login = timezone.now() - timedelta(days=1)
+            user.save()
+            self.users.append(user)
+
+    def tearDown(self):
+        buffers.get_last_login_buffer().flush()
+
+    def login(self, user):
+        return self.client.post(reverse('authemail-login'),
+                                {'email': user.email, 'password': 'pw'})
+
+    def test_last_login_written_in_one_batch(self):
+        before = timezone.now()
+        with CaptureQueriesContext(connection) as ctx:
+            for user in self.users + self.users[:1]:
+                self.assertEqual(self.login(user).status_code, status.HTTP_200_OK)
+
+        self.assertEqual(_updated_columns(ctx.captured_queries, get_user_model()), [])
+        for user in self.users:
+            user.refresh_from_db()
+            self.assertLess(user.last_login, before)
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(buffers.get_last_login_buffer().flush(), 4)
+
+        self.assertEqual(len(ctx.captured_queries), 1)
+        for user in self.users:
+            user.refresh_from_db()
+            self.assertGreaterEqual(user.last_login, before)
+
+    @override_settings(AUTH_EMAIL_LAST_LOGIN_BATCH_SIZE=2)
+    def test_flush_when_full(self):
+        before = timezone.now()
+        self.login(self.users[0])
+        self.login(self.users[1])
+
+        self.assertEqual(len(buffers.get_last_login_buffer()), 0)
+        self.users[1].refresh_from_db()
+        self.assertGreaterEqual(self.users[1].last_login, before)
+
+    def test_logins_of_killed_worker_flushed_by_another(self):
+        before = timezone.now()
+        self.login(self.users[0])
+        worker = buffers.get_last_login_buffer()
+        worker.timer.cancel()
+
+        # Another worker starts with an empty buffer of its own
+        buffers._last_logins = None
+        self.assertEqual(buffers.get_last_login_buffer().flush(), 1)
+        self.users[0].refresh_from_db()
+        self.assertGreaterEqual(self.users[0].last_login, before)
+        self.assertEqual(worker.flush(), 0)
+
+    @override_settings(AUTH_EMAIL_DEFER_LAST_LOGIN=False)
+    def test_not_deferred(self):
+        self.login(self.users[0])
+
+        self.assertEqual(len(buffers.get_last_login_buffer()), 0)
+
+
+@override_settings(AUTH_EMAIL_AUDIT_LOG=True, AUTH_EMAIL_AUDIT_MAX_DELAY=60)
+class AuditLogTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@mail.com', 'pw')
+        self.user.is_verified = True
+        self.user.save()
+
+    def tearDown(self):
+        audit.get_event_buffer().flush()
+
+    def login(self, password):
+        return self.client.post(reverse('authemail-login'),
+                                {'email': self.user.email, 'password': password})
+
+    def test_events_buffered_and_bulk_inserted(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.login('pw')
+            self.login('wrong')
+            self.client.post(reverse('authemail-login'),
+                             {'email': 'nobody@mail.com', 'password': 'pw'})
+        self.assertFalse(any('authemail_auditevent' in q['sql']
+                             for q in ctx.captured_queries))
+        self.assertFalse(AuditEvent.objects.exists())
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(audit.get_event_buffer().flush(), 3)
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        events = list(AuditEvent.objects.order_by('pk').values_list(
+            'event', 'user_id', 'email', 'ipaddr'))
+        self.assertEqual(events, [
+            (AuditEvent.LOGIN, self.user.pk, self.user.email, '127.0.0.1'),
+            (AuditEvent.LOGIN_FAILED, None, self.user.email, '127.0.0.1'),
+            (AuditEvent.LOGIN_FAILED, None, 'nobody@mail.com', '127.0.0.1'),
+        ])
+
+    def test_flows_recorded(self):
+        self.client.post(reverse('authemail-signup'), {
+            'email': 'new@mail.com', 'password': 'pw', 'first_name': '',
+            'last_name': ''})
+        self.client.get(reverse('authemail-signup-verify'),
+                        {'code': _get_code_from_email(mail)})
+        self.client.post(reverse('authemail-password-reset'),
+                         {'email': self.user.email})
+        self.client.post(reverse('authemail-password-reset-verified'),
+                         {'code': _get_code_from_email(mail), 'password': 'new'})
+        audit.get_event_buffer().flush()
+
+        new_user = get_user_model().objects.get(email='new@mail.com')
+        self.assertEqual(
+            list(AuditEvent.objects.for_user(new_user).values_list('event', flat=True)),
+            [AuditEvent.SIGNUP_VERIFIED, AuditEvent.SIGNUP])
+        self.assertEqual(
+            list(AuditEvent.objects.for_user(self.user).values_list('event', flat=True)),
+            [AuditEvent.PASSWORD_RESET_VERIFIED, AuditEvent.PASSWORD_RESET])
+
+    def test_between(self):
+        now = timezone.now()
+        AuditEvent.objects.bulk_create([
+            AuditEvent(user=self.user, event=AuditEvent.LOGIN,
+                       created_at=now - timedelta(days=i))
+            for i in range(5)])
+
+        events = AuditEvent.objects.between(now - timedelta(days=3),
+                                            now - timedelta(days=1))
+        self.assertEqual([e.created_at for e in events],
+                         [now - timedelta(days=2), now - timedelta(days=3)])
+        self.assertEqual(AuditEvent.objects.for_user(self.user.pk, since=now).count(), 1)
+
+    def test_admin_lists_events_of_deleted_users(self):
+        other = get_user_model().objects.create_user('other@mail.com', 'pw')
+        AuditEvent.objects.create(user=other, email=other.email,
+                                  event=AuditEvent.LOGIN)
+        other.delete()
+        superuser = get_user_model().objects.create_superuser('admin@mail.com', 'pw')
+        self.client.force_login(superuser)
+
+        response = self.client.get(reverse('admin:authemail_auditevent_changelist'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertContains(response, 'other@mail.com')
+
+    @override_settings(AUTH_EMAIL_AUDIT_LOG=False)
+    def test_disabled(self):
+        self.login('pw')
+
+        self.assertEqual(len(audit.get_event_buffer()), 0)
+
+
+@override_settings(AUTH_EMAIL_CODE_STORE='authemail.stores.CacheCodeStore')
+class CacheCodeStoreTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('user@mail.com', 'pw')
+        self.user.is_verified = True
+        self.user.save()
+
+    def code_queries(self, queries):
+        return [q['sql'] for q in queries if 'authemail_' in q['sql']]
+
+    @override_settings(AUTH_EMAIL_VERIFY_REPLAY_TIMEOUT=0)
+    def test_signup_flow_never_touches_code_tables(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('authemail-signup'), {
+                'email': 'new@mail.com', 'password': 'pw', 'first_name': '',
+                'last_name': ''})
+            code = _get_code_from_email(mail)
+            response = self.client.get(reverse('authemail-signup-verify'),
+                                       {'code': code})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.code_queries(ctx.captured_queries), [])
+        self.assertTrue(get_user_model().objects.get(email='new@mail.com').is_verified)
+
+        # The code was used up
+        response = self.client.get(reverse('authemail-signup-verify'), {'code': code})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_password_reset_flow(self):
+        self.client.post(reverse('authemail-password-reset'),
+                         {'email': self.user.email})
+        code = _get_code_from_email(mail)
+
+        response = self.client.get(reverse('authemail-password-reset-verify'),
+                                   {'code': code})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        payload = {'code': code, 'password': 'new'}
+        url = reverse('authemail-password-reset-verified')
+        self.assertEqual(self.client.post(url, payload).status_code,
+                         status.HTTP_200_OK)
+        self.assertEqual(self.client.post(url, payload).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.check_password('new'))
+        self.assertFalse(PasswordResetCode.objects.exists())
+
+    def test_issue_replaces_live_code(self):
+        old = EmailChangeCode.objects.create_email_change_code(self.user, 'a@mail.com')
+        new = EmailChangeCode.objects.create_email_change_code(self.user, 'b@mail.com')
+
+        with self.assertRaises(EmailChangeCode.DoesNotExist):
+            EmailChangeCode.objects.get_by_code(old.raw_code)
+        email_change_code = EmailChangeCode.objects.get_by_code(new.raw_code)
+        self.assertEqual(email_change_code.email, 'b@mail.com')
+        self.assertEqual(email_change_code.user, self.user)
+
+        EmailChangeCode.objects.delete_user_codes(self.user)
+        with self.assertRaises(EmailChangeCode.DoesNotExist):
+            EmailChangeCode.objects.get_by_code(new.raw_code)
+
+    def test_code_used_once_though_still_cached(self):
+        password_reset_code = PasswordResetCode.objects.create_password_reset_code(self.user)
+        store = stores.CacheCodeStore()
+        key = store.code_key(PasswordResetCode, password_reset_code.code)
+        values = store.cache.get(key)
+
+        PasswordResetCode.objects.use_code(password_reset_code.raw_code)
+        # As if a concurrent request read the code before it was deleted
+        store.cache.set(key, values)
+        with self.assertRaises(PasswordResetCode.DoesNotExist):
+            PasswordResetCode.objects.use_code(password_reset_code.raw_code)
+
+    def test_codes_deleted_with_user(self):
+        user = get_user_model().objects.create_user('deleted@mail.com', 'pw')
+        signup_code = SignupCode.objects.create_signup_code(user, '127.0.0.1')
+        password_reset_code = PasswordResetCode.objects.create_password_reset_code(user)
+
+        user.delete()
+
+        with self.assertRaises(SignupCode.DoesNotExist):
+            SignupCode.objects.get_by_code(signup_code.raw_code)
+        store = stores.CacheCodeStore()
+        self.assertIsNone(store.cache.get(store.user_key(PasswordResetCode, user.pk)))
+        response = self.client.get(reverse('authemail-password-reset-verify'),
+                                   {'code': password_reset_code.raw_code})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_codes_of_missing_user_rejected(self):
+        user = get_user_model().objects.create_user('deleted@mail.com', 'pw')
+        signup_code = SignupCode.objects.create_signup_code(user, '127.0.0.1')
+        password_reset_code = PasswordResetCode.objects.create_password_reset_code(user)
+        email_change_code = EmailChangeCode.objects.create_email_change_code(
+            user, 'changed@mail.com')
+
+        # The codes outlive the user, e.g. deleted on another cache
+        with mock.patch.object(stores.CacheCodeStore, 'user_deleted'):
+            user.delete()
+
+        response = self.client.get(reverse('authemail-signup-verify'),
+                                   {'code': signup_code.raw_code})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('authemail-password-reset-verified'),
+                                    {'code': password_reset_code.raw_code,
+                                     'password': 'new'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('authemail-email-change-verify'),
+                                   {'code': email_change_code.raw_code})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_code_expires_in_cache(self):
+        with mock.patch.object(stores.CacheCodeStore, 'get_timeout',
+                               return_value=-1):
+            password_reset_code = PasswordResetCode.objects.create_password_reset_code(
+                self.user)
+
+        with self.assertRaises(PasswordResetCode.DoesNotExist):
+            PasswordResetCode.objects.get_by_code(password_reset_code.raw_code)
+
+    def test_timeouts(self):
+        store = stores.get_code_store()
+        self.assertEqual(store.get_timeout(PasswordResetCode.objects),
+                         (PasswordResetCode.objects.get_expiry_period() + 1) * 86400)
+        self.assertEqual(store.get_timeout(SignupCode.objects), 30 * 86400)
+
+
+@override_settings(AUTH_EMAIL_CODE_LOOKUP_CACHE='default')
+class CodeLookupCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('user@mail.com', 'pw')
+        self.user.is_verified = True
+        self.user.save()
+
+    def get(self, url_name, code):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse(url_name), {'code': code})
+        return response.status_code, len(ctx.captured_queries)
+
+    def test_repeated_lookups_answered_from_cache(self):
+        PasswordResetCode.objects.create_password_reset_code(self.user)
+        code = PasswordResetCode.objects.create_password_reset_code(self.user).raw_code
+
+        self.assertEqual(self.get('authemail-password-reset-verify', code), (200, 1))
+        self.assertEqual(self.get('authemail-password-reset-verify', code), (200, 0))
+        self.assertEqual(self.get('authemail-password-reset-verify', 'bogus'), (400, 1))
+        self.assertEqual(self.get('authemail-password-reset-verify', 'bogus'), (400, 0))
+
+    def test_reissue_invalidates_cached_code(self):
+        old = PasswordResetCode.objects.create_password_reset_code(self.user)
+        self.assertEqual(self.get('authemail-password-reset-verify', old.raw_code), (200, 1))
+
+        PasswordResetCode.objects.create_password_reset_code(self.user)
+
+        self.assertEqual(self.get('authemail-password-reset-verify', old.raw_code), (400, 1))
+
+    @override_settings(AUTH_EMAIL_VERIFY_REPLAY_TIMEOUT=0)
+    def test_used_code_answered_from_cache(self):
+        user = get_user_model().objects.create_user('new@mail.com', 'pw')
+        code = SignupCode.objects.create_signup_code(user, '127.0.0.1').raw_code
+
+        self.assertEqual(self.get('authemail-signup-verify', code)[0], 200)
+        self.assertEqual(self.get('authemail-signup-verify', code), (400, 0))
+
+    def test_expired_code_deleted(self):
+        password_reset_code = PasswordResetCode.objects.create_password_reset_code(self.user)
+        PasswordResetCode.objects.update(
+            created_at=timezone.now() - timedelta(days=PasswordResetCode.objects.get_expiry_period() + 1))
+
+        self.assertEqual(self.get('authemail-password-reset-verify',
+                                  password_reset_code.raw_code), (400, 2))
+        self.assertFalse(PasswordResetCode.objects.exists())
+        self.assertEqual(self.get('authemail-password-reset-verify',
+                                  password_reset_code.raw_code), (400, 0))
+
+
+class VerifyReplayTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('user@mail.com', 'pw')
+
+    def get(self, url_name, code):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse(url_name), {'code': code})
+        return response, len(ctx.captured_queries)
+
+    def test_signup_verify_replayed(self):
+        code = SignupCode.objects.create_signup_code(self.user, '127.0.0.1').raw_code
+
+        first, _ = self.get('authemail-signup-verify', code)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+
+        second, num_queries = self.get('authemail-signup-verify', code)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(num_queries, 0)
+
+    def test_email_change_verify_replayed(self):
+        code = EmailChangeCode.objects.create_email_change_code(
+            self.user, 'new@mail.com').raw_code
+
+        first, _ = self.get('authemail-email-change-verify', code)
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+
+        second, num_queries = self.get('authemail-email-change-verify', code)
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(num_queries, 0)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.email, 'new@mail.com')
+
+    def test_failures_not_replayed(self):
+        response, _ = self.get('authemail-signup-verify', 'bogus')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        code = SignupCode.objects.create_signup_code(self.user, '127.0.0.1').raw_code
+        self.assertEqual(self.get('authemail-email-change-verify', code)[0].status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get('authemail-signup-verify', code)[0].status_code,
+                         status.HTTP_200_OK)
+
+    @override_settings(AUTH_EMAIL_VERIFY_REPLAY_TIMEOUT=0)
+    def test_disabled(self):
+        code = SignupCode.objects.create_signup_code(self.user, '127.0.0.1').raw_code
+
+        self.assertEqual(self.get('authemail-signup-verify', code)[0].status_code,
+                         status.HTTP_200_OK)
+        self.assertEqual(self.get('authemail-signup-verify', code)[0].status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(AUTH_EMAIL_EMAIL_FILTER=True)
+class EmailFilterTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        emailfilter._local = None
+        self.user = get_user_model().objects.create_user('user@mail.com', 'pw')
+        self.user.is_verified = True
+        self.user.save()
+
+    def post(self, url_name, data):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse(url_name), data)
+        return response.status_code, len(ctx.captured_queries)
+
+    def test_bloom_filter(self):
+        bloom = emailfilter.BloomFilter.for_capacity(1000, 0.01)
+        emails = ['user%d@mail.com' % n for n in range(1000)]
+        for email in emails:
+            bloom.add(email)
+
+        self.assertTrue(all(email in bloom for email in emails))
+        self.assertIn('USER1@mail.com', bloom)
+        false_positives = sum('other%d@mail.com' % n in bloom
+                              for n in range(1000))
+        self.assertLess(false_positives, 30)
+
+    def test_missing_filter_looks_up_every_email(self):
+        self.assertTrue(emailfilter.may_exist('unknown@mail.com'))
+        self.assertEqual(self.post('authemail-password-reset',
+                                   {'email': 'unknown@mail.com'})[1], 1)
+
+    def test_unknown_email_skips_lookup(self):
+        call_command('authemail_rebuild_email_filter', stdout=StringIO())
+
+        self.assertEqual(self.post('authemail-password-reset',
+                                   {'email': 'unknown@mail.com'}),
+                         (status.HTTP_400_BAD_REQUEST, 0))
+        self.assertEqual(self.post('authemail-password-reset',
+                                   {'email': 'user@mail.com'})[0],
+                         status.HTTP_201_CREATED)
+
+    def test_signup_of_taken_email(self):
+        emailfilter.rebuild()
+
+        self.assertEqual(self.post('authemail-signup', {
+            'email': 'user@mail.com', 'password': 'pw', 'first_name': '',
+            'last_name': ''})[0], status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post('authemail-signup', {
+            'email': 'new@mail.com', 'password': 'pw', 'first_name': '',
+            'last_name': ''})[0], status.HTTP_201_CREATED)
+        self.assertTrue(emailfilter.may_exist('new@mail.com'))
+
+    def test_signup_of_email_missing_from_filter(self):
+        unverified = get_user_model().objects.create_user('new@mail.com', 'pw')
+        emailfilter.rebuild()
+        # update() sends no post_save signal
+        get_user_model().objects.filter(pk=self.user.pk).update(
+            email='taken@mail.com')
+        self.assertFalse(emailfilter.may_exist('taken@mail.com'))
+
+        self.assertEqual(self.post('authemail-signup', {
+            'email': 'taken@mail.com', 'password': 'pw', 'first_name': '',
+            'last_name': ''})[0], status.HTTP_400_BAD_REQUEST)
+        with mock.patch('authemail.views.emailfilter.may_exist',
+                        return_value=False):
+            self.assertEqual(self.post('authemail-signup', {
+                'email': 'new@mail.com', 'password': 'new', 'first_name': 'N',
+                'last_name': ''})[0], status.HTTP_201_CREATED)
+        unverified.refresh_from_db()
+        self.assertTrue(unverified.check_password('new'))
+        self.assertEqual(unverified.first_name, 'N')
+
+    def test_seeded_users_added(self):
+        emailfilter.rebuild()
+        call_command('authemail_seed', 3, unverified=0, inactive=0,
+                     stdout=StringIO())
+
+        for email in get_user_model().objects.exclude(
+                pk=self.user.pk).values_list('email', flat=True):
+            self.assertTrue(emailfilter.may_exist(email))
+
+    def test_email_change_to_taken_email(self):
+        emailfilter.rebuild()
+        other = get_user_model().objects.create_user('other@mail.com', 'pw')
+        token = Token.objects.create(user=other)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+        self.assertEqual(self.post('authemail-email-change',
+                                   {'email': 'user@mail.com'})[0],
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post('authemail-email-change',
+                                   {'email': 'new@mail.com'})[0],
+                         status.HTTP_201_CREATED)
+
+    def test_saves_by_other_workers_replayed(self):
+        emailfilter.rebuild()
+        self.assertFalse(emailfilter.may_exist('new@mail.com'))
+        worker = emailfilter._local
+
+        # Another worker adds users
+        emailfilter._local = None
+        get_user_model().objects.create_user('new@mail.com', 'pw')
+        get_user_model().objects.bulk_create_users(
+            [{'email': 'imported@mail.com'}], send_emails=False)
+
+        emailfilter._local = worker
+        self.assertTrue(emailfilter.may_exist('new@mail.com'))
+        self.assertTrue(emailfilter.may_exist('imported@mail.com'))
+
+    def test_rebuild_starts_new_generation(self):
+        emailfilter.rebuild()
+        get_user_model().objects.create_user('new@mail.com', 'pw')
+        worker = emailfilter._local
+
+        emailfilter._local = None
+        emailfilter.rebuild()
+
+        emailfilter._local = worker
+        self.assertTrue(emailfilter.may_exist('new@mail.com'))
+        self.assertFalse(emailfilter.may_exist('unknown@mail.com'))
+        self.assertEqual(emailfilter._local.generation, 2)
+
+    def test_evicted_log_looks_up_every_email(self):
+        emailfilter.rebuild()
+        get_user_model().objects.create_user('new@mail.com', 'pw')
+        emailfilter._local = None
+        cache.delete('authemail:emailfilter:1:log:1')
+
+        self.assertTrue(emailfilter.may_exist('unknown@mail.com'))
+
+
+class FastValidationTests(APITestCase):
+    payloads = [
+        {'email': 'user@mail.com', 'password': 'pw'},
+        {'email': ' user@mail.com ', 'password': 'pw', 'first_name': 'Ann'},
+        {'email': 'user@mail.com', 'password': 'pw', 'first_name': ''},
+        {'email': 'user@mail.com', 'password': 'pw', 'first_name': 'x' * 31},
+        {'email': 'user@mail.com', 'password': 'pw', 'last_name': None},
+        {'email': 'user@mail.com', 'password': '   '},
+        {'email': 'user@mail.com', 'password': 'p\x00w'},
+        {'email': 'user@mail.com', 'password': 123},
+        {'email': 'user', 'password': 'pw'},
+        {'email': 'user@mail.com'},
+        {},
+    ]
+
+    def validate(self, serializer_class, data):
+        serializer = serializer_class(data=data)
+        return (serializer.is_valid(), dict(serializer.validated_data),
+                serializer.errors)
+
+    def assert_same_as_drf(self, serializer_class, data):
+        with override_settings(AUTH_EMAIL_FAST_VALIDATION=False):
+            expected = self.validate(serializer_class, data)
+        self.assertEqual(self.validate(serializer_class, data), expected)
+
+    def test_same_results_as_drf(self):
+        for payload in self.payloads:
+            with self.subTest(payload=payload):
+                self.assert_same_as_drf(SignupSerializer, payload)
+                self.assert_same_as_drf(LoginSerializer, payload)
+
+    def test_same_results_as_drf_for_forms(self):
+        for payload in self.payloads:
+            if None in payload.values() or 123 in payload.values():
+                continue
+            form = QueryDict(mutable=True)
+            form.update(payload)
+            with self.subTest(payload=payload):
+                self.assert_same_as_drf(SignupSerializer, form)
+
+    def test_valid_payload_skips_drf_validation(self):
+        with mock.patch.object(SignupSerializer, 'run_validation') as run_validation:
+            serializer = SignupSerializer(data={'email': 'user@mail.com',
+                                                'password': 'pw'})
+            self.assertTrue(serializer.is_valid())
+        run_validation.assert_not_called()
+        self.assertEqual(serializer.validated_data, {
+            'email': 'user@mail.com', 'password': 'pw', 'first_name': '',
+            'last_name': ''})
+
+    def test_custom_validation_uses_drf(self):
+        class CustomSerializer(SignupSerializer):
+            def validate_email(self, value):
+                return value.lower()
+
+        serializer = CustomSerializer(data={'email': 'USER@mail.com',
+                                            'password': 'pw'})
+        self.assertTrue(serializer.is_valid())
+        self.assertEqual(serializer.validated_data['email'], 'user@mail.com')
+
+
+@override_settings(REST_FRAMEWORK={'DEFAULT_AUTHENTICATION_CLASSES': (
+    'authemail.authentication.NarrowTokenAuthentication',)})
+class NarrowTokenAuthenticationTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            'user@mail.com', 'pw', first_name='Ann', last_name='Smith')
+        self.user.is_verified = True
+        self.user.save()
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def get(self, url_name):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse(url_name))
+        return response, [q['sql'] for q in ctx.captured_queries]
+
+    def test_serializer_user_fields(self):
+        self.assertEqual(get_serializer_user_fields(UserSerializer),
+                         ['id', 'email', 'first_name', 'last_name'])
+        self.assertIsNone(get_serializer_user_fields(LoginSerializer))
+        self.assertIsNone(get_serializer_user_fields(None))
+
+    def test_user_me_loads_serializer_fields(self):
+        response, queries = self.get('authemail-me')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['first_name'], 'Ann')
+        self.assertEqual(len(queries), 1)
+        self.assertIn('JOIN', queries[0])
+        self.assertIn('"first_name"', queries[0])
+        # The example project's MyUserSerializer adds date_of_birth
+        self.assertIn('"date_of_birth"', queries[0])
+        self.assertNotIn('"password"', queries[0])
+        self.assertNotIn('"last_login"', queries[0])
+        self.assertNotIn('"created"', queries[0])
+
+    def test_view_user_fields(self):
+        self.user.is_staff = True
+        self.user.save()
+
+        response, queries = self.get('authemail-logout')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('"is_staff"', queries[0])
+        self.assertNotIn('"email"', queries[0])
+
+    def test_full_row_without_user_fields(self):
+        response, queries = self.get('authemail-signup-verify')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('"password"', queries[0])
+
+    def test_email_change_needs_no_extra_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.post(reverse('authemail-email-change'),
+                                        {'email': 'new@mail.com'})
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(ctx.captured_queries), 3)
+        self.assertEqual(mail.outbox[0].to, ['user@mail.com'])
+
+    def test_invalid_and_inactive(self):
+        self.user.is_active = False
+        self.user.save()
+
+        response, queries = self.get('authemail-me')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.data['detail'], 'User inactive or deleted.')
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token bogus')
+        response, queries = self.get('authemail-me')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.data['detail'], 'Invalid token.')
+
+
+class UserListTests(APITestCase):
+    def setUp(self):
+        self.staff = get_user_model().objects.create_user('staff@mail.com', 'pw')
+        self.staff.is_staff = True
+        self.staff.is_verified = True
+        self.staff.save()
+        self.client.force_authenticate(self.staff)
+
+        for n in range(5):
+            get_user_model().objects.create_user('user%d@mail.com' % n, 'pw')
+        get_user_model().objects.filter(email__in=['user1@mail.com',
+                                                   'user3@mail.com']).update(
+            is_verified=True, date_joined=timezone.now() - timedelta(days=10))
+
+    def get(self, url=None, **params):
+        return self.client.get(url or reverse('authemail-users'), params)
+
+    def test_pages_by_id(self):
+        response = self.get(page_size=4)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [user['email'] for user in response.data['results']],
+            ['staff@mail.com', 'user0@mail.com', 'user1@mail.com', 'user2@mail.com'])
+        self.assertEqual(set(response.data['results'][0]),
+                         {'id', 'email', 'first_name', 'last_name'})
+        self.assertIsNone(response.data['previous'])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([user['email'] for user in response.data['results']],
+                         ['user3@mail.com', 'user4@mail.com'])
+        self.assertIsNone(response.data['next'])
+
+    def test_page_is_keyset_query(self):
+        first = self.get(page_size=2)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(first.data['next'])
+
+        sql = ctx.captured_queries[-1]['sql']
+        self.assertIn('"id" > ', sql)
+        self.assertNotIn('OFFSET', sql)
+        self.assertNotIn('COUNT', sql)
+        self.assertNotIn('"password"', sql)
+
+    def test_filters(self):
+        def emails(**params):
+            response = self.get(**params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return [user['email'] for user in response.data['results']]
+
+        self.assertEqual(emails(is_verified='true', email='user'),
+                         ['user1@mail.com', 'user3@mail.com'])
+        self.assertEqual(emails(is_verified='false'),
+                         ['user0@mail.com', 'user2@mail.com', 'user4@mail.com'])
+        self.assertEqual(
+            emails(joined_before=(timezone.now() - timedelta(days=1)).isoformat()),
+            ['user1@mail.com', 'user3@mail.com'])
+        self.assertEqual(
+            len(emails(joined_after=(timezone.now() - timedelta(days=1)).isoformat())), 4)
+        self.assertEqual(emails(email='user4'), ['user4@mail.com'])
+        self.assertEqual(emails(is_active='false'), [])
+
+    def test_invalid_filter(self):
+        response = self.get(is_verified='maybe', joined_after='yesterday')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(set(response.data), {'is_verified', 'joined_after'})
+
+    def test_staff_only(self):
+        self.client.force_authenticate(
+            get_user_model().objects.get(email='user1@mail.com'))
+        self.assertEqual(self.get().status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(None)
+        self.assertEqual(self.get().status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(AUTH_EMAIL_DAILY_STATS=True)
+class DailyStatsTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@mail.com', 'pw')
+        self.user.is_verified = True
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+
+    def tearDown(self):
+        stats.get_count_buffer().flush()
+
+    def test_flows_counted(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('authemail-signup'), {
+                'email': 'new@mail.com', 'password': 'pw', 'first_name': '',
+                'last_name': ''})
+            self.client.get(reverse('authemail-signup-verify'),
+                            {'code': _get_code_from_email(mail)})
+            self.client.post(reverse('authemail-password-reset'),
+                             {'email': self.user.email})
+            self.client.post(reverse('authemail-password-reset-verified'),
+                             {'code': _get_code_from_email(mail), 'password': 'new'})
+        self.assertFalse(any('authemail_dailystats' in q['sql']
+                             for q in ctx.captured_queries))
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(stats.get_count_buffer().flush(), 4)
+        # An UPDATE finding no row for the day, then an INSERT
+        self.assertEqual(len([q for q in ctx.captured_queries
+                              if 'authemail_dailystats' in q['sql']]), 2)
+
+        stats.record(email_changes=1)
+        stats.record(email_changes=1)
+        with CaptureQueriesContext(connection) as ctx:
+            stats.get_count_buffer().flush()
+        self.assertEqual(len(ctx.captured_queries), 1)
+
+        day = DailyStats.objects.get(date=timezone.localdate())
+        self.assertEqual((day.signups, day.signups_verified, day.verified_within_10m,
+                          day.password_resets, day.password_resets_verified,
+                          day.email_changes),
+                         (1, 1, 1, 1, 1, 2))
+
+    def test_counts_added_to_existing_rows(self):
+        today = timezone.localdate()
+        DailyStats.objects.create(date=today, signups=5)
+
+        stats.flush_counts([(today, {'signups': 1}), (today, {'signups': 2}),
+                            (today - timedelta(days=1), {'codes_expired': 1})])
+
+        self.assertEqual(DailyStats.objects.get(date=today).signups, 8)
+        self.assertEqual(DailyStats.objects.get(
+            date=today - timedelta(days=1)).codes_expired, 1)
+
+    def test_expired_and_reaped_counted(self):
+        code = PasswordResetCode.objects.create_password_reset_code(self.user)
+        PasswordResetCode.objects.update(created_at=timezone.now() - timedelta(days=30))
+        self.client.get(reverse('authemail-password-reset-verify'),
+                        {'code': code.raw_code})
+
+        stale = get_user_model().objects.create_user('stale@mail.com', 'pw')
+        get_user_model().objects.filter(pk=stale.pk).update(
+            date_joined=timezone.now() - timedelta(days=60))
+        get_user_model().objects.reap_unverified()
+        stats.get_count_buffer().flush()
+
+        day = DailyStats.objects.get(date=timezone.localdate())
+        self.assertEqual((day.codes_expired, day.users_reaped), (1, 1))
+
+    def test_verify_times(self):
+        now = timezone.now()
+        for minutes in (1, 30, 90):
+            stats.record_verified(SignupCode(created_at=now - timedelta(minutes=minutes)))
+        stats.record_verified(SignupCode(created_at=now - timedelta(days=3)))
+        stats.get_count_buffer().flush()
+
+        day = DailyStats.objects.get()
+        self.assertEqual((day.verified_within_10m, day.verified_within_1h,
+                          day.verified_within_1d, day.verified_later), (1, 1, 1, 1))
+        summary = DailyStats.objects.summary()
+        self.assertEqual(summary['signups_verified'], 4)
+        self.assertEqual(summary['median_verify_bucket'], 'verified_within_1h')
+        self.assertAlmostEqual(summary['mean_verify_seconds'],
+                               (60 + 1800 + 5400 + 3 * 86400) / 4, delta=2)
+
+    def test_median_bucket_later_or_none(self):
+        self.assertIsNone(DailyStats.objects.summary()['median_verify_bucket'])
+
+        stats.record_verified(SignupCode(created_at=timezone.now() - timedelta(days=3)))
+        stats.get_count_buffer().flush()
+
+        self.assertEqual(DailyStats.objects.summary()['median_verify_bucket'],
+                         'verified_later')
+
+    @override_settings(USE_TZ=False)
+    def test_without_time_zones(self):
+        stats.record(signups=1)
+        stats.get_count_buffer().flush()
+        self.client.force_authenticate(self.user)
+
+        response = self.client.get(reverse('authemail-stats'), {'days': 1})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['totals']['signups'], 1)
+        self.assertEqual(response.data['days'][0]['date'], str(date.today()))
+
+    @override_settings(AUTH_EMAIL_DAILY_STATS=False)
+    def test_disabled(self):
+        stats.record(signups=1)
+        self.assertEqual(stats.get_count_buffer().flush(), 0)
+
+    def test_stats_endpoint(self):
+        today = timezone.localdate()
+        DailyStats.objects.bulk_create([
+            DailyStats(date=today - timedelta(days=n), signups=n + 1)
+            for n in range(10)])
+        self.client.force_authenticate(self.user)
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('authemail-stats'), {'days': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(ctx.captured_queries), 2)
+        self.assertEqual(response.data['totals']['signups'], 1 + 2 + 3)
+        self.assertEqual([day['signups'] for day in response.data['days']], [1, 2, 3])
+
+        self.assertEqual(self.client.get(reverse('authemail-stats'),
+                                         {'days': 0}).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+        self.client.force_authenticate(
+            get_user_model().objects.create_user('other@mail.com', 'pw'))
+        self.assertEqual(self.client.get(reverse('authemail-stats')).status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+    def test_admin_shows_totals(self):
+        DailyStats.objects.create(date=timezone.localdate(), signups=7)
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('admin:authemail_dailystats_changelist'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['summary']['signups'], 7)
+        self.assertContains(response, 'daily-stats-summary')
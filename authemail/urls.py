@@ -27,7 +27,11 @@ urlpatterns = [
     path('password/change/', views.PasswordChange.as_view(),
          name='authemail-password-change'),
 
+    path('users/', views.UserList.as_view(), name='authemail-users'),
     path('users/me/', views.UserMe.as_view(), name='authemail-me'),
+
+    path('stats/', views.Stats.as_view(), name='authemail-stats'),
+    path('metrics/', views.Metrics.as_view(), name='authemail-metrics'),
 ]
 
 
@@ -1,27 +1,59 @@
-from datetime import date
+from datetime import date, timedelta
 from ipware import get_client_ip
 
 from django.conf import settings
 from django.contrib.auth import authenticate, get_user_model
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.http import Http404, HttpResponse
 from django.utils.translation import gettext as _
 
-from rest_framework import status
+from rest_framework import generics, status
 from rest_framework.authtoken.models import Token
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.pagination import CursorPagination
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from authemail import audit, emailfilter, metrics, stats
+from authemail.authentication import get_serializer_user_fields
+from authemail.buffers import record_last_login
+from authemail.metrics import ViewMetricsMixin
+from authemail.models import AuditEvent, DailyStats
 from authemail.models import SignupCode, EmailChangeCode, PasswordResetCode
-from authemail.models import send_multi_format_email
+from authemail.models import _hash_code, send_multi_format_email
+from authemail.routers import PrimaryDatabaseMixin
 from authemail.serializers import SignupSerializer, LoginSerializer
 from authemail.serializers import PasswordResetSerializer
 from authemail.serializers import PasswordResetVerifiedSerializer
 from authemail.serializers import EmailChangeSerializer
 from authemail.serializers import PasswordChangeSerializer
-from authemail.serializers import UserSerializer
+from authemail.serializers import DailyStatsQuerySerializer
+from authemail.serializers import DailyStatsSerializer
+from authemail.serializers import UserListFilterSerializer, UserSerializer
 
 
-class Signup(APIView):
+def _replay_key(kind, code):
+    return 'authemail:replay:%s:%s' % (kind, _hash_code(code))
+
+
+def _get_replay(kind, code):
+    """
+    Returns the content of the success response to a code verified in the
+    last AUTH_EMAIL_VERIFY_REPLAY_TIMEOUT seconds, or None.
+    """
+    if not getattr(settings, 'AUTH_EMAIL_VERIFY_REPLAY_TIMEOUT', 300):
+        return None
+    return cache.get(_replay_key(kind, code))
+
+
+def _set_replay(kind, code, content):
+    timeout = getattr(settings, 'AUTH_EMAIL_VERIFY_REPLAY_TIMEOUT', 300)
+    if timeout:
+        cache.set(_replay_key(kind, code), content, timeout)
+
+
+class Signup(ViewMetricsMixin, PrimaryDatabaseMixin, APIView):
     permission_classes = (AllowAny,)
     serializer_class = SignupSerializer
 
@@ -29,39 +61,58 @@ class Signup(APIView):
         serializer = self.serializer_class(data=request.data)
 
         if serializer.is_valid():
-            email = serializer.data['email']
-            password = serializer.data['password']
-            first_name = serializer.data['first_name']
-            last_name = serializer.data['last_name']
+            data = serializer.validated_data
+            email = data['email']
+            password = data['password']
+            first_name = data['first_name']
+            last_name = data['last_name']
 
             must_validate_email = getattr(settings, "AUTH_EMAIL_VERIFICATION", True)
 
-            try:
-                user = get_user_model().objects.get(email=email)
+            update_fields = None
+            if emailfilter.may_exist(email):
+                try:
+                    user = get_user_model().objects.get(email=email)
+                except get_user_model().DoesNotExist:
+                    user = get_user_model().objects.create_user(
+                        email=email, password=password,
+                        first_name=first_name, last_name=last_name)
+                    update_fields = []
+            else:
+                # The filter may not know every email yet, so let the unique
+                # email column decide instead of trusting the negative answer
+                try:
+                    with transaction.atomic():
+                        user = get_user_model().objects.create_user(
+                            email=email, password=password,
+                            first_name=first_name, last_name=last_name)
+                    update_fields = []
+                except IntegrityError:
+                    user = get_user_model().objects.get(email=email)
+
+            if update_fields is None:
                 if user.is_verified:
                     content = {'detail': _('Email address already taken.')}
                     return Response(content, status=status.HTTP_400_BAD_REQUEST)
 
-                try:
-                    # Delete old signup codes
-                    signup_code = SignupCode.objects.get(user=user)
-                    signup_code.delete()
-                except SignupCode.DoesNotExist:
-                    pass
+                if not must_validate_email:
+                    # Delete old signup code; otherwise the new one replaces it
+                    SignupCode.objects.delete_user_codes(user)
 
-            except get_user_model().DoesNotExist:
-                user = get_user_model().objects.create_user(email=email)
+                # Set user fields provided
+                user.set_password(password)
+                user.first_name = first_name
+                user.last_name = last_name
+                update_fields = ['password', 'first_name', 'last_name']
 
-            # Set user fields provided
-            user.set_password(password)
-            user.first_name = first_name
-            user.last_name = last_name
             if not must_validate_email:
                 user.is_verified = True
+                update_fields.append('is_verified')
                 send_multi_format_email('welcome_email',
                                         {'email': user.email, },
                                         target_email=user.email)
-            user.save()
+            if update_fields:
+                user.save(update_fields=update_fields)
 
             if must_validate_email:
                 # Create and associate signup code
@@ -70,6 +121,8 @@ class Signup(APIView):
                     client_ip = '0.0.0.0'    # Unable to get the client's IP address
                 signup_code = SignupCode.objects.create_signup_code(user, client_ip)
                 signup_code.send_signup_email()
+            audit.record(request, AuditEvent.SIGNUP, user)
+            stats.record(signups=1)
 
             content = {'email': email, 'first_name': first_name,
                        'last_name': last_name}
@@ -78,27 +131,32 @@ class Signup(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class SignupVerify(APIView):
+class SignupVerify(ViewMetricsMixin, PrimaryDatabaseMixin, APIView):
     permission_classes = (AllowAny,)
 
     def get(self, request, format=None):
         code = request.GET.get('code', '')
-        verified = SignupCode.objects.set_user_is_verified(code)
 
-        if verified:
-            try:
-                signup_code = SignupCode.objects.get(code=code)
-                signup_code.delete()
-            except SignupCode.DoesNotExist:
-                pass
+        # Repeated clicks on the link get the first click's response
+        content = _get_replay('signup', code)
+        if content is not None:
+            return Response(content, status=status.HTTP_200_OK)
+
+        signup_code = SignupCode.objects.verify_code(code)
+
+        if signup_code:
+            audit.record(request, AuditEvent.SIGNUP_VERIFIED, signup_code.user)
+            metrics.incr(metrics.CODES, kind='signup', event='verified')
+            stats.record_verified(signup_code)
             content = {'success': _('Email address verified.')}
+            _set_replay('signup', code, content)
             return Response(content, status=status.HTTP_200_OK)
         else:
             content = {'detail': _('Unable to verify user.')}
             return Response(content, status=status.HTTP_400_BAD_REQUEST)
 
 
-class Login(APIView):
+class Login(ViewMetricsMixin, APIView):
     permission_classes = (AllowAny,)
     serializer_class = LoginSerializer
 
@@ -106,25 +164,34 @@ class Login(APIView):
         serializer = self.serializer_class(data=request.data)
 
         if serializer.is_valid():
-            email = serializer.data['email']
-            password = serializer.data['password']
-            user = authenticate(email=email, password=password)
+            data = serializer.validated_data
+            email = data['email']
+            password = data['password']
+            with metrics.stage('authenticate'):
+                user = authenticate(email=email, password=password)
 
             if user:
                 if user.is_verified:
                     if user.is_active:
+                        if getattr(settings, 'AUTH_EMAIL_DEFER_LAST_LOGIN',
+                                   False):
+                            record_last_login(user)
                         token, created = Token.objects.get_or_create(user=user)
+                        audit.record(request, AuditEvent.LOGIN, user)
                         return Response({'token': token.key},
                                         status=status.HTTP_200_OK)
                     else:
+                        audit.record(request, AuditEvent.LOGIN_FAILED, user)
                         content = {'detail': _('User account not active.')}
                         return Response(content,
                                         status=status.HTTP_401_UNAUTHORIZED)
                 else:
+                    audit.record(request, AuditEvent.LOGIN_FAILED, user)
                     content = {'detail':
                                _('User account not verified.')}
                     return Response(content, status=status.HTTP_401_UNAUTHORIZED)
             else:
+                audit.record(request, AuditEvent.LOGIN_FAILED, email=email)
                 content = {'detail':
                            _('Unable to login with provided credentials.')}
                 return Response(content, status=status.HTTP_401_UNAUTHORIZED)
@@ -134,8 +201,9 @@ class Login(APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
-class Logout(APIView):
+class Logout(ViewMetricsMixin, APIView):
     permission_classes = (IsAuthenticated,)
+    user_fields = ()
 
     def get(self, request, format=None):
         """
@@ -148,7 +216,7 @@ class Logout(APIView):
         return Response(content, status=status.HTTP_200_OK)
 
 
-class PasswordReset(APIView):
+class PasswordReset(ViewMetricsMixin, APIView):
     permission_classes = (AllowAny,)
     serializer_class = PasswordResetSerializer
 
@@ -156,21 +224,26 @@ class PasswordReset(APIView):
         serializer = self.serializer_class(data=request.data)
 
         if serializer.is_valid():
-            email = serializer.data['email']
+            email = serializer.validated_data['email']
 
             try:
+                if not emailfilter.may_exist(email):
+                    raise get_user_model().DoesNotExist
                 user = get_user_model().objects.get(email=email)
 
-                # Delete all unused password reset codes
-                PasswordResetCode.objects.filter(user=user).delete()
-
                 if user.is_verified and user.is_active:
+                    # Replaces any unused password reset code
                     password_reset_code = \
                         PasswordResetCode.objects.create_password_reset_code(user)
                     password_reset_code.send_password_reset_email()
+                    audit.record(request, AuditEvent.PASSWORD_RESET, user)
+                    stats.record(password_resets=1)
                     content = {'email': email}
                     return Response(content, status=status.HTTP_201_CREATED)
 
+                # Delete all unused password reset codes
+                PasswordResetCode.objects.delete_user_codes(user)
+
             except get_user_model().DoesNotExist:
                 pass
 
@@ -183,19 +256,22 @@ class PasswordReset(APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
-class PasswordResetVerify(APIView):
+class PasswordResetVerify(ViewMetricsMixin, PrimaryDatabaseMixin, APIView):
     permission_classes = (AllowAny,)
 
     def get(self, request, format=None):
         code = request.GET.get('code', '')
 
         try:
-            password_reset_code = PasswordResetCode.objects.get(code=code)
+            password_reset_code = PasswordResetCode.objects.get_by_code(code)
 
             # Delete password reset code if older than expiry period
             delta = date.today() - password_reset_code.created_at.date()
             if delta.days > PasswordResetCode.objects.get_expiry_period():
                 password_reset_code.delete()
+                metrics.incr(metrics.CODES, kind='password_reset',
+                             event='expired')
+                stats.record(codes_expired=1)
                 raise PasswordResetCode.DoesNotExist()
 
             content = {'success': _('Email address verified.')}
@@ -205,7 +281,7 @@ class PasswordResetVerify(APIView):
             return Response(content, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PasswordResetVerified(APIView):
+class PasswordResetVerified(ViewMetricsMixin, PrimaryDatabaseMixin, APIView):
     permission_classes = (AllowAny,)
     serializer_class = PasswordResetVerifiedSerializer
 
@@ -213,16 +289,20 @@ class PasswordResetVerified(APIView):
         serializer = self.serializer_class(data=request.data)
 
         if serializer.is_valid():
-            code = serializer.data['code']
-            password = serializer.data['password']
+            data = serializer.validated_data
+            code = data['code']
+            password = data['password']
 
             try:
-                password_reset_code = PasswordResetCode.objects.get(code=code)
+                # Use up the password reset code
+                password_reset_code = PasswordResetCode.objects.use_code(code)
                 password_reset_code.user.set_password(password)
-                password_reset_code.user.save()
-
-                # Delete password reset code just used
-                password_reset_code.delete()
+                password_reset_code.user.save(update_fields=['password'])
+                audit.record(request, AuditEvent.PASSWORD_RESET_VERIFIED,
+                             password_reset_code.user)
+                metrics.incr(metrics.CODES, kind='password_reset',
+                             event='verified')
+                stats.record(password_resets_verified=1)
 
                 content = {'success': _('Password reset.')}
                 return Response(content, status=status.HTTP_200_OK)
@@ -235,24 +315,26 @@ class PasswordResetVerified(APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
-class EmailChange(APIView):
+class EmailChange(ViewMetricsMixin, APIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = EmailChangeSerializer
+    # For the email to the previous address
+    user_fields = ('email', 'first_name', 'last_name')
 
     def post(self, request, format=None):
         serializer = self.serializer_class(data=request.data)
 
         if serializer.is_valid():
             user = request.user
-
-            # Delete all unused email change codes
-            EmailChangeCode.objects.filter(user=user).delete()
-
-            email_new = serializer.data['email']
+            email_new = serializer.validated_data['email']
 
             try:
+                if not emailfilter.may_exist(email_new):
+                    raise get_user_model().DoesNotExist
                 user_with_email = get_user_model().objects.get(email=email_new)
                 if user_with_email.is_verified:
+                    # Delete all unused email change codes
+                    EmailChangeCode.objects.delete_user_codes(user)
                     content = {'detail': _('Email address already taken.')}
                     return Response(content, status=status.HTTP_400_BAD_REQUEST)
                 else:
@@ -261,9 +343,13 @@ class EmailChange(APIView):
                     raise get_user_model().DoesNotExist
 
             except get_user_model().DoesNotExist:
+                # Replaces any unused email change code
                 email_change_code = EmailChangeCode.objects.create_email_change_code(user, email_new)
 
                 email_change_code.send_email_change_emails()
+                audit.record(request, AuditEvent.EMAIL_CHANGE, user,
+                             email=email_new)
+                stats.record(email_changes=1)
 
                 content = {'email': email_new}
                 return Response(content, status=status.HTTP_201_CREATED)
@@ -273,29 +359,33 @@ class EmailChange(APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
-class EmailChangeVerify(APIView):
+class EmailChangeVerify(ViewMetricsMixin, PrimaryDatabaseMixin, APIView):
     permission_classes = (AllowAny,)
 
     def get(self, request, format=None):
         code = request.GET.get('code', '')
 
+        # Repeated clicks on the link get the first click's response
+        content = _get_replay('email_change', code)
+        if content is not None:
+            return Response(content, status=status.HTTP_200_OK)
+
         try:
-            # Check if the code exists.
-            email_change_code = EmailChangeCode.objects.get(code=code)
+            # Check if the code exists, and use it up.
+            email_change_code = EmailChangeCode.objects.use_code(code)
 
             # Check if the code has expired.
             delta = date.today() - email_change_code.created_at.date()
             if delta.days > EmailChangeCode.objects.get_expiry_period():
-                email_change_code.delete()
+                metrics.incr(metrics.CODES, kind='email_change',
+                             event='expired')
+                stats.record(codes_expired=1)
                 raise EmailChangeCode.DoesNotExist()
 
             # Check if the email address is being used by a verified user.
             try:
                 user_with_email = get_user_model().objects.get(email=email_change_code.email)
                 if user_with_email.is_verified:
-                    # Delete email change code since won't be used
-                    email_change_code.delete()
-
                     content = {'detail': _('Email address already taken.')}
                     return Response(content, status=status.HTTP_400_BAD_REQUEST)
                 else:
@@ -308,21 +398,24 @@ class EmailChangeVerify(APIView):
 
             # If all is well, change the email address.
             email_change_code.user.email = email_change_code.email
-            email_change_code.user.save()
-
-            # Delete email change code just used
-            email_change_code.delete()
+            email_change_code.user.save(update_fields=['email'])
+            audit.record(request, AuditEvent.EMAIL_CHANGE_VERIFIED,
+                         email_change_code.user)
+            metrics.incr(metrics.CODES, kind='email_change', event='verified')
+            stats.record(email_changes_verified=1)
 
             content = {'success': _('Email address changed.')}
+            _set_replay('email_change', code, content)
             return Response(content, status=status.HTTP_200_OK)
         except EmailChangeCode.DoesNotExist:
             content = {'detail': _('Unable to verify user.')}
             return Response(content, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PasswordChange(APIView):
+class PasswordChange(ViewMetricsMixin, APIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = PasswordChangeSerializer
+    user_fields = ('email',)
 
     def post(self, request, format=None):
         serializer = self.serializer_class(data=request.data)
@@ -330,9 +423,10 @@ class PasswordChange(APIView):
         if serializer.is_valid():
             user = request.user
 
-            password = serializer.data['password']
+            password = serializer.validated_data['password']
             user.set_password(password)
-            user.save()
+            user.save(update_fields=['password'])
+            audit.record(request, AuditEvent.PASSWORD_CHANGE, user)
 
             content = {'success': _('Password changed.')}
             return Response(content, status=status.HTTP_200_OK)
@@ -342,9 +436,93 @@ class PasswordChange(APIView):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserMe(APIView):
+class UserMe(ViewMetricsMixin, APIView):
     permission_classes = (IsAuthenticated,)
     serializer_class = UserSerializer
 
     def get(self, request, format=None):
         return Response(self.serializer_class(request.user).data)
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    Pages by id, so a page needs no OFFSET however deep it is.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def __init__(self, *args, **kwargs):
+        super(UserCursorPagination, self).__init__(*args, **kwargs)
+        self.page_size = getattr(settings, 'AUTH_EMAIL_USER_LIST_PAGE_SIZE',
+                                 100)
+
+
+class UserList(ViewMetricsMixin, generics.ListAPIView):
+    """
+    Lists users for staff, filtered by the is_verified, is_active,
+    joined_after, joined_before and email (prefix) query parameters.
+    """
+    permission_classes = (IsAdminUser,)
+    serializer_class = UserSerializer
+    pagination_class = UserCursorPagination
+    user_fields = ()
+
+    def get_queryset(self):
+        serializer = UserListFilterSerializer(
+            data=self.request.query_params.dict())
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        queryset = get_user_model()._default_manager.all()
+        fields = get_serializer_user_fields(self.get_serializer_class())
+        if fields is not None:
+            queryset = queryset.only(*fields)
+        for name in ('is_verified', 'is_active'):
+            if name in params:
+                queryset = queryset.filter(**{name: params[name]})
+        if 'joined_after' in params:
+            queryset = queryset.filter(date_joined__gte=params['joined_after'])
+        if 'joined_before' in params:
+            queryset = queryset.filter(date_joined__lt=params['joined_before'])
+        if params.get('email'):
+            queryset = queryset.filter(email__startswith=params['email'])
+        return queryset
+
+
+class Stats(APIView):
+    """
+    The totals and daily counts of the signup funnel over the last 'days'
+    query parameter (default 30) days, for staff.
+    """
+    permission_classes = (IsAdminUser,)
+    user_fields = ()
+
+    def get(self, request, format=None):
+        serializer = DailyStatsQuerySerializer(data=request.query_params.dict())
+        serializer.is_valid(raise_exception=True)
+
+        since = stats.today() - timedelta(
+            days=serializer.validated_data['days'] - 1)
+        content = {
+            'since': since,
+            'totals': DailyStats.objects.summary(since),
+            'days': DailyStatsSerializer(DailyStats.objects.between(since),
+                                         many=True).data,
+        }
+        return Response(content, status=status.HTTP_200_OK)
+
+
+class Metrics(APIView):
+    permission_classes = (IsAdminUser,)
+    user_fields = ()
+
+    def get(self, request, format=None):
+        """
+        Render the in-memory metrics in the Prometheus text format.
+        """
+        sink = metrics.get_sink()
+        if not hasattr(sink, 'render_prometheus'):
+            raise Http404
+        return HttpResponse(sink.render_prometheus(),
+                            content_type='text/plain; version=0.0.4')
@@ -0,0 +1,85 @@
+"""
+Query report of the authemail endpoints.
+
+Runs the flows of benchmarks/querybudget.py against a throwaway test
+database and reports the SQL queries and time per step, against the budgets
+in benchmarks/query_budgets.json.
+
+Run from the repository root:
+
+    python -m benchmarks.query_report
+    BENCH_DB=postgres python -m benchmarks.query_report --check
+"""
+import argparse
+import json
+import os
+import sys
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--db', choices=('sqlite', 'postgres'),
+                        default=os.environ.get('BENCH_DB', 'sqlite'))
+    parser.add_argument('--json', action='store_true',
+                        help='Output the report as JSON.')
+    parser.add_argument('--check', action='store_true',
+                        help='Exit with an error if any step is over or '
+                             'under its query budget.')
+    parser.add_argument('--write-budgets', action='store_true',
+                        help='Write the measured query counts to '
+                             'benchmarks/query_budgets.json.')
+    args = parser.parse_args(argv)
+
+    os.environ['BENCH_DB'] = args.db
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    import django
+    django.setup()
+
+    from django.db import connection, transaction
+    from django.test.utils import override_settings
+
+    from benchmarks.querybudget import BUDGETS_FILE, FlowRunner
+    from benchmarks.querybudget import load_budgets, off_budget
+
+    db_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        # Like the tests, run the flows in a transaction that's rolled back
+        with transaction.atomic(), override_settings(
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            measurements = FlowRunner().run()
+            transaction.set_rollback(True)
+    finally:
+        connection.creation.destroy_test_db(db_name, verbosity=0)
+
+    budgets = load_budgets()
+
+    if args.write_budgets:
+        measured = dict((m.step, m.num_queries) for m in measurements)
+        with open(BUDGETS_FILE, 'w') as f:
+            json.dump(measured, f, indent=4, sort_keys=True)
+            f.write('\n')
+        budgets = measured
+
+    if args.json:
+        report = [{'step': m.step, 'method': m.method,
+                   'status': m.status_code, 'expected': m.expected_status,
+                   'queries': m.num_queries, 'budget': budgets.get(m.step),
+                   'ms': round(m.seconds * 1000, 2)}
+                  for m in measurements]
+        print(json.dumps(report, indent=4))
+    else:
+        print('%-55s %6s %7s %9s' % ('step', 'status', 'queries', 'ms'))
+        for m in measurements:
+            print('%-55s %6d %3d/%-3s %9.2f' % (
+                m.step, m.status_code, m.num_queries,
+                budgets.get(m.step, '-'), m.seconds * 1000))
+
+    failures = off_budget(measurements, budgets)
+    if args.check and failures:
+        sys.exit('Off query budget or failed: %s' %
+                 ', '.join(m.step for m in failures))
+
+
+if __name__ == '__main__':
+    main()
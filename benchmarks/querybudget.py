@@ -0,0 +1,150 @@
+"""
+The authemail flows and their query budgets, used by QueryBudgetTests and
+benchmarks.query_report.
+"""
+import json
+import os
+import re
+import time
+import uuid
+
+from django.core import mail
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
+
+
+def load_budgets(path=BUDGETS_FILE):
+    with open(path) as f:
+        return json.load(f)
+
+
+class Measurement(object):
+    def __init__(self, step, method, status_code, expected_status, queries,
+                 seconds):
+        self.step = step
+        self.method = method
+        self.status_code = status_code
+        self.expected_status = expected_status
+        self.queries = queries
+        self.seconds = seconds
+
+    @property
+    def num_queries(self):
+        return len(self.queries)
+
+
+class FlowRunner(object):
+    """
+    Drives the authemail endpoints through complete flows with the test
+    client and records the SQL queries issued and time spent per step.
+
+    Each step is labelled '<flow>:<url name>' so the same endpoint can be
+    budgeted separately for the different paths through it.
+    """
+    def __init__(self):
+        self.client = APIClient()
+        self.measurements = []
+        self.suffix = uuid.uuid4().hex[:8]
+
+    def email(self, name):
+        return 'querybudget-%s-%s@mail.com' % (name, self.suffix)
+
+    def last_code(self):
+        match = re.search(r'\?code=([0-9a-f]+)$', mail.outbox[-1].body,
+                          re.MULTILINE)
+        return match.group(1) if match else None
+
+    def request(self, flow, url_name, method, data=None,
+                expect=status.HTTP_200_OK):
+        step = '%s:%s' % (flow, url_name)
+        url = reverse(url_name)
+        with CaptureQueriesContext(connection) as ctx:
+            start = time.perf_counter()
+            response = getattr(self.client, method)(url, data)
+            seconds = time.perf_counter() - start
+        self.measurements.append(Measurement(
+            step, method.upper(), response.status_code, expect,
+            [q['sql'] for q in ctx.captured_queries], seconds))
+        return response
+
+    def signup_flow(self):
+        email = self.email('signup')
+        self.request('signup', 'authemail-signup', 'post',
+                     {'email': email, 'password': 'pw'},
+                     expect=status.HTTP_201_CREATED)
+        self.request('signup_again', 'authemail-signup', 'post',
+                     {'email': email, 'password': 'pw'},
+                     expect=status.HTTP_201_CREATED)
+        self.request('signup', 'authemail-signup-verify', 'get',
+                     {'code': self.last_code()})
+        self.request('signup_taken', 'authemail-signup', 'post',
+                     {'email': email, 'password': 'pw'},
+                     expect=status.HTTP_400_BAD_REQUEST)
+        self.request('signup_bad_code', 'authemail-signup-verify', 'get',
+                     {'code': 'XXX'}, expect=status.HTTP_400_BAD_REQUEST)
+        return email
+
+    def login_flow(self, email):
+        self.request('login_bad_password', 'authemail-login', 'post',
+                     {'email': email, 'password': 'XXX'},
+                     expect=status.HTTP_401_UNAUTHORIZED)
+        response = self.request('login', 'authemail-login', 'post',
+                                {'email': email, 'password': 'pw'})
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' +
+                                response.data['token'])
+        self.request('login', 'authemail-me', 'get')
+        self.request('login', 'authemail-password-change', 'post',
+                     {'password': 'pw'})
+
+    def email_change_flow(self):
+        email_new = self.email('changed')
+        self.request('email_change', 'authemail-email-change', 'post',
+                     {'email': email_new}, expect=status.HTTP_201_CREATED)
+        self.request('email_change', 'authemail-email-change-verify', 'get',
+                     {'code': self.last_code()})
+        self.request('email_change', 'authemail-logout', 'get')
+        self.client.credentials()
+        return email_new
+
+    def password_reset_flow(self, email):
+        self.request('password_reset_unknown', 'authemail-password-reset',
+                     'post', {'email': self.email('unknown')},
+                     expect=status.HTTP_400_BAD_REQUEST)
+        self.request('password_reset', 'authemail-password-reset', 'post',
+                     {'email': email}, expect=status.HTTP_201_CREATED)
+        code = self.last_code()
+        self.request('password_reset', 'authemail-password-reset-verify',
+                     'get', {'code': code})
+        self.request('password_reset', 'authemail-password-reset-verified',
+                     'post', {'code': code, 'password': 'pw'})
+
+    def run(self):
+        """
+        Run all flows.  Email must be captured by the locmem backend so the
+        codes can be read back from the outbox.
+        """
+        if not hasattr(mail, 'outbox'):
+            mail.outbox = []
+        email = self.signup_flow()
+        self.login_flow(email)
+        email = self.email_change_flow()
+        self.password_reset_flow(email)
+        return self.measurements
+
+
+def off_budget(measurements, budgets):
+    """
+    Returns the measurements whose query count differs from their budget,
+    which have no budget at all, or whose status isn't the expected one.
+
+    Steps issuing fewer queries than budgeted fail too, so that budgets are
+    lowered along with the query counts.
+    """
+    return [m for m in measurements
+            if m.num_queries != budgets.get(m.step) or
+            m.status_code != m.expected_status]
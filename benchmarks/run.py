@@ -0,0 +1,154 @@
+"""
+End-to-end benchmark of the authemail endpoints.
+
+Drives the URLconf in authemail/urls.py through the signup, password reset,
+and email change flows with Django's test client, delivering email over SMTP
+to an in-process sink from which the verification codes are read back.
+Reports throughput and p50/p95/p99 latency per step.
+
+Run from the repository root:
+
+    python -m benchmarks.run --iterations 200
+    BENCH_DB=postgres python -m benchmarks.run
+"""
+import argparse
+import json
+import math
+import os
+import time
+import uuid
+
+from benchmarks.smtp_sink import SMTPSink
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of a non-empty list.
+    """
+    ordered = sorted(values)
+    index = max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+
+class Recorder(object):
+    def __init__(self, client):
+        self.client = client
+        self.timings = {}
+        self.order = []
+
+    def request(self, step, method, path, data=None, expect=200, **extra):
+        start = time.perf_counter()
+        response = getattr(self.client, method)(path, data, **extra)
+        elapsed = time.perf_counter() - start
+        if response.status_code != expect:
+            raise RuntimeError('%s returned %d: %s' % (
+                step, response.status_code, response.content[:200]))
+        if step not in self.timings:
+            self.order.append(step)
+            self.timings[step] = []
+        self.timings[step].append(elapsed)
+        return response
+
+    def report(self):
+        rows = []
+        for step in self.order:
+            timings = self.timings[step]
+            rows.append({
+                'step': step,
+                'count': len(timings),
+                'rps': len(timings) / sum(timings),
+                'p50_ms': percentile(timings, 50) * 1000,
+                'p95_ms': percentile(timings, 95) * 1000,
+                'p99_ms': percentile(timings, 99) * 1000,
+            })
+        return rows
+
+
+def run_flows(recorder, sink):
+    suffix = uuid.uuid4().hex[:12]
+    email = 'bench-%s@mail.com' % suffix
+    email_new = 'bench-new-%s@mail.com' % suffix
+    password = 'bench-pw-%s' % suffix
+
+    # signup -> verify -> login -> users/me
+    recorder.request('signup', 'post', '/signup/',
+                     {'email': email, 'password': password}, expect=201)
+    recorder.request('signup/verify', 'get', '/signup/verify/',
+                     {'code': sink.last_code(email)})
+    response = recorder.request('login', 'post', '/login/',
+                                {'email': email, 'password': password})
+    auth = {'HTTP_AUTHORIZATION': 'Token ' + response.json()['token']}
+    recorder.request('users/me', 'get', '/users/me/', **auth)
+
+    # password reset -> verify -> verified
+    recorder.request('password/reset', 'post', '/password/reset/',
+                     {'email': email}, expect=201)
+    code = sink.last_code(email)
+    recorder.request('password/reset/verify', 'get',
+                     '/password/reset/verify/', {'code': code})
+    recorder.request('password/reset/verified', 'post',
+                     '/password/reset/verified/',
+                     {'code': code, 'password': password})
+
+    # email change -> verify
+    recorder.request('email/change', 'post', '/email/change/',
+                     {'email': email_new}, expect=201, **auth)
+    recorder.request('email/change/verify', 'get', '/email/change/verify/',
+                     {'code': sink.last_code(email_new)})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--db', choices=('sqlite', 'postgres'),
+                        default=os.environ.get('BENCH_DB', 'sqlite'))
+    parser.add_argument('--fast-hasher', action='store_true',
+                        help='Use the MD5 password hasher to take password '
+                             'hashing out of the measurements.')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    os.environ['BENCH_DB'] = args.db
+    if args.fast_hasher:
+        os.environ['BENCH_FAST_HASHER'] = '1'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client
+
+    with SMTPSink() as sink:
+        settings.EMAIL_PORT = sink.port
+        db_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            recorder = Recorder(Client())
+            start = time.perf_counter()
+            for i in range(args.iterations):
+                run_flows(recorder, sink)
+            elapsed = time.perf_counter() - start
+        finally:
+            connection.creation.destroy_test_db(db_name, verbosity=0)
+
+    rows = recorder.report()
+    if args.json:
+        print(json.dumps({'db': args.db, 'iterations': args.iterations,
+                          'seconds': elapsed, 'emails': sink.count,
+                          'steps': rows}, indent=4))
+        return
+
+    print('%d iterations on %s in %.2fs (%.1f flows/s, %d emails)' % (
+        args.iterations, args.db, elapsed, args.iterations / elapsed,
+        sink.count))
+    print('%-26s %6s %9s %9s %9s %9s' % (
+        'step', 'count', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for row in rows:
+        print('%-26s %6d %9.1f %9.2f %9.2f %9.2f' % (
+            row['step'], row['count'], row['rps'], row['p50_ms'],
+            row['p95_ms'], row['p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Django settings for the authemail benchmarks.
+
+The example project's `accounts` app provides the user model.  Set
+BENCH_DB=postgres to run against a local PostgreSQL server instead of
+SQLite; the BENCH_PG_* variables describe how to connect to it.
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'example_project'))
+
+SECRET_KEY = 'benchmarks-not-secret'
+DEBUG = False
+ALLOWED_HOSTS = ['testserver']
+
+AUTH_USER_MODEL = 'accounts.MyUser'
+AUTH_EMAIL_VERIFICATION = True
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'rest_framework',
+    'rest_framework.authtoken',
+    'authemail',
+    'accounts',
+]
+
+MIDDLEWARE = [
+    'django.middleware.common.CommonMiddleware',
+]
+
+ROOT_URLCONF = 'authemail.urls'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'APP_DIRS': True,
+    },
+]
+
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': (
+        'authemail.authentication.NarrowTokenAuthentication',
+    )
+}
+
+if os.environ.get('BENCH_DB') == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('BENCH_PG_NAME', 'authemail_bench'),
+            'USER': os.environ.get('BENCH_PG_USER', 'postgres'),
+            'PASSWORD': os.environ.get('BENCH_PG_PASSWORD', ''),
+            'HOST': os.environ.get('BENCH_PG_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('BENCH_PG_PORT', '5432'),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+    }
+
+if os.environ.get('BENCH_FAST_HASHER'):
+    PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+USE_TZ = True
+TIME_ZONE = 'UTC'
+
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+# The SMTP sink's port is filled in by benchmarks.run at startup.
+EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+EMAIL_HOST = '127.0.0.1'
+EMAIL_PORT = 0
+EMAIL_USE_TLS = False
+EMAIL_FROM = 'bench@mail.com'
+EMAIL_BCC = 'bench-bcc@mail.com'
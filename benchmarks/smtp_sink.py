@@ -0,0 +1,113 @@
+"""
+A minimal in-process SMTP server that accepts every message and keeps it in
+memory, so the benchmarks can exercise Django's real SMTP email backend
+without any network access.
+"""
+import email
+import re
+import socketserver
+import threading
+from email.policy import default as default_policy
+
+CODE_RE = re.compile(r'\?code=([0-9a-f]+)\s*$', re.MULTILINE)
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        mail_from, rcpt_to = None, []
+        self.reply('220 authemail-sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 authemail-sink')
+            elif verb == 'MAIL':
+                mail_from, rcpt_to = command[10:].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                rcpt_to.append(command[8:].strip().strip('<>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                self.server.sink.deliver(mail_from, rcpt_to, self.read_data())
+                self.reply('250 OK')
+            elif verb == 'RSET':
+                mail_from, rcpt_to = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if line in (b'.\r\n', b'.\n', b''):
+                return b''.join(lines)
+            if line.startswith(b'..'):
+                line = line[1:]
+            lines.append(line)
+
+
+class _ThreadingSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink(object):
+    """
+    Collects messages per recipient.  Use as a context manager; the port to
+    point EMAIL_PORT at is available as `port` once started.
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.server = _ThreadingSMTPServer((host, port), _SMTPHandler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.count = 0
+
+    def deliver(self, mail_from, rcpt_to, data):
+        message = email.message_from_bytes(data, policy=default_policy)
+        with self.lock:
+            self.count += 1
+            for rcpt in rcpt_to:
+                self.messages.setdefault(rcpt, []).append(message)
+
+    def last_message(self, rcpt):
+        with self.lock:
+            return self.messages[rcpt][-1]
+
+    def last_code(self, rcpt):
+        """
+        Returns the verification code in the latest message to rcpt.
+        """
+        body = self.last_message(rcpt).get_body(preferencelist=('plain',))
+        match = CODE_RE.search(body.get_content())
+        return match.group(1) if match else None
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark of request payload validation in the authemail views.
+
+Times validating the login and signup payloads the way the views used to,
+with full DRF validation and a serializer.data read per field, against the
+fast validation path with one validated_data read.  No database or HTTP is
+involved.
+
+Run from the repository root:
+
+    python -m benchmarks.validation --iterations 20000
+"""
+import argparse
+import json
+import os
+import time
+
+from django.http import QueryDict
+
+PAYLOADS = {
+    'login': {'email': 'user@mail.com', 'password': 'bench-pw'},
+    'signup': {'email': 'user@mail.com', 'password': 'bench-pw',
+               'first_name': 'Ann', 'last_name': 'Smith'},
+}
+
+
+def full_validation(serializer_class, data):
+    serializer = serializer_class(data=data)
+    if serializer.is_valid():
+        return [serializer.data[name] for name in data]
+
+
+def fast_validation(serializer_class, data):
+    serializer = serializer_class(data=data)
+    if serializer.is_valid():
+        validated_data = serializer.validated_data
+        return [validated_data[name] for name in data]
+
+
+def time_per_call(func, serializer_class, data, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(serializer_class, data)
+    return (time.perf_counter() - start) / iterations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--iterations', type=int, default=5000)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    import django
+    django.setup()
+
+    from django.test.utils import override_settings
+
+    from authemail.serializers import LoginSerializer, SignupSerializer
+
+    serializers = {'login': LoginSerializer, 'signup': SignupSerializer}
+    rows = []
+    for name, payload in PAYLOADS.items():
+        form = QueryDict(mutable=True)
+        form.update(payload)
+        for kind, data in (('json', payload), ('form', form)):
+            with override_settings(AUTH_EMAIL_FAST_VALIDATION=False):
+                before = time_per_call(full_validation, serializers[name],
+                                       data, args.iterations)
+            after = time_per_call(fast_validation, serializers[name], data,
+                                  args.iterations)
+            rows.append({'payload': '%s (%s)' % (name, kind),
+                         'before_us': before * 1e6, 'after_us': after * 1e6,
+                         'speedup': before / after})
+
+    if args.json:
+        print(json.dumps({'iterations': args.iterations, 'payloads': rows},
+                         indent=4))
+        return
+
+    print('%-16s %11s %11s %8s' % ('payload', 'before us', 'after us',
+                                    'speedup'))
+    for row in rows:
+        print('%-16s %11.1f %11.1f %7.1fx' % (
+            row['payload'], row['before_us'], row['after_us'],
+            row['speedup']))
+
+
+if __name__ == '__main__':
+    main()
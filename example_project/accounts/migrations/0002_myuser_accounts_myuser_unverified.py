@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(condition=models.Q(('is_verified', False)), fields=['date_joined'], name='accounts_myuser_unverified'),
+        ),
+    ]
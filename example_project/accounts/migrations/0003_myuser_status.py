@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_myuser_accounts_myuser_unverified'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='myuser',
+            index=models.Index(fields=['is_verified', 'is_active', 'id'], name='accounts_myuser_status'),
+        ),
+    ]
@@ -11,6 +11,17 @@ class MyUser(EmailAbstractUser):
     # Required
     objects = EmailUserManager()
 
+    class Meta(EmailAbstractUser.Meta):
+        indexes = [
+            # Finds stale unverified users to reap
+            models.Index(fields=['date_joined'],
+                         name='accounts_myuser_unverified',
+                         condition=models.Q(is_verified=False)),
+            # Pages through the staff user list filtered by status
+            models.Index(fields=['is_verified', 'is_active', 'id'],
+                         name='accounts_myuser_status'),
+        ]
+
 
 class VerifiedUserManager(EmailUserManager):
     def get_queryset(self):
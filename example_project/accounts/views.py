@@ -26,14 +26,14 @@ class MyUserMeChange(APIView):
         if serializer.is_valid():
             user = request.user
 
-            if 'first_name' in serializer.data:
-                user.first_name = serializer.data['first_name']
-            if 'last_name' in serializer.data:
-                user.last_name = serializer.data['last_name']
-            if 'date_of_birth' in serializer.data:
-                user.date_of_birth = serializer.data['date_of_birth']
-
-            user.save()
+            update_fields = []
+            for field in ('first_name', 'last_name', 'date_of_birth'):
+                if field in serializer.validated_data:
+                    setattr(user, field, serializer.validated_data[field])
+                    update_fields.append(field)
+
+            if update_fields:
+                user.save(update_fields=update_fields)
 
             content = {'success': _('User information changed.')}
             return Response(content, status=status.HTTP_200_OK)
@@ -78,7 +78,7 @@ TEMPLATES = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'authemail.authentication.NarrowTokenAuthentication',
     )
 }
 
@@ -23,7 +23,8 @@ setup(
     ],
     url='http://github.com/celiao/django-rest-authemail',
     download_url='https://github.com/celiao/django-rest-authemail/tarball/2.1.7',
-    packages=['authemail'],
+    packages=['authemail', 'authemail.management',
+              'authemail.management.commands'],
     include_package_data=True,
     long_description=long_description,
     long_description_content_type="text/markdown",